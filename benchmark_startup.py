@@ -0,0 +1,41 @@
+"""
+Measures the startup cost of the dataset module and of the shared face models.
+
+Each measurement runs in a fresh interpreter, so nothing is shared between
+them: importing dataset.py alone (what text/audio runs and DataLoader workers
+pay), then building the MTCNN detector and the FaceNet embedder on first use.
+
+Example:
+    python benchmark_startup.py --device cpu --repeats 3
+"""
+import argparse
+import subprocess
+import sys
+
+IMPORT = "import time; start = time.time(); import dataset; print(time.time() - start)"
+MODEL = ("import time; import dataset; from models.visual_features import {0}, set_face_model_device; "
+         "set_face_model_device('{1}'); start = time.time(); {0}(); print(time.time() - start)")
+
+
+def measure(code, repeats):
+    times = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-W", "ignore", "-c", code], check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        times.append(float(output.strip().splitlines()[-1]))
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the startup of dataset.py and the face models")
+    parser.add_argument("--device", default="cuda")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    print("import dataset:            {:.2f}s".format(measure(IMPORT, args.repeats)))
+    print("first get_face_detector(): {:.2f}s".format(measure(MODEL.format("get_face_detector", args.device), args.repeats)))
+    print("first get_face_embedder(): {:.2f}s".format(measure(MODEL.format("get_face_embedder", args.device), args.repeats)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Compares per-utterance and batched BERT encoding throughput on CPU.
+
+The per-utterance path is what DialogueGCN.embed_text used to do: one BERT call
+with batch size 1 for each transcript. The batched path is
+models.text_features.encode_transcripts, which pads length-bucketed batches
+under an attention mask. Transcripts are random token ids whose lengths follow
+MELD (mostly short utterances with a long tail), grouped into dialogues of
+--dialogue-size utterances.
+
+BERT has bert-base-uncased's shape but random weights by default, which does
+not change the cost; pass --pretrained to load the real weights.
+
+Example:
+    python benchmark_text_encoding.py --threads 4 --max-batch-tokens 1024 4096
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from transformers import BertConfig, BertModel
+
+from models.text_features import encode_transcripts
+
+
+def make_transcripts(num_utterances, seed=0):
+    rng = np.random.RandomState(seed)
+    # MELD transcripts are about 10 words long on average, with a few above 60
+    lengths = np.clip(rng.lognormal(2.6, 0.6, size=num_utterances).astype(int), 1, 100) + 2
+    return [rng.randint(1000, 30000, size=length).tolist() for length in lengths]
+
+
+def per_utterance(bert, transcripts):
+    for ids in transcripts:
+        bert(torch.tensor([ids]))[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-utterance and batched BERT encoding on CPU")
+    parser.add_argument("--utterances", type=int, default=256)
+    parser.add_argument("--dialogue-size", type=int, default=10, help="utterances encoded per batched call")
+    parser.add_argument("--max-batch-tokens", type=int, nargs="+", default=[1024, 4096])
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--pretrained", action="store_true")
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    if args.pretrained:
+        bert = BertModel.from_pretrained('bert-base-uncased')
+    else:
+        bert = BertModel(BertConfig())
+    bert.eval()
+    transcripts = make_transcripts(args.utterances)
+    dialogues = [transcripts[i:i + args.dialogue_size] for i in range(0, len(transcripts), args.dialogue_size)]
+
+    with torch.inference_mode():
+        per_utterance(bert, transcripts[:4])
+        start = time.time()
+        per_utterance(bert, transcripts)
+        base = time.time() - start
+        print("{:<36} {:8.1f} utt/s".format("per utterance", len(transcripts) / base))
+
+        for max_batch_tokens in args.max_batch_tokens:
+            for name, groups in [("dialogues of {}".format(args.dialogue_size), dialogues), ("all at once", [transcripts])]:
+                start = time.time()
+                for group in groups:
+                    encode_transcripts(bert, group, "cpu", max_batch_tokens)
+                elapsed = time.time() - start
+                print("{:<36} {:8.1f} utt/s  {:.1f}x".format(
+                    "batched, {}, {} tok".format(name, max_batch_tokens), len(transcripts) / elapsed, base / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Precomputes the BERT hidden states of every MELD transcript ahead of training.
+
+BERT is frozen in DialogueGCN, so encoding the same transcripts every epoch is
+wasted work. This script tokenizes each transcript of the requested splits
+with the same fast tokenizer as the dataset, runs it through bert-base-uncased
+once in length-bucketed batches (see models.text_features.encode_transcripts)
+and writes the per-token hidden states (tokens x 768) into a memory-mapped
+FeatureStore at dataset.TEXT_CACHE_PATH, keyed like the token cache by split,
+dialogue, utterance and a hash of the transcript (see
+dataset.get_transcript_key). Entries of an existing store are kept, so only new
+or edited transcripts are encoded when the command is re-run; the hidden
+states of the old version of an edited transcript are dropped.
+
+Set config.use_text_cache to train from the store.
+
+Example:
+    python -u build_text_cache.py --data-root ../MELD.Raw
+"""
+import argparse
+import os
+import time
+
+import torch
+from transformers import BertModel
+
+from feature_store import FeatureStore, FeatureStoreWriter
+from models.config import Config
+from models.text_features import encode_transcripts, tokenize_transcripts
+
+
+def collect_utterances(data_root, splits):
+    """
+    Returns (cache key, text store key, transcript) for every utterance of the
+    given splits
+    """
+    from dataset import MELDDataset, MELD_SPLITS
+
+    config = Config(False, False, False, 0, False)
+    utterances = []
+    for name in splits:
+        csv_file, video_dir = MELD_SPLITS[name]
+        split = MELDDataset(os.path.join(data_root, csv_file), os.path.join(data_root, video_dir), None, name=name, config=config)
+        utterances.extend(zip(split.get_cache_keys(), split.get_transcript_keys(), split.transcripts.tolist()))
+    return utterances
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the cached BERT hidden states for MELD")
+    parser.add_argument("--data-root", default="../MELD.Raw")
+    parser.add_argument("--splits", nargs="+", default=["train", "val", "test"], choices=["train", "val", "test"])
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", default="float16", choices=["float16", "float32"])
+    parser.add_argument("--max-batch-tokens", type=int, default=4096, help="padded tokens per BERT batch")
+    parser.add_argument("--chunk-size", type=int, default=1024, help="utterances sorted and encoded together")
+    args = parser.parse_args(argv)
+
+    import dataset
+    from dataset import TEXT_CACHE_PATH
+
+    utterances = collect_utterances(args.data_root, args.splits)
+    old_store = FeatureStore(TEXT_CACHE_PATH) if FeatureStore.exists(TEXT_CACHE_PATH) else None
+    pending = [(key, text_key, transcript) for key, text_key, transcript in utterances
+               if old_store is None or text_key not in old_store]
+    print("{} utterances, {} already cached, {} to encode".format(len(utterances), len(utterances) - len(pending), len(pending)))
+    if len(pending) == 0:
+        return
+
+    bert = BertModel.from_pretrained('bert-base-uncased').to(args.device).eval()
+
+    os.makedirs(os.path.dirname(TEXT_CACHE_PATH), exist_ok=True)
+    start = time.time()
+    with FeatureStoreWriter(TEXT_CACHE_PATH, args.dtype) as writer:
+        if old_store is not None:
+            # older versions of the pending transcripts are dropped
+            stale = set(key for key, _, _ in pending)
+            for key in old_store.keys():
+                if key.rsplit('_', 1)[0] not in stale:
+                    writer.add(key, old_store.get(key))
+        with torch.inference_mode():
+            for chunk_start in range(0, len(pending), args.chunk_size):
+                chunk = pending[chunk_start:chunk_start + args.chunk_size]
+                input_ids = tokenize_transcripts([transcript for _, _, transcript in chunk])
+                hidden_states, lengths, order = encode_transcripts(bert, input_ids, args.device, args.max_batch_tokens)
+                hidden_states = hidden_states.cpu().numpy()
+                for row, i in enumerate(order.tolist()):
+                    writer.add(chunk[i][1], hidden_states[row, :lengths[row]])
+                done = chunk_start + len(chunk)
+                elapsed = time.time() - start
+                print("[{}/{}] {:.1f} utt/s, {:.0f}s elapsed".format(done, len(pending), done / elapsed, elapsed))
+    # reopen the rewritten store on next use
+    dataset.feature_stores.pop(TEXT_CACHE_PATH, None)
+    print("Wrote {} entries to {}.bin".format(len(writer.keys), TEXT_CACHE_PATH))
+
+
+if __name__ == "__main__":
+    main()
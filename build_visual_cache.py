@@ -0,0 +1,165 @@
+"""
+Warms the ./cache/persons_*_rate_*_size_* visual feature cache ahead of training.
+
+The dialogues of the requested MELD splits are sharded across a pool of worker
+processes. Each worker runs its own MTCNN/InceptionResnetV1 instance (pinned to
+one GPU when several are available), detects faces over all frames of a dialogue
+in batches of --frame-batch-size frames and writes cache entries atomically, so
+the command can be interrupted and re-run: utterances whose cache file already
+exists are skipped. With --keyframe-interval, the full detector only runs on
+every n-th sampled frame of an utterance and faces are tracked in between.
+
+With --pack, the per-utterance .pth files of the setting are afterwards packed
+into a single memory-mapped FeatureStore next to the cache directory, which
+get_cached_visual_features reads before falling back to the .pth files.
+
+Example:
+    python -u build_visual_cache.py --data-root ../MELD.Raw --workers 4 --pack
+"""
+import argparse
+import glob
+import multiprocessing
+import os
+import time
+
+import torch
+
+from feature_store import FeatureStore, FeatureStoreWriter
+from models.config import Config
+from models.visual_features import get_face_embedder, set_face_model_device
+
+
+def init_worker(worker_ids, num_gpus, embed_batch_size, device):
+    """
+    Pins the worker to a GPU before the face models are built, so that the
+    "cuda" device they are built on refers to that GPU.
+    """
+    worker_id = worker_ids.get()
+    if num_gpus > 0:
+        torch.cuda.set_device(worker_id % num_gpus)
+    if device is not None:
+        set_face_model_device(device)
+    global dataset
+    import dataset
+    get_face_embedder().max_batch_size = embed_batch_size
+
+
+def build_dialogue(task):
+    name, dialogue_id, utterances, max_persons, output_size, sampling_rate, frame_batch_size, keyframe_interval = task
+    utterances = [dataset.Utterance(dialogue_id, utterance_id, None, None, None, None, file_path, None, name)
+                  for utterance_id, file_path in utterances]
+    built = dataset.Dialogue(dialogue_id, utterances).build_cached_visual_features(
+        max_persons, output_size, sampling_rate, frame_batch_size, keyframe_interval)
+    return name, dialogue_id, built
+
+
+def collect_tasks(data_root, splits, max_persons, output_size, sampling_rate, frame_batch_size, keyframe_interval):
+    """
+    Returns one task per dialogue of the given splits with the utterances that
+    are neither packed nor cached as a .pth file yet, the number of those
+    utterances, and the total number of utterances.
+    """
+    from dataset import MELDDataset, MELD_SPLITS, get_visual_store
+
+    config = Config(False, False, False, 0, True)
+    store = get_visual_store(max_persons, output_size, sampling_rate)
+    tasks = []
+    pending = 0
+    total = 0
+    for name in splits:
+        csv_file, video_dir = MELD_SPLITS[name]
+        split = MELDDataset(os.path.join(data_root, csv_file), os.path.join(data_root, video_dir), None, name=name, config=config)
+        for dialogue in split.data:
+            utterances = []
+            for utterance in dialogue.utterances:
+                total += 1
+                if store is not None and utterance.get_visual_cache_key() in store:
+                    continue
+                if os.path.exists(utterance.get_visual_cache_path(max_persons, output_size, sampling_rate)):
+                    continue
+                utterances.append((utterance.utterance_id, utterance.file_path))
+            if len(utterances) > 0:
+                pending += len(utterances)
+                tasks.append((name, dialogue.dialogue_id, utterances, max_persons, output_size, sampling_rate,
+                              frame_batch_size, keyframe_interval))
+    return tasks, pending, total
+
+
+def pack_visual_cache(max_persons, output_size, sampling_rate, dtype):
+    """
+    Packs the .pth files of one cache setting into a FeatureStore. Entries of an
+    existing store whose .pth file has since been deleted are carried over, so
+    the .pth files can be removed once they have been packed.
+    """
+    from dataset import get_visual_setting_path
+
+    setting_path = get_visual_setting_path(max_persons, output_size, sampling_rate)
+    files = sorted(glob.glob(os.path.join(setting_path, '*.pth')))
+    old_store = FeatureStore(setting_path) if FeatureStore.exists(setting_path) else None
+    start = time.time()
+    with FeatureStoreWriter(setting_path, dtype) as writer:
+        for file_path in files:
+            writer.add(os.path.basename(file_path)[:-len('.pth')], torch.load(file_path).numpy())
+        carried = 0
+        if old_store is not None:
+            for key in old_store.keys():
+                if not os.path.exists(os.path.join(setting_path, key + '.pth')):
+                    writer.add(key, old_store.get(key))
+                    carried += 1
+    print("Packed {} cached utterances ({} carried over from the previous store) into {}.bin in {:.0f}s".format(
+        len(files) + carried, carried, setting_path, time.time() - start))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the cached visual features for MELD")
+    parser.add_argument("--data-root", default="../MELD.Raw")
+    parser.add_argument("--splits", nargs="+", default=["train", "val", "test"], choices=["train", "val", "test"])
+    parser.add_argument("--device", default=None, help="device of the face models, cuda when available by default")
+    parser.add_argument("--workers", type=int, default=max(1, torch.cuda.device_count()))
+    parser.add_argument("--max-persons", type=int, default=7)
+    parser.add_argument("--output-size", type=int, default=224)
+    parser.add_argument("--sampling-rate", type=int, default=30)
+    parser.add_argument("--frame-batch-size", type=int, default=32, help="frames per MTCNN batch")
+    parser.add_argument("--embed-batch-size", type=int, default=64, help="faces per FaceNet batch")
+    parser.add_argument("--keyframe-interval", type=int, default=None,
+                        help="track faces between keyframes this many sampled frames apart")
+    parser.add_argument("--log-every", type=int, default=10, help="log progress every n dialogues")
+    parser.add_argument("--pack", action="store_true", help="pack the .pth cache into a memory-mapped store")
+    parser.add_argument("--pack-dtype", default="float16", choices=["float16", "float32"])
+    parser.add_argument("--skip-build", action="store_true", help="only pack the existing .pth cache")
+    args = parser.parse_args()
+
+    if not args.skip_build:
+        build(args)
+    if args.pack:
+        pack_visual_cache(args.max_persons, args.output_size, args.sampling_rate, args.pack_dtype)
+
+
+def build(args):
+    tasks, pending, total = collect_tasks(args.data_root, args.splits, args.max_persons, args.output_size,
+                                          args.sampling_rate, args.frame_batch_size, args.keyframe_interval)
+    print("{} utterances, {} already cached, {} to build in {} dialogues with {} workers".format(
+        total, total - pending, pending, len(tasks), args.workers))
+    if len(tasks) == 0:
+        return
+
+    # CUDA cannot be re-initialised in forked children, every worker starts a fresh interpreter
+    context = multiprocessing.get_context("spawn")
+    worker_ids = context.Queue()
+    for i in range(args.workers):
+        worker_ids.put(i)
+
+    start = time.time()
+    done = 0
+    with context.Pool(args.workers, initializer=init_worker, initargs=(worker_ids, torch.cuda.device_count(), args.embed_batch_size, args.device)) as pool:
+        for i, (name, dialogue_id, built) in enumerate(pool.imap_unordered(build_dialogue, tasks), 1):
+            done += built
+            if i % args.log_every == 0 or i == len(tasks):
+                elapsed = time.time() - start
+                rate = done / elapsed
+                print("[{}/{}] {:.2f} utt/s, {:.0f}s elapsed, {:.0f}s remaining (last: {} dia {})".format(
+                    done, pending, rate, elapsed, (pending - done) / rate if rate > 0 else 0, name, dialogue_id))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Converts the pickled audio features main.py reads into memory-mapped stores.
+
+Unpickling train_audio.pkl and friends loads every feature vector into memory
+before training can start. This script writes the fixed-size features of each
+pickle into a MatrixStore (one float32 row per utterance, indexed by dialogue
+and utterance id) at dataset.get_audio_store_path(pickle), and the temporal
+features of our audio into a FeatureStore next to it. load_audio_embeddings
+reads the stores instead of the pickle once they exist.
+
+Pickles of our audio hold a (fixed, temporal) pair of dicts, the MELD
+feature-selection pickle a (train, val, test) triple of dicts, each keyed by
+"<dialogue_id>_<utterance_id>".
+
+Example:
+    python -u convert_audio_features.py ../MELD.Raw/train_audio.pkl ../MELD.Raw/dev_audio.pkl ../MELD.Raw/test_audio.pkl
+    python -u convert_audio_features.py --meld ../MELD.Raw/audio_embeddings_feature_selection_emotion.pkl
+"""
+import argparse
+import pickle
+import time
+
+from feature_store import FeatureStoreWriter, MatrixStoreWriter
+
+
+def write_fixed_features(store_path, audio_embs, dtype):
+    with MatrixStoreWriter(store_path, dtype) as writer:
+        for key, features in audio_embs.items():
+            dialogue_id, utterance_id = key.split('_')
+            writer.add(int(dialogue_id), int(utterance_id), features)
+    print("Wrote {} utterances with {} features to {}.bin".format(len(writer.dialogue_ids), writer.num_features, store_path))
+
+
+def write_temporal_features(store_path, audio_embs, dtype):
+    with FeatureStoreWriter(store_path, dtype) as writer:
+        for key, features in audio_embs.items():
+            writer.add(key, features)
+    print("Wrote {} utterances to {}.bin".format(len(writer.keys), store_path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert pickled audio features into memory-mapped stores")
+    parser.add_argument("pickles", nargs="+", help="audio feature pickles, as passed to main.py")
+    parser.add_argument("--meld", action="store_true", help="the pickles hold (train, val, test) MELD features")
+    parser.add_argument("--dtype", default="float32", choices=["float16", "float32"])
+    args = parser.parse_args()
+
+    from dataset import MELD_SPLITS, get_audio_store_path
+
+    for pickle_path in args.pickles:
+        start = time.time()
+        with open(pickle_path, 'rb') as f:
+            audio_embs = pickle.load(f)
+        print("Unpickled {} in {:.0f}s".format(pickle_path, time.time() - start))
+        if args.meld:
+            for split, split_embs in zip(MELD_SPLITS, audio_embs):
+                write_fixed_features(get_audio_store_path(pickle_path, split), split_embs, args.dtype)
+        else:
+            fixed_embs, temporal_embs = audio_embs
+            store_path = get_audio_store_path(pickle_path)
+            # written first, so a store is only picked up once both halves exist
+            write_temporal_features(store_path + '_temporal', temporal_embs, args.dtype)
+            write_fixed_features(store_path, fixed_embs, args.dtype)
+
+
+if __name__ == "__main__":
+    main()
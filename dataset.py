@@ -3,53 +3,321 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.dataloader import default_collate
 from torchvision import transforms, utils
 from PIL import Image
 import os
 import cv2
 from scipy.io import wavfile
 import pickle
-from models.visual_features import detect_faces_mtcnn
+import hashlib
+import functools
+from models.visual_features import detect_faces_mtcnn, align_face_identities, get_face_detector, get_face_embedder, set_face_model_device
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import StandardScaler
 from sklearn.svm import LinearSVC
 from torchvision.transforms import ToPILImage
 from facenet_pytorch_local.models.mtcnn import MTCNN
 from facenet_pytorch_local.models.inception_resnet_v1 import InceptionResnetV1
+from models.text_features import tokenize_transcripts
+from feature_store import FeatureStore, FeatureStoreWriter, MatrixStore
+
+VISUAL_CACHE_PATH = './cache'
+# per-token BERT hidden states of every transcript, built by build_text_cache.py
+TEXT_CACHE_PATH = './cache/bert_base_uncased'
+# int32 bert-base-uncased token ids of every transcript, built by MELDDataset
+TOKEN_CACHE_PATH = './cache/bert_base_uncased_tokens'
+# columnar indexes of the parsed csv files, built by load_meld_index
+INDEX_CACHE_PATH = './cache/index'
+# converted audio feature pickles, written by convert_audio_features.py
+AUDIO_STORE_PATH = './cache/audio'
+# audio statistics fitted by MELDDataset.get_audio_stats, keyed by split and feature hash
+AUDIO_PARAMS_CACHE_PATH = './cache/audio_params'
+
+# packed stores opened so far in this process, keyed by store path
+feature_stores = {}
+
+def get_feature_store(store_path):
+    """
+    Returns the packed FeatureStore at `store_path`, or None if it has not
+    been built yet
+    """
+    if store_path not in feature_stores:
+        feature_stores[store_path] = FeatureStore(store_path) if FeatureStore.exists(store_path) else None
+    return feature_stores[store_path]
+
+def get_visual_setting_path(max_persons=7, output_size=224, sampling_rate=30):
+    """
+    Returns the cache directory for the given visual settings. The packed store
+    for the same settings lives next to it as <setting path>.bin/.index.json
+    """
+    return os.path.join(VISUAL_CACHE_PATH, 'persons_{}_rate_{}_size_{}'.format(max_persons, sampling_rate, output_size))
 
-mtcnn_model = MTCNN(image_size=224, margin=0, keep_all=True)
-facenet_model = InceptionResnetV1(pretrained='vggface2').eval().to("cuda")
+def get_visual_store(max_persons=7, output_size=224, sampling_rate=30):
+    """
+    Returns the packed FeatureStore for the given visual settings, or None if
+    the per-utterance .pth cache has not been packed yet
+    """
+    return get_feature_store(get_visual_setting_path(max_persons, output_size, sampling_rate))
+
+def get_text_store():
+    """
+    Returns the packed store of BERT hidden states, or None if
+    build_text_cache.py has not been run yet
+    """
+    return get_feature_store(TEXT_CACHE_PATH)
 
-def video_to_tensor(video_file, sampling_rate=30):
-    """ Converts a mp4 file into a pytorch tensor"""
+def get_token_store():
+    """
+    Returns the packed store of transcript token ids, or None if it has not
+    been built yet
+    """
+    return get_feature_store(TOKEN_CACHE_PATH)
+
+def get_transcript_key(cache_key, transcript):
+    """
+    Returns the key of a transcript in the token and text stores: its cache
+    key plus a hash of the text, so an edited transcript is never served stale
+    token ids or hidden states
+    """
+    return '{}_{}'.format(cache_key, hashlib.sha1(str(transcript).encode()).hexdigest()[:16])
+
+def build_token_cache(keys, transcripts):
+    """
+    Tokenizes the transcripts that are not in the token store yet with the
+    fast tokenizer and rewrites the store with them, keeping the existing
+    entries except the ones of older versions of the same utterances.
+    Returns the token store key of every transcript.
+    """
+    token_keys = [get_transcript_key(key, transcript) for key, transcript in zip(keys, transcripts)]
+    store = get_token_store()
+    pending = [i for i, key in enumerate(token_keys) if store is None or key not in store]
+    if len(pending) == 0:
+        return token_keys
+    token_ids = tokenize_transcripts([str(transcripts[i]) for i in pending])
+    stale = set(keys[i] for i in pending)
+    with FeatureStoreWriter(TOKEN_CACHE_PATH, 'int32') as writer:
+        if store is not None:
+            for key in store.keys():
+                if key.rsplit('_', 1)[0] not in stale:
+                    writer.add(key, store.get(key))
+        for i, ids in zip(pending, token_ids):
+            writer.add(token_keys[i], ids)
+    # reopen the rewritten store on next use
+    feature_stores.pop(TOKEN_CACHE_PATH, None)
+    print("Tokenized {} transcripts into {}.bin".format(len(pending), TOKEN_CACHE_PATH))
+    return token_keys
+
+def detect_video_faces(videos, frame_batch_size=32, keyframe_interval=None):
+    """
+    Runs MTCNN over the frames of several videos (eg. all utterances of a
+    dialogue) at once. Videos with the same frame size are concatenated and
+    sent through the detector `frame_batch_size` frames at a time.
+
+    With `keyframe_interval`, faces are only detected on every
+    `keyframe_interval`-th frame of each video and tracked on the frames in
+    between (see MTCNN.detect_tensor).
+
+    Returns, for every video, a list with one entry per frame that is either
+    None or a (faces, 3, size, size) tensor on the cpu.
+    """
+    faces = [None] * len(videos)
+    by_shape = {}
+    for i, video in enumerate(videos):
+        by_shape.setdefault(tuple(video.shape[1:]), []).append(i)
+    for indices in by_shape.values():
+        frames = torch.cat([videos[i] for i in indices], dim=0)
+        frame_faces = get_face_detector().forward_tensor(frames, frame_batch_size, keyframe_interval,
+                                                 [len(videos[i]) for i in indices])
+        frame_faces = [None if f is None else f.cpu() for f in frame_faces]
+        start = 0
+        for i in indices:
+            faces[i] = frame_faces[start:start + len(videos[i])]
+            start += len(videos[i])
+    return faces
+
+def sample_video_frames(video_file, sampling_rate=30, out=None, seek=False):
+    """
+    Generator over every `sampling_rate`-th frame of a mp4 file, starting with
+    the first frame.
+
+    Skipped frames are only grabbed (or jumped over by seeking when `seek` is
+    True) and never converted or copied. Each yielded frame is a (H, W, 3)
+    uint8 array in OpenCV's BGR order, written into a reused buffer: slot i of
+    `out` when it is given, otherwise a single frame buffer that is
+    overwritten on the next step, so copy it if it has to be kept. Nothing is
+    yielded for files OpenCV cannot open.
+    """
+    cap = cv2.VideoCapture(video_file)
+    try:
+        if cap.isOpened():
+            yield from _sample_frames(cap, sampling_rate, out, seek)
+    finally:
+        cap.release()
+
+def _sample_frames(cap, sampling_rate, out, seek):
+    if out is None:
+        frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        frame = np.empty((frame_height, frame_width, 3), np.dtype('uint8'))
+
+    fc = 0
+    while out is None or fc < len(out):
+        if fc > 0:
+            if seek:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, fc * sampling_rate)
+            else:
+                for _ in range(sampling_rate - 1):
+                    if not cap.grab():
+                        return
+        if not cap.grab():
+            return
+        target = frame if out is None else out[fc]
+        ret, image = cap.retrieve(target)
+        if not ret:
+            return
+        if image is not target:
+            target[...] = image
+        yield target
+        fc += 1
+
+def video_to_tensor(video_file, sampling_rate=30, seek=False):
+    """ Converts a mp4 file into a pytorch tensor of every `sampling_rate`-th frame"""
 
     cap = cv2.VideoCapture(video_file)
-    frameCount = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) / sampling_rate)
+    frameCount = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    frameCount = (frameCount + sampling_rate - 1) // sampling_rate
     frameWidth = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     frameHeight = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
     buf = np.empty((frameCount, frameHeight, frameWidth, 3), np.dtype('uint8'))
 
     fc = 0
-    ret = True
-
-    while (fc < frameCount  and ret):
-        ret, frame = cap.read()
-        if fc % sampling_rate == 0:
-            buf[fc] = frame
+    for _ in _sample_frames(cap, sampling_rate, buf, seek):
         fc += 1
 
     cap.release()
-    return torch.tensor(buf)
+    # CAP_PROP_FRAME_COUNT is only an estimate, drop the slots that were never filled
+    return torch.from_numpy(buf[:fc])
+
+def collate_dialogues(batch):
+    """
+    DataLoader collate_fn for batches of several dialogues. Every per-utterance
+    list holds the utterances of all dialogues back to back, in the layout the
+    default collate gives for a batch of a single dialogue, and the inputs get
+    a fifth entry with the number of utterances of each dialogue:
+
+        ([transcripts], [video], [audio], speakers, dialogue_lengths) ([emotion_id], [sentiment_id])
+
+    Speaker ids stay relative to their dialogue.
+    """
+    transcripts = []
+    video = []
+    audio = []
+    speakers = []
+    emotions = []
+    sentiments = []
+    for item in batch:
+        (dialogue_transcripts, dialogue_video, dialogue_audio, dialogue_speakers), (dialogue_emotions, dialogue_sentiments) = default_collate([item])
+        transcripts += dialogue_transcripts
+        video += dialogue_video
+        audio += dialogue_audio
+        speakers.append(dialogue_speakers)
+        emotions += dialogue_emotions
+        sentiments += dialogue_sentiments
+    dialogue_lengths = torch.LongTensor([speaker.size(1) for speaker in speakers])
+    return (transcripts, video, audio, torch.cat(speakers, dim=1), dialogue_lengths), (emotions, sentiments)
+
+
+def init_loader_worker(face_device, worker_id):
+    """
+    worker_init_fn of the DataLoaders. Nothing in this module builds a model at
+    import, so each worker builds its own face models on first use, on
+    face_device, and keeps to one CPU thread so the workers don't oversubscribe
+    the cores the training process uses.
+    """
+    torch.set_num_threads(1)
+    set_face_model_device(face_device)
+
+def get_data_loader(dataset, config, shuffle=True):
+    """
+    Returns a DataLoader of batches of config.batch_size dialogues, loaded by
+    config.num_workers worker processes and collated into pinned memory when
+    training on cuda
+    """
+    options = {}
+    if config.num_workers > 0:
+        options = {'prefetch_factor': config.prefetch_factor, 'persistent_workers': True,
+                   'worker_init_fn': functools.partial(init_loader_worker, config.loader_face_device)}
+    return DataLoader(dataset, batch_size=config.batch_size, shuffle=shuffle, collate_fn=collate_dialogues,
+                      num_workers=config.num_workers,
+                      pin_memory=config.pin_memory and torch.device(config.device).type == 'cuda', **options)
+
+
+class DevicePrefetcher(object):
+    """
+    Wraps a DataLoader and copies the floating point inputs of the next batch
+    (audio, face and cached text features) to the device on a side CUDA stream
+    while the current batch runs, so the copies overlap with compute. Token
+    ids, speakers and labels stay where the DataLoader put them. On the cpu,
+    batches are passed through unchanged.
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        batches = iter(self.loader)
+        next_batch = self.preload(batches)
+        while next_batch is not None:
+            batch, copied = next_batch
+            if self.stream is not None:
+                torch.cuda.current_stream(self.device).wait_stream(self.stream)
+                # the copies were allocated on the side stream but are used on this one
+                for tensor in copied:
+                    tensor.record_stream(torch.cuda.current_stream(self.device))
+            next_batch = self.preload(batches)
+            yield batch
+
+    def preload(self, batches):
+        try:
+            inputs, labels = next(batches)
+        except StopIteration:
+            return None
+        if self.stream is None:
+            return (inputs, labels), []
+        copied = []
+        with torch.cuda.stream(self.stream):
+            inputs = self.to_device(inputs, copied)
+        return (inputs, labels), copied
+
+    def to_device(self, data, copied):
+        if isinstance(data, torch.Tensor):
+            if not data.is_floating_point():
+                return data
+            data = data.to(self.device, non_blocking=True)
+            copied.append(data)
+            return data
+        if isinstance(data, (list, tuple)):
+            return type(data)(self.to_device(item, copied) for item in data)
+        return data
+
+
 
 class Dialogue(object):
     """
     Class for representing a dialogue as a list of utterances
     """
-    def __init__(self, id, utterances, visual_features=False):
+    def __init__(self, id, utterances, visual_features=False, text_features=False, token_ids=False):
         self.dialogue_id = id
         self.utterances = utterances
         self.visual_features = visual_features
+        self.text_features = text_features
+        self.token_ids = token_ids
         self.reparameterize_speakers()
 
     def reparameterize_speakers(self):
@@ -68,8 +336,14 @@ class Dialogue(object):
 
     def get_transcripts(self):
         """
-        Method returns a list of text transcripts for each utterance
+        Method returns a list of text transcripts for each utterance, or of
+        their cached BERT hidden states if self.text_features is true, or of
+        their cached token ids if self.token_ids is true
         """
+        if self.text_features:
+            return [utterance.get_text_features() for utterance in self.utterances]
+        if self.token_ids:
+            return [utterance.get_token_ids() for utterance in self.utterances]
         return [utterance.get_transcript() for utterance in self.utterances]
 
     def get_videos(self):
@@ -87,6 +361,33 @@ class Dialogue(object):
         features = [utterance.get_cached_visual_features() for utterance in self.utterances]
         return features
 
+    def build_cached_visual_features(self, max_persons=7, output_size=224, sampling_rate=30, frame_batch_size=32,
+                                     keyframe_interval=None):
+        """
+        Method builds the visual cache of every utterance in the dialogue whose
+        features are not cached yet. Face detection runs over the frames of all
+        those utterances together, `frame_batch_size` frames at a time, and
+        tracks faces between keyframes when `keyframe_interval` is set.
+        Returns the number of utterances that were built.
+        """
+        store = get_visual_store(max_persons, output_size, sampling_rate)
+        pending = []
+        for utterance in self.utterances:
+            if store is not None and utterance.get_visual_cache_key() in store:
+                continue
+            if not os.path.exists(utterance.get_visual_cache_path(max_persons, output_size, sampling_rate)):
+                pending.append(utterance)
+
+        videos = [utterance.load_video(sampling_rate) for utterance in pending]
+        faces = detect_video_faces(videos, frame_batch_size, keyframe_interval)
+        keys = [utterance.get_face_embedding_key(output_size, sampling_rate, keyframe_interval) for utterance in pending]
+        embeddings = get_face_embedder().embed_videos(faces, keys)
+        for utterance, video, faces_vector, face_embeddings in zip(pending, videos, faces, embeddings):
+            face_vector = utterance.get_face_frames(video, max_persons, output_size, faces_vector=faces_vector,
+                                                    face_embeddings=face_embeddings)
+            utterance.save_visual_features(face_vector, max_persons, output_size, sampling_rate)
+        return len(pending)
+
     def get_audios(self):
         """
         Method returns a list of audio embeddings for each utterance
@@ -183,30 +484,33 @@ class Utterance(object):
         #print(self.emotion)
         return (self.emotion, self.sentiment)
 
-    def load_video(self):
+    def load_video(self, sampling_rate=30):
         """
-        Loads the video into memory and converts the frames into a pyTorch tensor
+        Loads every `sampling_rate`-th frame of the video into memory as a pyTorch tensor
         """
         #print(self.file_path)
-        return video_to_tensor(self.file_path)
+        return video_to_tensor(self.file_path, sampling_rate)
 
-    def get_face_frames(self, video_tensor, max_persons=7, output_size=224):
+    def get_face_frames(self, video_tensor, max_persons=7, output_size=224, faces_vector=None, frame_batch_size=32,
+                        keyframe_interval=None, face_embeddings=None, embedding_key=None):
+        """
+        Detects the faces in every frame of the video and aligns them so that
+        the same person stays in the same slot across frames. `faces_vector`
+        and `face_embeddings` can be passed when detection and embedding
+        already ran, eg. batched over a whole dialogue with detect_video_faces
+        and FaceEmbedder.embed_videos. The face embeddings are memoized under
+        `embedding_key` when given, see get_face_embedding_key.
+        """
 
         threshold = 1.25
 
         #mtcnn = MTCNN(image_size=output_size, margin=0, keep_all=True).to("cuda")
 
-        # Compiling sampling and pass into MTCNN
-
-        image_converter = ToPILImage()
-
         #print("number of frames: {}".format(video_tensor.shape[0]))
         #mtcnn_model = MTCNN(image_size=224, margin=0, keep_all=True).to("cuda")
         #facenet_model = InceptionResnetV1(pretrained='vggface2').eval().to("cuda")
-        video = []
-        for image in video_tensor:
-            video.append(image_converter(image.permute(2, 0, 1)))
-        faces_vector = mtcnn_model(video)
+        if faces_vector is None:
+            faces_vector = detect_video_faces([video_tensor], frame_batch_size, keyframe_interval)[0]
 
         if len(faces_vector) == 0:
             #print("BIG WHOOPSIES")
@@ -214,57 +518,24 @@ class Utterance(object):
 
         #resnet = InceptionResnetV1(pretrained='vggface2').eval().to("cuda")
 
-        embedding_vector = []
-        for frame in faces_vector:
-            if type(frame) == torch.Tensor:
-                embedding_vector.append(facenet_model(frame.to("cuda")))
-            else:
-                embedding_vector.append(torch.zeros(1, 512).to("cuda"))
+        # (F x K x 512) embeddings, every frame padded to the largest number of faces
+        if face_embeddings is None:
+            face_embeddings = get_face_embedder().embed_frames(faces_vector, embedding_key)
+        embeddings, num_faces = face_embeddings
 
         #padded_embedding = torch.zeros(max_persons, 3, output_size, outputsize)
         #padded_embedding[:embedding_vector[0].size] = embedding_vector[0]
 
-        aligned_embeddings = torch.zeros(len(faces_vector), max_persons, 512)
-        alignment_indices = torch.zeros(len(faces_vector), max_persons)
-        
-        # aligned_embeddings is (F x N x 512)
-        new_face_index = 0
-
-        for i, embedding in enumerate(embedding_vector):
-            # embedding is (F x 512)
-            embedding = embedding.to("cpu")
-            distances = torch.sum(((embedding.unsqueeze(1).unsqueeze(1) - aligned_embeddings.unsqueeze(0)) ** 2), dim=3)
-            # distances is (F x F x N)
-            distances = torch.mean(distances, dim=1)
-            # distances is (F x F)
-            indices = torch.zeros(max_persons)
-            for j, distance in enumerate(distances):
-                #distances 
-                min_dist, arg_min = torch.min(distance, dim=0)
-                if min_dist < threshold and indices[arg_min] < 1:
-                    indices[arg_min] = j + 1
-                    alignment_indices[i, arg_min] = j + 1
-                else:
-                    new_face_index += 1 
-                    if new_face_index < max_persons:
-                        indices[new_face_index] = j + 1
-                        alignment_indices[i, new_face_index] = j + 1
-
-            padded_embedding = torch.cat([torch.zeros(1, 512), embedding], dim=0)
-            aligned_embedding = torch.index_select(padded_embedding, 0, indices.long())
-            aligned_embeddings[i, : aligned_embedding.shape[0]] =  aligned_embedding
-
-
-        aligned_faces = []
-        for i, faces in enumerate(faces_vector):
-            if type(faces) == torch.Tensor:
-                padding = torch.zeros(1, 3, output_size, output_size)
-                padded_faces = torch.cat([padding, faces], dim=0)
-                aligned_faces.append(torch.index_select(padded_faces, 0, alignment_indices[i].long()).unsqueeze(0))
-            else:
-                aligned_faces.append(torch.zeros(1, 7, 3, output_size, output_size))
+        # alignment_indices is (F x N), the index + 1 of the face in each slot
+        alignment_indices = align_face_identities(embeddings, num_faces, max_persons, threshold).cpu()
 
-        aligned_faces = torch.cat(aligned_faces, dim=0)
+        # gather every slot of every frame at once from the faces of the video,
+        # with a leading zero face for the empty slots
+        faces = [faces for faces in faces_vector if type(faces) == torch.Tensor]
+        padded_faces = torch.cat([torch.zeros(1, 3, output_size, output_size)] + faces, dim=0)
+        offsets = torch.cumsum(torch.tensor([0] + num_faces[:-1]), dim=0).unsqueeze(1)
+        face_indices = torch.where(alignment_indices > 0, alignment_indices + offsets, 0)
+        aligned_faces = padded_faces[face_indices]
         #print(aligned_faces.shape)
 
         """
@@ -285,24 +556,95 @@ class Utterance(object):
 
         return aligned_faces.detach()
 
+    def get_visual_cache_key(self):
+        """
+        Returns the key of the utterance in the visual cache
+        """
+        return self.get_cache_key()
+
+    def get_face_embedding_key(self, output_size=224, sampling_rate=30, keyframe_interval=None):
+        """
+        Returns the key of the face embeddings of the utterance in the
+        FaceEmbedder memo, the detected crops depend on the sampling settings
+        """
+        return (self.get_visual_cache_key(), output_size, sampling_rate, keyframe_interval)
+
+    def get_cache_key(self):
+        """
+        Returns the key of the utterance in the feature caches
+        """
+        return self.name + '_dia_{}_utt_{}'.format(self.dialogue_id, self.utterance_id)
+
+    def get_text_features(self):
+        """
+        Returns the (tokens x 768) BERT hidden states of the transcript from
+        the text cache
+        """
+        store = get_text_store()
+        text_key = get_transcript_key(self.get_cache_key(), self.transcript)
+        if store is None or text_key not in store:
+            raise Exception("No cached BERT hidden states for dialogue: {}, utterance: {} ({}), run build_text_cache.py".format(
+                self.dialogue_id, self.utterance_id, self.name))
+        return torch.from_numpy(store.get(text_key))
+
+    def get_token_ids(self):
+        """
+        Returns the int32 bert-base-uncased token ids of the transcript from the
+        token cache
+        """
+        store = get_token_store()
+        token_key = get_transcript_key(self.get_cache_key(), self.transcript)
+        if store is None or token_key not in store:
+            raise Exception("No cached token ids for dialogue: {}, utterance: {} ({})".format(
+                self.dialogue_id, self.utterance_id, self.name))
+        return torch.from_numpy(store.get(token_key))
+
+    def get_visual_cache_path(self, max_persons=7, output_size=224, sampling_rate=30):
+        """
+        Returns the path of the cached face tensor for the given visual settings
+        """
+        setting_path = get_visual_setting_path(max_persons, output_size, sampling_rate)
+        return os.path.join(setting_path, self.get_visual_cache_key() + '.pth')
+
+    def build_cached_visual_features(self, max_persons=7, output_size=224, sampling_rate=30, frame_batch_size=32,
+                                     keyframe_interval=None):
+        """
+        Runs face detection on the video and writes the resulting face tensor to
+        the cache
+        """
+        video_tensor = self.load_video(sampling_rate)
+        face_vector = self.get_face_frames(video_tensor, max_persons, output_size, frame_batch_size=frame_batch_size,
+                                           keyframe_interval=keyframe_interval,
+                                           embedding_key=self.get_face_embedding_key(output_size, sampling_rate, keyframe_interval))
+        self.save_visual_features(face_vector, max_persons, output_size, sampling_rate)
+        return face_vector
+
+    def save_visual_features(self, face_vector, max_persons=7, output_size=224, sampling_rate=30):
+        """
+        Writes the face tensor to the cache. The tensor is saved to a temporary
+        file first and then moved into place, so an interrupted run never leaves
+        a truncated cache entry.
+        """
+        file_path = self.get_visual_cache_path(max_persons, output_size, sampling_rate)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(file_path, os.getpid())
+        torch.save(face_vector, tmp_path)
+        os.replace(tmp_path, file_path)
+
     def get_cached_visual_features(self, max_persons=7, output_size=224, sampling_rate=30, display_images=False):
 
         #video_tensor = self.load_video()
         #face_vector = detect_faces_mtcnn(video_tensor.to("cpu"), max_persons, output_size, 1, display_images)
         #face_vector = self.get_face_frames(video_tensor, max_persons, output_size)
 
-        cache_path = './cache'
-        setting_path = os.path.join(cache_path, 'persons_{}_rate_{}_size_{}'.format(max_persons, sampling_rate, output_size))
-        file_path = os.path.join(setting_path, self.name + '_dia_{}_utt_{}.pth'.format(self.dialogue_id, self.utterance_id))
-        if not os.path.exists(cache_path):
-            os.mkdir(cache_path)
-        if not os.path.exists(setting_path):
-            os.mkdir(setting_path)
+        store = get_visual_store(max_persons, output_size, sampling_rate)
+        if store is not None and self.get_visual_cache_key() in store:
+            return torch.from_numpy(store.get(self.get_visual_cache_key()))
+
+        file_path = self.get_visual_cache_path(max_persons, output_size, sampling_rate)
         if not os.path.exists(file_path):
             print("No cached features found, generating new features for dialogue: {}, utterance: {} ({}, {}, {})".format(self.dialogue_id, self.utterance_id, max_persons, sampling_rate, output_size))
-            video_tensor = self.load_video()
-            face_vector = self.get_face_frames(video_tensor, max_persons, output_size)
-            torch.save(face_vector, file_path)
+            return self.build_cached_visual_features(max_persons, output_size, sampling_rate)
         else:
             print("Retrieved cached visual features for dialogue: {}, utterance: {} ({}, {}, {})".format(self.dialogue_id, self.utterance_id, max_persons, sampling_rate, output_size))
         #print(torch.load(file_path))
@@ -315,6 +657,150 @@ class Utterance(object):
         return self.utt_audio
 
 
+# (csv file, video directory) of each MELD split, relative to the MELD.Raw root
+MELD_SPLITS = {
+    "train": ("train_sent_emo.csv", "train_splits"),
+    "val": ("dev_sent_emo.csv", "dev_splits_complete"),
+    "test": ("test_sent_emo.csv", "output_repeated_splits_test"),
+}
+
+# features of the utterances missing from our audio features, shared by all of them
+MISSING_AUDIO_FIXED = np.zeros(6373, dtype=np.float32)
+MISSING_AUDIO_TEMPORAL = np.zeros((1, 142), dtype=np.float32)
+
+
+def get_audio_store_path(pickle_path, split=None):
+    """
+    Returns the path of the store convert_audio_features.py writes for an
+    audio feature pickle, or for one split of a pickle holding several
+    """
+    name = os.path.splitext(os.path.basename(pickle_path))[0]
+    if split is not None:
+        name += '_' + split
+    return os.path.join(AUDIO_STORE_PATH, name)
+
+
+def load_audio_store(store_path, use_our_audio):
+    if use_our_audio:
+        temporal_path = store_path + '_temporal'
+        if not FeatureStore.exists(temporal_path):
+            raise Exception("{} has no temporal features at {}, convert or extract the audio features again".format(
+                store_path, temporal_path))
+        return MatrixStore(store_path), FeatureStore(temporal_path)
+    return MatrixStore(store_path)
+
+
+def load_audio_embeddings(pickle_path, use_our_audio, splits=None):
+    """
+    Returns the audio features of a pickle in the form MELDDataset takes: its
+    memory-mapped stores when convert_audio_features.py has converted it,
+    otherwise the unpickled features. For pickles holding the features of
+    several splits, eg. (train, val, test), returns a list with the features
+    of each of the given splits.
+    """
+    store_paths = [get_audio_store_path(pickle_path, split) for split in (splits or [None])]
+    if all(MatrixStore.exists(store_path) for store_path in store_paths):
+        audio_embs = [load_audio_store(store_path, use_our_audio) for store_path in store_paths]
+    else:
+        print("Unpickling {}, run convert_audio_features.py on it to load it faster".format(pickle_path))
+        with open(pickle_path, 'rb') as f:
+            audio_embs = pickle.load(f)
+        if splits is None:
+            audio_embs = [audio_embs]
+        else:
+            audio_embs = [audio_embs[list(MELD_SPLITS).index(split)] for split in splits]
+    return audio_embs if splits is not None else audio_embs[0]
+
+# ported from the mapping used for frame attention network 
+EMOTION_MAPPING = {"joy": 0, "anger": 1, "disgust": 2, "fear": 3, "sadness": 4, "neutral": 5, "surprise": 6}
+
+# bump when the layout of the columns written by build_meld_index changes
+MELD_INDEX_VERSION = 1
+
+
+def build_meld_index(csv_file, emotion_mapping):
+    """
+    Parses a MELD csv file into columns, one NumPy array per attribute with a
+    row per utterance. Rows are sorted by dialogue, in order of first
+    appearance in the csv, then by utterance id. dialogue_offsets holds the
+    first row of every dialogue plus the total number of rows (CSR layout).
+
+    Speaker and sentiment ids index the sorted speaker_names and
+    sentiment_names. dialogue_speakers are the speaker ids relative to the
+    dialogue, numbered in order of first appearance (see
+    Dialogue.reparameterize_speakers).
+    """
+    records = pd.read_csv(csv_file)
+    # Sr No., Utterance, Speaker, Emotion, Sentiment, Dialogue_ID, Utterance_ID, ...
+    transcripts = records.iloc[:, 1].to_numpy(dtype=str)
+    speaker_names, speakers = np.unique(records.iloc[:, 2].to_numpy(dtype=str), return_inverse=True)
+    emotions = records.iloc[:, 3].map(emotion_mapping).to_numpy(dtype=np.int64)
+    sentiment_names, sentiments = np.unique(records.iloc[:, 4].to_numpy(dtype=str), return_inverse=True)
+    dialogue_ids = records.iloc[:, 5].to_numpy(dtype=np.int64)
+    utterance_ids = records.iloc[:, 6].to_numpy(dtype=np.int64)
+
+    # rank of every dialogue by first appearance
+    unique_dialogues, first_rows, dialogue_ranks = np.unique(dialogue_ids, return_index=True, return_inverse=True)
+    appearance = np.empty(len(unique_dialogues), dtype=np.int64)
+    appearance[np.argsort(first_rows, kind='stable')] = np.arange(len(unique_dialogues))
+    dialogue_ranks = appearance[dialogue_ranks]
+    order = np.lexsort((utterance_ids, dialogue_ranks))
+    dialogue_ranks = dialogue_ranks[order]
+    speakers = speakers[order]
+
+    dialogue_offsets = np.searchsorted(dialogue_ranks, np.arange(len(unique_dialogues) + 1))
+
+    # number the (dialogue, speaker) pairs by their first row, then within each dialogue
+    _, pair_rows, pair_inverse = np.unique(dialogue_ranks * len(speaker_names) + speakers,
+                                           return_index=True, return_inverse=True)
+    pair_order = np.argsort(pair_rows)
+    pair_dialogues = dialogue_ranks[pair_rows[pair_order]]
+    relative_ids = np.empty(len(pair_rows), dtype=np.int64)
+    relative_ids[pair_order] = np.arange(len(pair_rows)) - np.searchsorted(pair_dialogues, pair_dialogues)
+
+    return {
+        'dialogue_offsets': dialogue_offsets.astype(np.int64),
+        'dialogue_ids': dialogue_ids[order],
+        'utterance_ids': utterance_ids[order],
+        'transcripts': transcripts[order],
+        'speakers': speakers.astype(np.int64),
+        'dialogue_speakers': relative_ids[pair_inverse.reshape(-1)],
+        'emotions': emotions[order],
+        'sentiments': sentiments[order].astype(np.int64),
+        'speaker_names': speaker_names,
+        'sentiment_names': sentiment_names,
+    }
+
+
+def get_meld_index_path(csv_file):
+    """
+    Returns the path of the saved index of a csv file, keyed by its absolute
+    path, size and modification time so an edited csv is parsed again
+    """
+    stat = os.stat(csv_file)
+    fingerprint = '{}:{}:{}:{}'.format(os.path.abspath(csv_file), stat.st_size, stat.st_mtime_ns, MELD_INDEX_VERSION)
+    name = os.path.splitext(os.path.basename(csv_file))[0]
+    return os.path.join(INDEX_CACHE_PATH, '{}_{}.npz'.format(name, hashlib.sha1(fingerprint.encode()).hexdigest()[:16]))
+
+
+def load_meld_index(csv_file, emotion_mapping):
+    """
+    Returns the columns of build_meld_index, read from the saved index of the
+    csv file when there is one and saved there otherwise
+    """
+    index_path = get_meld_index_path(csv_file)
+    if os.path.exists(index_path):
+        with np.load(index_path, allow_pickle=False) as index:
+            return {key: index[key] for key in index.files}
+    index = build_meld_index(csv_file, emotion_mapping)
+    os.makedirs(INDEX_CACHE_PATH, exist_ok=True)
+    tmp_path = '{}.{}.tmp.npz'.format(index_path[:-len('.npz')], os.getpid())
+    np.savez(tmp_path, **index)
+    os.replace(tmp_path, index_path)
+    print("Indexed {} utterances of {} into {}".format(len(index['dialogue_ids']), csv_file, index_path))
+    return index
+
+
 class MELDDataset(Dataset):
     """
     Class representing MELD dataset. Initialization is against a csv file and
@@ -329,11 +815,22 @@ class MELDDataset(Dataset):
 
         video is a list of face tensors detected by the mtcnn network
         otherwise, video is raw video tensors 
+
+    The utterances are stored column-wise (see build_meld_index): one NumPy
+    array per attribute, sorted by dialogue and utterance, with the dialogue
+    boundaries in dialogue_offsets, so that dialogue idx is the row range
+    dialogue_offsets[idx]:dialogue_offsets[idx + 1] of every column. Audio
+    features are one contiguous float32 matrix in the same row order.
     
     Attributes:
 
-    csv_recods: pandas representation of csv file
     root_dir: pah to root directory of data
+    dialogue_offsets: first row of every dialogue, plus the number of rows
+    dialogue_ids, utterance_ids, transcripts, speakers, dialogue_speakers,
+        emotions, sentiments: one entry per utterance row
+    audio: (rows x features) float32 audio features, None without audio
+    audio_rows: row of audio for every utterance row when audio is a
+        memory-mapped MatrixStore, None when audio is in row order
 
     speaker_mapping: dictionary mapping speaker name to speaker id
     emotion_mapping: dictionary mapping emotion to emotion id
@@ -346,66 +843,184 @@ class MELDDataset(Dataset):
     """
 
     def __init__(self, csv_file, root_dir, audio_embs, name, config):
-        self.csv_records = pd.read_csv(csv_file)
         self.root_dir = os.path.abspath(root_dir)
         self.name = name
+        self.config = config
 
-        speaker_set = set(self.csv_records.loc[:, "Speaker"].values.tolist())
-        emotion_set = set(self.csv_records.loc[:, "Emotion"].values.tolist())
-        sentiment_set = set(self.csv_records.loc[:, "Sentiment"].values.tolist())
+        self.emotion_mapping = dict(EMOTION_MAPPING)
+        print(self.emotion_mapping)
 
+        index = load_meld_index(csv_file, self.emotion_mapping)
         # TODO: we have combination mappings right now (eg. "Monica and Rachael")
-        self.speaker_mapping = {speaker: id for id, speaker in enumerate(speaker_set)}
-        #self.emotion_mapping = {emotion: id for id, emotion in enumerate(emotion_set)}
+        self.speaker_mapping = {speaker: id for id, speaker in enumerate(index['speaker_names'])}
+        self.sentiment_mapping = {sentiment: id for id, sentiment in enumerate(index['sentiment_names'])}
+        self.dialogue_offsets = index['dialogue_offsets']
+        self.dialogue_ids = index['dialogue_ids']
+        self.utterance_ids = index['utterance_ids']
+        self.transcripts = index['transcripts']
+        self.speakers = index['speakers']
+        self.dialogue_speakers = index['dialogue_speakers']
+        self.emotions = index['emotions']
+        self.sentiments = index['sentiments']
+
+        self.audio = None
+        self.audio_rows = None
+        self.audio_temporal = None
+        if audio_embs is not None:
+            self.load_audio_features(audio_embs, config.use_our_audio)
+
+        self.token_ids = config.use_texts and config.use_token_cache and not config.use_text_cache
+        if self.token_ids:
+            token_keys = build_token_cache(self.get_cache_keys(), self.transcripts)
+            store = get_token_store()
+            token_ids = [store.get(key) for key in token_keys]
+            self.token_offsets = np.concatenate([[0], np.cumsum([len(ids) for ids in token_ids])]).astype(np.int64)
+            self.token_values = np.concatenate(token_ids).astype(np.int32)
+
+        # Dialogue objects, built on first use of self.data
+        self.dialogues = None
+
+    def load_audio_features(self, audio_embs, use_our_audio):
+        """
+        Looks up the audio features of every utterance, in row order.
+
+        audio_embs is either a MatrixStore, or for our audio a (MatrixStore,
+        FeatureStore) pair of fixed and temporal features (see
+        load_audio_embeddings), in which case the store stays memory-mapped and
+        only the row of each utterance is recorded; or the unpickled features
+        keyed by "<dialogue_id>_<utterance_id>", which are gathered into one
+        contiguous float32 matrix. The temporal features of our audio vary in
+        length and are kept as one array per utterance. Without temporal
+        features (None), every utterance counts as missing our audio.
+        """
+        fixed_embs, temporal_embs = audio_embs if use_our_audio else (audio_embs, None)
+        keys = ["{}_{}".format(d_id, u_id) for d_id, u_id in zip(self.dialogue_ids, self.utterance_ids)]
+        if isinstance(fixed_embs, MatrixStore):
+            self.audio = fixed_embs.data
+            self.audio_rows = fixed_embs.rows(self.dialogue_ids, self.utterance_ids)
+            has_audio = self.audio_rows != 0
+        else:
+            has_audio = np.array([key in fixed_embs for key in keys], dtype=bool)
+        if use_our_audio:
+            # an utterance only has our audio features when both halves exist
+            has_audio &= np.array([temporal_embs is not None and key in temporal_embs for key in keys], dtype=bool)
+        if use_our_audio:
+            self.audio_temporal = [np.asarray(temporal_embs.get(key), dtype=np.float32) if present else MISSING_AUDIO_TEMPORAL
+                                   for key, present in zip(keys, has_audio)]
+        if isinstance(fixed_embs, MatrixStore):
+            self.audio_rows[~has_audio] = 0
+            print("{} of {} utterances of {} have no audio features".format(np.sum(~has_audio), len(keys), self.name))
+        elif use_our_audio:
+            self.audio = np.stack([np.asarray(fixed_embs[key], dtype=np.float32).reshape(-1) if present else MISSING_AUDIO_FIXED
+                                   for key, present in zip(keys, has_audio)])
+        else:
+            self.audio = np.stack([np.asarray(fixed_embs[key], dtype=np.float32).reshape(-1) for key in keys])
 
-        # ported from the mapping used for frame attention network 
-        self.emotion_mapping = {"joy": 0, "anger": 1, "disgust": 2, "fear": 3, "sadness": 4, "neutral": 5, "surprise": 6}
-        print(self.emotion_mapping)
-        self.sentiment_mapping = {sentiment: id for id, sentiment in enumerate(sentiment_set)}
-
-        dialogues = {}
-        for record in self.csv_records.loc[:].values:
-            id, transcript, speaker, emotion, sentiment, d_id, u_id, _, _, _, _ = record
-
-            if d_id not in dialogues.keys():
-                dialogues[d_id] = []
-            file_path = "dia{}_utt{}.mp4".format(d_id, u_id)
-            file_path = os.path.join(self.root_dir, file_path)
-            utt_audio_embed_id = str(d_id) + "_" + str(u_id)
-            if config.use_our_audio:
-                try:
-                    audio_embs_fixed, audio_embs_temporal = audio_embs
-                    utt_audio_embed = (audio_embs_fixed[utt_audio_embed_id], audio_embs_temporal[utt_audio_embed_id])
-                except KeyError:
-                    utt_audio_embed = (np.zeros((1, 6373)), np.zeros((1, 142)))
-            else:
-                utt_audio_embed = audio_embs[utt_audio_embed_id]
-                
-            utterance = Utterance(
+    def get_audio_matrix(self, start=0, end=None):
+        """
+        Returns the audio features of rows start:end as a (rows x features)
+        array, a view when the features are already in row order
+        """
+        if self.audio_rows is None:
+            return self.audio[start:end]
+        return self.audio[self.audio_rows[start:end]]
+
+    def get_cache_keys(self, start=0, end=None):
+        """
+        Returns the feature cache keys (see Utterance.get_cache_key) of the rows
+        """
+        end = len(self.dialogue_ids) if end is None else end
+        return [self.name + '_dia_{}_utt_{}'.format(d_id, u_id)
+                for d_id, u_id in zip(self.dialogue_ids[start:end], self.utterance_ids[start:end])]
+
+    def get_video_path(self, dialogue_id, utterance_id):
+        return os.path.join(self.root_dir, "dia{}_utt{}.mp4".format(dialogue_id, utterance_id))
+
+    def get_transcript_keys(self, start=0, end=None):
+        """
+        Returns the token and text store keys (see get_transcript_key) of the
+        transcripts of rows start:end
+        """
+        end = len(self.dialogue_ids) if end is None else end
+        return [get_transcript_key(key, transcript)
+                for key, transcript in zip(self.get_cache_keys(start, end), self.transcripts[start:end])]
+
+    def get_dialogue(self, idx):
+        """
+        Returns dialogue idx as a Dialogue of Utterance objects
+        """
+        start, end = self.dialogue_offsets[idx], self.dialogue_offsets[idx + 1]
+        utterances = []
+        for row in range(start, end):
+            d_id, u_id = int(self.dialogue_ids[row]), int(self.utterance_ids[row])
+            utterances.append(Utterance(
                 d_id,
                 u_id,
-                transcript,
-                self.speaker_mapping[speaker],
-                self.emotion_mapping[emotion],
-                self.sentiment_mapping[sentiment],
-                file_path,
-                utt_audio_embed,
+                str(self.transcripts[row]),
+                int(self.speakers[row]),
+                int(self.emotions[row]),
+                int(self.sentiments[row]),
+                self.get_video_path(d_id, u_id),
+                self.get_audio(row, row + 1)[0] if self.audio is not None else None,
                 self.name
-            )
-            dialogues[d_id].append(utterance)
+            ))
+        return Dialogue(int(self.dialogue_ids[start]), utterances, visual_features=self.config.visual_features,
+                        text_features=self.config.use_text_cache, token_ids=self.token_ids)
 
-        self.data = []
-        for d_id, utterances in dialogues.items():
-            # Assumes no gaps in dialogue id
-            # Assumes no gaps in utterance ids            
-            utteraences = utterances.sort(key=lambda x: x.utterance_id)
-            self.data.append(Dialogue(d_id, utterances, visual_features=config.visual_features))
+    @property
+    def data(self):
+        """
+        List of all dialogues as Dialogue objects, for code working on utterances
+        """
+        if self.dialogues is None:
+            self.dialogues = [self.get_dialogue(idx) for idx in range(len(self))]
+        return self.dialogues
+
+    def get_audio(self, start, end):
+        """
+        Returns the audio features of rows start:end, one view into the audio
+        matrix per utterance
+        """
+        features = torch.from_numpy(self.get_audio_matrix(start, end))
+        if self.audio_temporal is not None:
+            return [(features[i], torch.from_numpy(self.audio_temporal[row])) for i, row in enumerate(range(start, end))]
+        return list(features)
+
+    def get_transcripts(self, start, end):
+        if self.config.use_text_cache:
+            store = get_text_store()
+            text_keys = self.get_transcript_keys(start, end)
+            for row, key in zip(range(start, end), text_keys):
+                if store is None or key not in store:
+                    raise Exception("No cached BERT hidden states for dialogue: {}, utterance: {} ({}), run build_text_cache.py".format(
+                        self.dialogue_ids[row], self.utterance_ids[row], self.name))
+            return [torch.from_numpy(store.get(key)) for key in text_keys]
+        if self.token_ids:
+            offsets = self.token_offsets[start:end + 1]
+            return [torch.from_numpy(self.token_values[offsets[i]:offsets[i + 1]]) for i in range(end - start)]
+        return self.transcripts[start:end].tolist()
 
     def __len__(self):
-        return len(self.data)
+        return len(self.dialogue_offsets) - 1
 
     def __getitem__(self, idx):
-        return self.data[idx].get_data()
+        start, end = self.dialogue_offsets[idx], self.dialogue_offsets[idx + 1]
+        transcripts = self.get_transcripts(start, end)
+        if self.config.visual_features:
+            video = self.get_dialogue(idx).get_visual_features()
+        elif self.config.use_visual:
+            video = [video_to_tensor(self.get_video_path(d_id, u_id))
+                     for d_id, u_id in zip(self.dialogue_ids[start:end], self.utterance_ids[start:end])]
+        else:
+            # the clips are only decoded for models that look at them
+            video = [torch.zeros(0) for _ in range(start, end)]
+        if self.audio is not None:
+            audio = self.get_audio(start, end)
+        else:
+            audio = [None] * (end - start)
+        speakers = torch.from_numpy(self.dialogue_speakers[start:end])
+        labels = (self.emotions[start:end].tolist(), self.sentiments[start:end].tolist())
+        return (transcripts, video, audio, speakers), labels
 
     def load_sample_transcript(self, idx):
         return self.data[idx].get_transcript()
@@ -416,66 +1031,82 @@ class MELDDataset(Dataset):
     def load_sample_video(self, idx):
         return self.data[idx].load_video()
     
+    def get_audio_fingerprint(self, use_our_audio):
+        """
+        Returns a hash of the audio features and of the transform fitted on
+        them, which identifies the statistics find_audio_stats would return
+        """
+        num_rows = len(self.dialogue_ids)
+        digest = hashlib.sha1('{}:{}:{}'.format((num_rows, self.audio.shape[1]), self.audio.dtype, use_our_audio).encode())
+        # hash a few thousand rows at a time to avoid copying the whole matrix
+        for start in range(0, num_rows, 4096):
+            digest.update(np.ascontiguousarray(self.get_audio_matrix(start, start + 4096)).data)
+        return digest.hexdigest()
+
+    def get_audio_stats(self, use_our_audio):
+        """
+        Returns the audio statistics of find_audio_stats, read from the audio
+        params cache when they were fitted on the same features before and
+        saved there otherwise
+        """
+        params_path = os.path.join(AUDIO_PARAMS_CACHE_PATH, '{}_{}.pkl'.format(
+            self.name, self.get_audio_fingerprint(use_our_audio)[:16]))
+        if os.path.exists(params_path):
+            print("Loaded audio statistics from", params_path)
+            with open(params_path, 'rb') as f:
+                return pickle.load(f)
+        params = self.find_audio_stats(use_our_audio)
+        os.makedirs(AUDIO_PARAMS_CACHE_PATH, exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(params_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(params, f)
+        os.replace(tmp_path, params_path)
+        return params
+
     def find_audio_stats(self, use_our_audio):
+        """
+        Fits the standardisation (and the PCA for our audio) on the audio
+        matrix in one pass each, in float32
+        """
         print("=== Constructing train dataset audio statistics ===")
-        audio_fixed_acc = []
-        #audio_temp_acc = []
-        for dialogue in self.data:
-            for utterance in dialogue.utterances:
-                if use_our_audio:
-                    curr_audio, curr_temp = utterance.load_audio()[0], utterance.load_audio()[1]
-                else:
-                    curr_audio = utterance.load_audio()
-                audio_fixed_acc.append(curr_audio.reshape(1, -1))
-                #audio_temp_acc.append(torch.FloatTensor(curr_temp))
-        audio_fixed_feats = np.concatenate(audio_fixed_acc, axis=0)
+        audio_fixed_feats = self.get_audio_matrix()
         print("FIXED", audio_fixed_feats.shape)
         
         scaler = StandardScaler()
         audio_fixed_feats = scaler.fit_transform(audio_fixed_feats)
         if use_our_audio:
-            pca = PCA(n_components=400, svd_solver='full')
+            # 400 components for the 6373 openSMILE features, fewer for smaller feature sets
+            pca = PCA(n_components=min(400, *audio_fixed_feats.shape), svd_solver='full')
             reduced = pca.fit_transform(audio_fixed_feats)
             print(np.isnan(reduced).any())
             print(pca.components_.shape, reduced.shape)
             print(np.sum(pca.explained_variance_ratio_), pca.explained_variance_ratio_[:30])
-            #audio_temp_feats = torch.cat(audio_temp_acc, dim=0)
-            #means_temp = torch.mean(audio_temp_feats, dim=0)
-            #sds_temp = torch.std(audio_temp_feats, dim=0)
             print("=== Finished audio statistics ===")
-            return scaler, pca# means_temp, sds_temp
+            return scaler, pca
         return scaler
     
+    @staticmethod
+    def get_audio_dim(params, use_our_audio):
+        """
+        Returns the number of audio features apply_audio_transform produces
+        with the given statistics, the audio_in_dim of the model
+        """
+        if use_our_audio:
+            return params[1].n_components_
+        return params.n_features_in_
+
     def apply_audio_transform(self, params, use_our_audio):
         print("Applying audio feature transforms to ", self.name)
         if use_our_audio:
-            scaler, pca = params #means_temp, sds_temp = params
-            for i, dialogue in enumerate(self.data):
-                if (i % 100 == 0):
-                    print(i)
-                for j, utterance in enumerate(dialogue.utterances):
-                    curr_audio, temp = utterance.load_audio()[0], torch.FloatTensor(utterance.load_audio()[1])
-                    curr_audio = scaler.transform(curr_audio)
-                    curr_audio = pca.transform(curr_audio)
-                    #temp -= means_temp
-                    #temp /= sds_temp
-                    utterance.utt_audio = (torch.FloatTensor(curr_audio).squeeze(0), temp)
-                    dialogue.utterances[j] = utterance
-                self.data[i] = dialogue
+            scaler, pca = params
+            self.audio = np.ascontiguousarray(pca.transform(scaler.transform(self.get_audio_matrix())), dtype=np.float32)
         else:
-            scaler = params #means_temp, sds_temp = params
-            for i, dialogue in enumerate(self.data):
-                if (i % 100 == 0):
-                    print(i)
-                for j, utterance in enumerate(dialogue.utterances):
-                    curr_audio = utterance.load_audio().reshape(1, -1)
-                    curr_audio = scaler.transform(curr_audio)
-                    #temp -= means_temp
-                    #temp /= sds_temp
-                    utterance.utt_audio = torch.FloatTensor(curr_audio).squeeze(0)
-                    dialogue.utterances[j] = utterance
-                self.data[i] = dialogue
-            
+            scaler = params
+            self.audio = np.ascontiguousarray(scaler.transform(self.get_audio_matrix()), dtype=np.float32)
+        # the transformed features are in memory and in row order
+        self.audio_rows = None
+        # the Dialogue objects hold views of the old features
+        self.dialogues = None
         print("Applied audio feature transform to ", self.name)
         
     """
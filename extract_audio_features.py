@@ -0,0 +1,131 @@
+"""
+Extracts acoustic features from the audio track of every MELD clip.
+
+The clips of the requested splits are found like MELDDataset finds them
+(<video dir>/dia<dialogue>_utt<utterance>.mp4) and spread over a pool of
+worker processes. Each worker decodes the audio of a clip to in-memory PCM
+with ffmpeg and computes frame-level features (log mel energies, log energy,
+zero-crossing rate and spectral centroid every 10ms) and a pooled, fixed-size
+summary of them (see models.audio_features).
+
+Per split, the pooled features are written to a MatrixStore at
+dataset.get_audio_store_path("<name>.pkl", split) and the frame-level
+features to a FeatureStore next to it with a _temporal suffix, the layout
+convert_audio_features.py writes for our audio. Set
+config.audio_features_name to <name> to train main.py on them; the PCA and
+config.audio_in_dim follow the number of pooled features.
+
+The new clips are appended to the stores every --flush-every clips and clips
+already in the store are skipped, so the command can be interrupted and re-run, and only
+new clips are processed when a corpus grows.
+
+Example:
+    python -u extract_audio_features.py --data-root ../MELD.Raw --workers 16
+"""
+import argparse
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from feature_store import FeatureStoreWriter, MatrixStore, MatrixStoreWriter
+from models.audio_features import extract_audio_features
+
+
+def extract_clip(task):
+    split, dialogue_id, utterance_id, file_path, sample_rate, n_mels = task
+    try:
+        pooled, frames = extract_audio_features(file_path, sample_rate, n_mels)
+    except Exception as e:
+        print(e)
+        return split, dialogue_id, utterance_id, None, None
+    return split, dialogue_id, utterance_id, pooled, frames
+
+
+def collect_tasks(data_root, splits, store_paths, sample_rate, n_mels):
+    """
+    Returns one task per clip of the given splits that exists and is not in
+    the split's store yet, and the total number of utterances
+    """
+    from dataset import EMOTION_MAPPING, MELD_SPLITS, load_meld_index
+
+    tasks = []
+    total = 0
+    for split in splits:
+        csv_file, video_dir = MELD_SPLITS[split]
+        index = load_meld_index(os.path.join(data_root, csv_file), EMOTION_MAPPING)
+        store_path = store_paths[split]
+        store = MatrixStore(store_path) if MatrixStore.exists(store_path) else None
+        done = np.zeros(len(index['dialogue_ids']), dtype=bool)
+        if store is not None:
+            done = store.rows(index['dialogue_ids'], index['utterance_ids']) != 0
+        total += len(done)
+        for dialogue_id, utterance_id in zip(index['dialogue_ids'][~done], index['utterance_ids'][~done]):
+            file_path = os.path.join(data_root, video_dir, "dia{}_utt{}.mp4".format(dialogue_id, utterance_id))
+            if not os.path.exists(file_path):
+                print("Missing clip", file_path)
+                continue
+            tasks.append((split, int(dialogue_id), int(utterance_id), file_path, sample_rate, n_mels))
+    return tasks, total
+
+
+def write_stores(store_path, results):
+    """
+    Appends the new (dialogue id, utterance id, pooled, frames) results to the
+    stores of a split, creating them on the first flush
+    """
+    # the frame-level store first, so the pooled store never lists clips it lacks
+    with FeatureStoreWriter(store_path + '_temporal', 'float32', append=True) as writer:
+        for dialogue_id, utterance_id, _, frames in results:
+            writer.add("{}_{}".format(dialogue_id, utterance_id), frames)
+    with MatrixStoreWriter(store_path, 'float32', append=True) as writer:
+        for dialogue_id, utterance_id, pooled, _ in results:
+            writer.add(dialogue_id, utterance_id, pooled)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract acoustic features from the MELD clips")
+    parser.add_argument("--data-root", default="../MELD.Raw")
+    parser.add_argument("--splits", nargs="+", default=["train", "val", "test"], choices=["train", "val", "test"])
+    parser.add_argument("--name", default="acoustic", help="the stores are named like the pickle <name>.pkl")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--sample-rate", type=int, default=16000)
+    parser.add_argument("--n-mels", type=int, default=40)
+    parser.add_argument("--flush-every", type=int, default=1000, help="append to the stores every n clips")
+    parser.add_argument("--log-every", type=int, default=100, help="log progress every n clips")
+    args = parser.parse_args()
+
+    from dataset import get_audio_store_path
+
+    store_paths = {split: get_audio_store_path(args.name + '.pkl', split) for split in args.splits}
+    tasks, total = collect_tasks(args.data_root, args.splits, store_paths, args.sample_rate, args.n_mels)
+    print("{} utterances, {} clips to extract with {} workers".format(total, len(tasks), args.workers))
+    if len(tasks) == 0:
+        return
+
+    start = time.time()
+    results = {split: [] for split in args.splits}
+    pending = 0
+    failed = 0
+    with multiprocessing.Pool(args.workers) as pool:
+        for i, (split, dialogue_id, utterance_id, pooled, frames) in enumerate(
+                pool.imap_unordered(extract_clip, tasks, chunksize=4), 1):
+            if pooled is None:
+                failed += 1
+            else:
+                results[split].append((dialogue_id, utterance_id, pooled, frames))
+                pending += 1
+            if pending >= args.flush_every or i == len(tasks):
+                for name, split_results in results.items():
+                    if len(split_results) > 0:
+                        write_stores(store_paths[name], split_results)
+                        split_results.clear()
+                pending = 0
+            if i % args.log_every == 0 or i == len(tasks):
+                elapsed = time.time() - start
+                print("[{}/{}] {:.1f} clips/s, {:.0f}s elapsed, {} failed".format(i, len(tasks), i / elapsed, elapsed, failed))
+
+
+if __name__ == "__main__":
+    main()
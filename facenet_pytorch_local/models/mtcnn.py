@@ -4,7 +4,7 @@ import numpy as np
 import os
 from collections.abc import Iterable
 
-from .utils.detect_face import detect_face, extract_face
+from .utils.detect_face import detect_face, extract_face, extract_face_tensor, track_face
 
 
 class PNet(nn.Module):
@@ -46,7 +46,7 @@ class PNet(nn.Module):
         a = self.conv4_1(x)
         a = self.softmax4_1(a)
         b = self.conv4_2(x)
-        return b.cpu(), a.cpu()
+        return b, a
 
 
 class RNet(nn.Module):
@@ -380,6 +380,165 @@ class MTCNN(nn.Module):
 
         return boxes, probs
 
+    def detect_tensor(self, frames, batch_size=32, keyframe_interval=None, clip_lengths=None):
+        """Detect all faces in a batch of frames given as a uint8 tensor.
+
+        Unlike detect(), the frames are not converted to PIL images: they are moved to
+        self.device `batch_size` frames at a time and the whole scale pyramid is run on each
+        chunk as one batch.
+
+        With `keyframe_interval`, the frames are tracked instead: the full pyramid only runs on
+        every `keyframe_interval`-th frame of each clip, and the faces of a keyframe are looked
+        for on the following frames with R-Net and O-Net alone, around their keyframe boxes.
+        A tracked frame falls back to detection when a face is lost or its probability drops
+        below `track_threshold`, with a pyramid limited to the face sizes found on the other
+        frames. Faces that only appear between two keyframes are missed on those frames.
+
+        Arguments:
+            frames {torch.Tensor} -- uint8 tensor of shape (N, H, W, 3).
+
+        Keyword Arguments:
+            batch_size {int} -- Number of frames sent through the networks at once. (default: {32})
+            keyframe_interval {int} -- Track faces between keyframes this many frames apart,
+                None to detect on every frame. (default: {None})
+            clip_lengths {list} -- Number of frames of each clip when `frames` is several
+                clips put back to back, so that tracking restarts with a keyframe at the start
+                of every clip. (default: {None})
+
+        Returns:
+            tuple(list, list) -- For each frame, a (n, 4) array of bounding boxes and a length n
+                array of detection probabilities, ordered as in detect(), or None and [None] when
+                no face was found.
+        """
+        if keyframe_interval is not None:
+            return self._track(frames, batch_size, keyframe_interval, clip_lengths)
+        boxes, probs = [], []
+        for start in range(0, len(frames), batch_size):
+            chunk_boxes, chunk_probs = self._detect_chunk(frames[start:start + batch_size].to(self.device))
+            boxes.extend(chunk_boxes)
+            probs.extend(chunk_probs)
+        return boxes, probs
+
+    def forward_tensor(self, frames, batch_size=32, keyframe_interval=None, clip_lengths=None):
+        """Detect and extract faces from a batch of frames given as a uint8 tensor.
+
+        Tensor counterpart of forward() built on detect_tensor(): faces are cropped and
+        resized on self.device straight from the frames that were used for detection.
+
+        Arguments:
+            frames {torch.Tensor} -- uint8 tensor of shape (N, H, W, 3).
+
+        Keyword Arguments:
+            batch_size {int} -- Number of frames sent through the networks at once. (default: {32})
+            keyframe_interval {int} -- See detect_tensor(). (default: {None})
+            clip_lengths {list} -- See detect_tensor(). (default: {None})
+
+        Returns:
+            list -- For each frame, None if no face was detected, otherwise an
+                n x 3 x image_size x image_size tensor on self.device if self.keep_all is True,
+                or the 3 x image_size x image_size tensor of the first face.
+        """
+        boxes = None
+        if keyframe_interval is not None:
+            boxes, _ = self._track(frames, batch_size, keyframe_interval, clip_lengths)
+        faces = []
+        for start in range(0, len(frames), batch_size):
+            chunk = frames[start:start + batch_size].to(self.device)
+            if boxes is None:
+                chunk_boxes, _ = self._detect_chunk(chunk)
+            else:
+                chunk_boxes = boxes[start:start + batch_size]
+            for frame, box_im in zip(chunk.permute(0, 3, 1, 2), chunk_boxes):
+                if box_im is None:
+                    faces.append(None)
+                    continue
+                if not self.keep_all:
+                    box_im = box_im[[0]]
+                faces_im = []
+                for box in box_im:
+                    face = extract_face_tensor(frame, box, self.image_size, self.margin)
+                    if self.prewhiten:
+                        face = prewhiten(face)
+                    faces_im.append(face)
+                faces.append(torch.stack(faces_im) if self.keep_all else faces_im[0])
+        return faces
+
+    def _detect_chunk(self, frames, maxsize=None, minsize=None):
+        with torch.no_grad():
+            batch_boxes, _ = detect_face(
+                frames, self.min_face_size if minsize is None else minsize,
+                self.pnet, self.rnet, self.onet,
+                self.thresholds, self.factor,
+                self.device, maxsize
+            )
+
+        boxes, probs = [], []
+        for box in batch_boxes:
+            box, prob = self._order_boxes(box)
+            boxes.append(box)
+            probs.append(prob)
+        return boxes, probs
+
+    def _order_boxes(self, box):
+        box = np.array(box)
+        if len(box) == 0:
+            return None, [None]
+        if self.select_largest:
+            box_order = np.argsort((box[:, 2] - box[:, 0]) * (box[:, 3] - box[:, 1]))[::-1]
+            box = box[box_order]
+        return box[:, :4], box[:, 4]
+
+    def _track(self, frames, batch_size, keyframe_interval, clip_lengths=None, track_threshold=0.9,
+               size_margin=1.5):
+        if clip_lengths is None:
+            clip_lengths = [len(frames)]
+        # every frame is tracked from the last keyframe of its clip
+        anchors = []
+        for clip_start, length in zip(np.cumsum([0] + list(clip_lengths)), clip_lengths):
+            anchors.extend(clip_start + (i // keyframe_interval) * keyframe_interval for i in range(length))
+        anchors = np.array(anchors, dtype=np.int64)
+        is_keyframe = anchors == np.arange(len(frames))
+
+        boxes = [None] * len(frames)
+        probs = [[None]] * len(frames)
+        self._detect_frames(frames, np.flatnonzero(is_keyframe), batch_size, boxes, probs)
+
+        tracked = [i for i in np.flatnonzero(~is_keyframe) if boxes[anchors[i]] is not None]
+        fallback = [i for i in np.flatnonzero(~is_keyframe) if boxes[anchors[i]] is None]
+        for start in range(0, len(tracked), batch_size):
+            chunk = tracked[start:start + batch_size]
+            prev = [boxes[anchors[i]] for i in chunk]
+            prev_inds = np.repeat(np.arange(len(chunk)), [len(b) for b in prev])
+            with torch.no_grad():
+                found = track_face(
+                    frames[chunk], np.concatenate(prev), prev_inds,
+                    self.rnet, self.onet, self.thresholds, self.device
+                )
+            for i, prev_im, box in zip(chunk, prev, found):
+                if len(box) < len(prev_im) or box[:, 4].min() < track_threshold:
+                    fallback.append(i)
+                else:
+                    boxes[i], probs[i] = self._order_boxes(box)
+
+        # the faces of a clip keep roughly the same size, the pyramid of the fallback frames
+        # only covers the sizes seen so far
+        sizes = [np.maximum(b[:, 2] - b[:, 0], b[:, 3] - b[:, 1]) for b in boxes if b is not None]
+        minsize, maxsize = None, None
+        if len(sizes) > 0:
+            sizes = np.concatenate(sizes)
+            minsize = max(self.min_face_size, sizes.min() / size_margin)
+            maxsize = sizes.max() * size_margin
+        self._detect_frames(frames, sorted(fallback), batch_size, boxes, probs, maxsize, minsize)
+        return boxes, probs
+
+    def _detect_frames(self, frames, indices, batch_size, boxes, probs, maxsize=None, minsize=None):
+        # runs detection on frames[indices] and fills in their entries of boxes and probs
+        for start in range(0, len(indices), batch_size):
+            chunk = indices[start:start + batch_size]
+            chunk_boxes, chunk_probs = self._detect_chunk(frames[chunk].to(self.device), maxsize, minsize)
+            for i, box, prob in zip(chunk, chunk_boxes, chunk_probs):
+                boxes[i], probs[i] = box, prob
+
 
 def prewhiten(x):
     mean = x.mean()
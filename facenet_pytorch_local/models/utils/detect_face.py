@@ -1,21 +1,26 @@
 import torch
+import torchvision
 from torchvision.transforms import functional as F
 import numpy as np
 import os
 from collections.abc import Iterable
 
 
-def detect_face(imgs, minsize, pnet, rnet, onet, threshold, factor, device):
-    if not isinstance(imgs, Iterable):
-        imgs = [imgs]
-    if any(img.size != imgs[0].size for img in imgs):
-        raise Exception("MTCNN batch processing only compatible with equal-dimension images.")
-
-    imgs = [torch.as_tensor(np.uint8(img)).float().to(device) for img in imgs]
-    if (len(imgs) == 0):
-        imgs = torch.zeros(3, 3, 720, 1280)
+def detect_face(imgs, minsize, pnet, rnet, onet, threshold, factor, device, maxsize=None):
+    if isinstance(imgs, torch.Tensor):
+        # uint8 (N, H, W, 3) frames are used as they are, without a PIL round-trip
+        imgs = imgs.to(device).float().permute(0, 3, 1, 2)
     else:
-        imgs = torch.stack(imgs).permute(0, 3, 1, 2)
+        if not isinstance(imgs, Iterable):
+            imgs = [imgs]
+        if any(img.size != imgs[0].size for img in imgs):
+            raise Exception("MTCNN batch processing only compatible with equal-dimension images.")
+
+        imgs = [torch.as_tensor(np.uint8(img)).float().to(device) for img in imgs]
+        if (len(imgs) == 0):
+            imgs = torch.zeros(3, 3, 720, 1280)
+        else:
+            imgs = torch.stack(imgs).permute(0, 3, 1, 2)
     batch_size = len(imgs)
     h, w = imgs.shape[2:4]
     m = 12.0 / minsize
@@ -24,7 +29,8 @@ def detect_face(imgs, minsize, pnet, rnet, onet, threshold, factor, device):
 
     # First stage
     # Create scale pyramid
-    total_boxes_all = [np.empty((0, 9)) for i in range(batch_size)]
+    total_boxes = []
+    image_inds = []
     scale = m
     while minl >= 12:
         hs = int(h * scale + 1)
@@ -33,106 +39,33 @@ def detect_face(imgs, minsize, pnet, rnet, onet, threshold, factor, device):
         im_data = (im_data - 127.5) * 0.0078125
         reg, probs = pnet(im_data)
 
-        for b_i in range(batch_size):
-            boxes = generateBoundingBox(reg[b_i], probs[b_i, 1], scale, threshold[0]).numpy()
+        boxes, image_inds_scale = generateBoundingBox(reg, probs[:, 1], scale, threshold[0])
 
-            # inter-scale nms
-            pick = nms(boxes, 0.5, "Union")
-            if boxes.size > 0 and pick.size > 0:
-                boxes = boxes[pick, :]
-                total_boxes_all[b_i] = np.append(total_boxes_all[b_i], boxes, axis=0)
+        # inter-scale nms, for all images of the batch at once
+        pick = batched_nms(boxes[:, :4], boxes[:, 4], image_inds_scale, 0.5, "Union")
+        total_boxes.append(boxes[pick])
+        image_inds.append(image_inds_scale[pick])
 
+        # P-Net sees faces of about 12 / scale pixels, the pyramid stops at the first scale
+        # that covers faces of maxsize
+        if maxsize is not None and 12.0 / scale >= maxsize:
+            break
         scale = scale * factor
         minl = minl * factor
 
-    batch_boxes = []
-    batch_points = []
-    for img, total_boxes in zip(imgs, total_boxes_all):
-        points = []
-        numbox = total_boxes.shape[0]
-        if numbox > 0:
-            pick = nms(total_boxes, 0.7, "Union")
-            total_boxes = total_boxes[pick, :]
-            regw = total_boxes[:, 2] - total_boxes[:, 0]
-            regh = total_boxes[:, 3] - total_boxes[:, 1]
-            qq1 = total_boxes[:, 0] + total_boxes[:, 5] * regw
-            qq2 = total_boxes[:, 1] + total_boxes[:, 6] * regh
-            qq3 = total_boxes[:, 2] + total_boxes[:, 7] * regw
-            qq4 = total_boxes[:, 3] + total_boxes[:, 8] * regh
-            total_boxes = np.transpose(np.vstack([qq1, qq2, qq3, qq4, total_boxes[:, 4]]))
-            total_boxes = rerec(total_boxes)
-            total_boxes[:, 0:4] = np.fix(total_boxes[:, 0:4]).astype(np.int32)
-            y, ey, x, ex = pad(total_boxes, w, h)
-
-        numbox = total_boxes.shape[0]
-        if numbox > 0:
-            # second stage
-            im_data = []
-            for k in range(0, numbox):
-                if ey[k] > (y[k] - 1) and ex[k] > (x[k] - 1):
-                    img_k = img[:, (y[k] - 1) : ey[k], (x[k] - 1) : ex[k]].unsqueeze(0)
-                    im_data.append(imresample(img_k, (24, 24)))
-            im_data = torch.cat(im_data, 0)
-            im_data = (im_data - 127.5) * 0.0078125
-            out = rnet(im_data)
-
-            out0 = np.transpose(out[0].numpy())
-            out1 = np.transpose(out[1].numpy())
-            score = out1[1, :]
-            ipass = np.where(score > threshold[1])
-            total_boxes = np.hstack(
-                [total_boxes[ipass[0], 0:4].copy(), np.expand_dims(score[ipass].copy(), 1)]
-            )
-            mv = out0[:, ipass[0]]
-            if total_boxes.shape[0] > 0:
-                pick = nms(total_boxes, 0.7, "Union")
-                total_boxes = total_boxes[pick, :]
-                total_boxes = bbreg(total_boxes.copy(), np.transpose(mv[:, pick]))
-                total_boxes = rerec(total_boxes.copy())
-
-        numbox = total_boxes.shape[0]
-        if numbox > 0:
-            # third stage
-            total_boxes = np.fix(total_boxes).astype(np.int32)
-            y, ey, x, ex = pad(total_boxes.copy(), w, h)
-            im_data = []
-            for k in range(0, numbox):
-                if ey[k] > (y[k] - 1) and ex[k] > (x[k] - 1):
-                    img_k = img[:, (y[k] - 1) : ey[k], (x[k] - 1) : ex[k]].unsqueeze(0)
-                    im_data.append(imresample(img_k, (48, 48)))
-            im_data = torch.cat(im_data, 0)
-            im_data = (im_data - 127.5) * 0.0078125
-            out = onet(im_data)
-
-            out0 = np.transpose(out[0].numpy())
-            out1 = np.transpose(out[1].numpy())
-            out2 = np.transpose(out[2].numpy())
-            score = out2[1, :]
-            points = out1
-            ipass = np.where(score > threshold[2])
-            points = points[:, ipass[0]]
-            total_boxes = np.hstack(
-                [total_boxes[ipass[0], 0:4].copy(), np.expand_dims(score[ipass].copy(), 1)]
-            )
-            mv = out0[:, ipass[0]]
-
-            w_i = total_boxes[:, 2] - total_boxes[:, 0] + 1
-            h_i = total_boxes[:, 3] - total_boxes[:, 1] + 1
-            points_x = (
-                np.tile(w_i, (5, 1)) * points[0:5, :] + np.tile(total_boxes[:, 0], (5, 1)) - 1
-            )
-            points_y = (
-                np.tile(h_i, (5, 1)) * points[5:10, :] + np.tile(total_boxes[:, 1], (5, 1)) - 1
-            )
-            points = np.stack((points_x, points_y), axis=0)
-            if total_boxes.shape[0] > 0:
-                total_boxes = bbreg(total_boxes, np.transpose(mv))
-                pick = nms(total_boxes, 0.7, "Min")
-                total_boxes = total_boxes[pick, :]
-                points = np.transpose(points[:, :, pick])
-
-        batch_boxes.append(total_boxes)
-        batch_points.append(points)
+    total_boxes = torch.cat(total_boxes, dim=0)
+    image_inds = torch.cat(image_inds, dim=0)
+    pick = batched_nms(total_boxes[:, :4], total_boxes[:, 4], image_inds, 0.7, "Union")
+    total_boxes = total_boxes[pick].cpu().double().numpy()
+    image_inds = image_inds[pick].cpu().numpy()
+
+    total_boxes, image_inds, points = refine_boxes(
+        integral_image(imgs), total_boxes, image_inds, w, h, rnet, onet, threshold
+    )
+
+    # scatter the boxes back to their images
+    batch_boxes = [total_boxes[image_inds == b_i] for b_i in range(batch_size)]
+    batch_points = [points[image_inds == b_i] for b_i in range(batch_size)]
     #print(len(batch_points))
     #print(len(batch_boxes))
     #if (len(batch_points) != 0):
@@ -145,6 +78,140 @@ def detect_face(imgs, minsize, pnet, rnet, onet, threshold, factor, device):
     return batch_boxes, np.zeros((len(batch_points),2,5,0))
 
 
+def track_face(imgs, prev_boxes, prev_inds, rnet, onet, threshold, device):
+    """Re-detects known faces in a batch of frames without running P-Net.
+
+    Every box of `prev_boxes` (eg. the faces found on an earlier frame of the same clip) is
+    turned into a few candidate windows around it, shifted and scaled to follow a face that
+    moved, and only these candidates go through R-Net and O-Net.
+
+    Arguments:
+        imgs {torch.Tensor} -- uint8 tensor of shape (N, H, W, 3).
+        prev_boxes {numpy.ndarray} -- (n, 4+) array of boxes to look around.
+        prev_inds {numpy.ndarray} -- (n,) array with the frame of `imgs` each box is searched in.
+
+    Returns:
+        list -- For each frame, a (k, 5) array of boxes and O-Net scores.
+    """
+    imgs = imgs.to(device).float().permute(0, 3, 1, 2)
+    h, w = imgs.shape[2:4]
+    total_boxes, image_inds = track_candidates(prev_boxes, prev_inds)
+    total_boxes, image_inds, _ = refine_boxes(
+        integral_image(imgs), total_boxes, image_inds, w, h, rnet, onet, threshold
+    )
+    return [total_boxes[image_inds == b_i] for b_i in range(len(imgs))]
+
+
+def track_candidates(boxes, image_inds, scales=(0.8, 1.0, 1.25), shifts=(-0.3, 0, 0.3)):
+    """Candidate windows in the (n, 9) layout of the first stage output, with a score of one
+    and no regression: every combination of `scales` of the box size and of `shifts` of the box
+    centre in x and y, as a fraction of the box size."""
+    boxes = np.asarray(boxes, dtype=np.float64)[:, :4]
+    size = np.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1])
+    cx = (boxes[:, 0] + boxes[:, 2]) / 2
+    cy = (boxes[:, 1] + boxes[:, 3]) / 2
+    scale, dx, dy = [g.reshape(-1, 1) for g in np.meshgrid(scales, shifts, shifts)]
+    half = size * scale / 2
+    x = cx + dx * size
+    y = cy + dy * size
+    candidates = np.stack([x - half, y - half, x + half, y + half], axis=2).reshape(-1, 4)
+    candidates = np.hstack([candidates, np.ones((len(candidates), 1)), np.zeros((len(candidates), 4))])
+    return candidates, np.tile(np.asarray(image_inds), len(scale))
+
+
+def refine_boxes(integral, total_boxes, image_inds, w, h, rnet, onet, threshold):
+    """Second and third stage of MTCNN for the candidate boxes of all images at once.
+
+    `total_boxes` is an (n, 9) array of P-Net style candidates and `image_inds` keeps track of
+    the image each box belongs to. Returns the kept (k, 5) boxes, their image indices and their
+    (k, 5, 2) landmarks.
+    """
+    points = np.zeros((0, 5, 2))
+    numbox = total_boxes.shape[0]
+    if numbox > 0:
+        regw = total_boxes[:, 2] - total_boxes[:, 0]
+        regh = total_boxes[:, 3] - total_boxes[:, 1]
+        qq1 = total_boxes[:, 0] + total_boxes[:, 5] * regw
+        qq2 = total_boxes[:, 1] + total_boxes[:, 6] * regh
+        qq3 = total_boxes[:, 2] + total_boxes[:, 7] * regw
+        qq4 = total_boxes[:, 3] + total_boxes[:, 8] * regh
+        total_boxes = np.transpose(np.vstack([qq1, qq2, qq3, qq4, total_boxes[:, 4]]))
+        total_boxes = rerec(total_boxes)
+        total_boxes[:, 0:4] = np.fix(total_boxes[:, 0:4]).astype(np.int32)
+        y, ey, x, ex = pad(total_boxes, w, h)
+
+        # crops that end up empty after clipping to the image are dropped
+        valid = (ey > y - 1) & (ex > x - 1)
+        total_boxes, image_inds = total_boxes[valid], image_inds[valid]
+        y, ey, x, ex = y[valid], ey[valid], x[valid], ex[valid]
+
+    numbox = total_boxes.shape[0]
+    if numbox > 0:
+        # second stage, one R-Net pass over the candidates of every image
+        out = run_on_crops(rnet, integral, image_inds, y, ey, x, ex, (24, 24))
+        out0 = np.transpose(out[0].numpy())
+        out1 = np.transpose(out[1].numpy())
+        score = out1[1, :]
+        ipass = np.where(score > threshold[1])
+        total_boxes = np.hstack(
+            [total_boxes[ipass[0], 0:4].copy(), np.expand_dims(score[ipass].copy(), 1)]
+        )
+        image_inds = image_inds[ipass[0]]
+        mv = out0[:, ipass[0]]
+        if total_boxes.shape[0] > 0:
+            pick = nms(total_boxes, 0.7, "Union", image_inds)
+            total_boxes = total_boxes[pick, :]
+            image_inds = image_inds[pick]
+            total_boxes = bbreg(total_boxes.copy(), np.transpose(mv[:, pick]))
+            total_boxes = rerec(total_boxes.copy())
+
+    numbox = total_boxes.shape[0]
+    if numbox > 0:
+        total_boxes = np.fix(total_boxes).astype(np.int32)
+        y, ey, x, ex = pad(total_boxes.copy(), w, h)
+        valid = (ey > y - 1) & (ex > x - 1)
+        total_boxes, image_inds = total_boxes[valid], image_inds[valid]
+        y, ey, x, ex = y[valid], ey[valid], x[valid], ex[valid]
+
+    numbox = total_boxes.shape[0]
+    if numbox > 0:
+        # third stage, one O-Net pass over the candidates of every image
+        out = run_on_crops(onet, integral, image_inds, y, ey, x, ex, (48, 48))
+
+        out0 = np.transpose(out[0].numpy())
+        out1 = np.transpose(out[1].numpy())
+        out2 = np.transpose(out[2].numpy())
+        score = out2[1, :]
+        points = out1
+        ipass = np.where(score > threshold[2])
+        points = points[:, ipass[0]]
+        total_boxes = np.hstack(
+            [total_boxes[ipass[0], 0:4].copy(), np.expand_dims(score[ipass].copy(), 1)]
+        )
+        image_inds = image_inds[ipass[0]]
+        mv = out0[:, ipass[0]]
+
+        w_i = total_boxes[:, 2] - total_boxes[:, 0] + 1
+        h_i = total_boxes[:, 3] - total_boxes[:, 1] + 1
+        points_x = (
+            np.tile(w_i, (5, 1)) * points[0:5, :] + np.tile(total_boxes[:, 0], (5, 1)) - 1
+        )
+        points_y = (
+            np.tile(h_i, (5, 1)) * points[5:10, :] + np.tile(total_boxes[:, 1], (5, 1)) - 1
+        )
+        points = np.stack((points_x, points_y), axis=0)
+        if total_boxes.shape[0] > 0:
+            total_boxes = bbreg(total_boxes, np.transpose(mv))
+            pick = nms(total_boxes, 0.7, "Min", image_inds)
+            total_boxes = total_boxes[pick, :]
+            image_inds = image_inds[pick]
+            points = np.transpose(points[:, :, pick])
+        else:
+            points = np.zeros((0, 5, 2))
+
+    return total_boxes, image_inds, points
+
+
 def bbreg(boundingbox, reg):
     if reg.shape[1] == 1:
         reg = np.reshape(reg, (reg.shape[2], reg.shape[3]))
@@ -160,50 +227,94 @@ def bbreg(boundingbox, reg):
 
 
 def generateBoundingBox(reg, probs, scale, thresh):
+    """Turns the P-Net outputs of a batch of images into candidate boxes.
+
+    Returns a (n, 9) tensor of boxes (x1, y1, x2, y2, score, 4 regression offsets) and the
+    index of the image each box belongs to.
+    """
     stride = 2
     cellsize = 12
 
+    reg = reg.permute(1, 0, 2, 3)
+
     mask = probs >= thresh
+    mask_inds = mask.nonzero()
+    image_inds = mask_inds[:, 0]
     score = probs[mask]
     reg = reg[:, mask].permute(1, 0)
-    bb = mask.nonzero().float().flip(1)
+    bb = mask_inds[:, 1:].type(reg.dtype).flip(1)
     q1 = ((stride * bb + 1) / scale).floor()
     q2 = ((stride * bb + cellsize - 1 + 1) / scale).floor()
     boundingbox = torch.cat([q1, q2, score.unsqueeze(1), reg], dim=1)
-    return boundingbox
+    return boundingbox, image_inds
 
 
-def nms(boxes, threshold, method):
-    if boxes.size == 0:
-        return np.empty((0, 3))
-    x1 = boxes[:, 0]
-    y1 = boxes[:, 1]
-    x2 = boxes[:, 2]
-    y2 = boxes[:, 3]
-    s = boxes[:, 4]
+def batched_nms(boxes, scores, idxs, threshold, method):
+    """Greedy non-maximum suppression over the boxes of several images at once.
+
+    Boxes only suppress boxes with the same value in `idxs` (the image index). Box areas use
+    the inclusive pixel convention of MTCNN, (x2 - x1 + 1) * (y2 - y1 + 1), and a box is
+    suppressed when its overlap with a higher scoring box is above `threshold`.
+
+    Arguments:
+        boxes {torch.Tensor} -- (n, 4) tensor of x1, y1, x2, y2 coordinates.
+        scores {torch.Tensor} -- (n,) tensor of scores.
+        idxs {torch.Tensor} -- (n,) tensor of image indices.
+        threshold {float} -- Overlap threshold.
+        method {str} -- "Union" for intersection over union, "Min" for intersection over the
+            smaller of the two areas.
+
+    Returns:
+        torch.Tensor -- int64 indices of the kept boxes, in decreasing order of score.
+    """
+    if boxes.numel() == 0:
+        return torch.empty((0,), dtype=torch.int64, device=boxes.device)
+
+    boxes = boxes.double()
+    if method == "Min":
+        # Move the boxes of each image to their own region so that boxes of different images
+        # can never overlap, then run a single NMS over the whole batch
+        offsets = idxs.to(boxes) * (boxes.max() - boxes.min() + 2)
+        return _nms_min(boxes + offsets[:, None], scores, threshold)
+
+    # torchvision uses (x2 - x1) * (y2 - y1) areas, shift the far corner by one pixel
+    boxes = torch.cat([boxes[:, :2], boxes[:, 2:] + 1], dim=1)
+    return torchvision.ops.batched_nms(boxes, scores.double(), idxs, threshold)
+
+
+def _nms_min(boxes, scores, threshold):
+    # Builds the full pairwise overlap matrix, which is fine for the few boxes left after
+    # O-Net, the only stage that uses "Min"
+    order = torch.argsort(scores, descending=True)
+    boxes = boxes[order]
+    x1, y1, x2, y2 = boxes.unbind(1)
     area = (x2 - x1 + 1) * (y2 - y1 + 1)
-    I = np.argsort(s)
-    pick = np.zeros_like(s, dtype=np.int16)
-    counter = 0
-    while I.size > 0:
-        i = I[-1]
-        pick[counter] = i
-        counter += 1
-        idx = I[0:-1]
-        xx1 = np.maximum(x1[i], x1[idx])
-        yy1 = np.maximum(y1[i], y1[idx])
-        xx2 = np.minimum(x2[i], x2[idx])
-        yy2 = np.minimum(y2[i], y2[idx])
-        w = np.maximum(0.0, xx2 - xx1 + 1)
-        h = np.maximum(0.0, yy2 - yy1 + 1)
-        inter = w * h
-        if method is "Min":
-            o = inter / np.minimum(area[i], area[idx])
-        else:
-            o = inter / (area[i] + area[idx] - inter)
-        I = I[np.where(o <= threshold)]
-    pick = pick[0:counter]
-    return pick
+    w = (torch.min(x2[:, None], x2[None, :]) - torch.max(x1[:, None], x1[None, :]) + 1).clamp(min=0)
+    h = (torch.min(y2[:, None], y2[None, :]) - torch.max(y1[:, None], y1[None, :]) + 1).clamp(min=0)
+    overlap = w * h / torch.min(area[:, None], area[None, :])
+    suppress = (overlap > threshold).cpu().numpy()
+
+    # Only the kept boxes need a Python step, each one removes everything it overlaps
+    removed = np.zeros(len(order), dtype=bool)
+    keep = []
+    for i in range(len(order)):
+        if removed[i]:
+            continue
+        keep.append(i)
+        removed |= suppress[i]
+    return order[torch.as_tensor(keep, dtype=torch.int64, device=order.device)]
+
+
+def nms(boxes, threshold, method, image_inds=None):
+    """NMS over an (n, 5+) numpy array of boxes, see batched_nms(). Without `image_inds` all
+    boxes are taken to come from a single image."""
+    if boxes.size == 0:
+        return np.empty((0,), dtype=np.int64)
+    if image_inds is None:
+        image_inds = np.zeros(len(boxes), dtype=np.int64)
+    boxes = torch.as_tensor(boxes)
+    pick = batched_nms(boxes[:, :4], boxes[:, 4], torch.as_tensor(image_inds), threshold, method)
+    return pick.numpy()
 
 
 def pad(total_boxes, w, h):
@@ -236,6 +347,61 @@ def imresample(img, sz):
     return im_data
 
 
+def integral_image(imgs):
+    """Zero-padded summed-area table of a batch of images with integer values in [0, 255], as
+    an (N, H + 1, W + 1, C) tensor. Sums are exact in int32 for images of up to 2**31 / 255
+    (about 8.4 million) pixels."""
+    integral = imgs.to(torch.int32).cumsum(2, dtype=torch.int32).cumsum(3, dtype=torch.int32)
+    integral = torch.nn.functional.pad(integral, (1, 0, 1, 0))
+    return integral.permute(0, 2, 3, 1).contiguous()
+
+
+def run_on_crops(net, integral, image_inds, y, ey, x, ex, sz, chunk_size=256):
+    """Runs R-Net or O-Net over the crops of all candidate boxes of a batch and returns the
+    concatenated outputs. Crops are built and fed in chunks of `chunk_size`, which bounds the
+    memory used by the crops and is faster on CPU than a single very large forward pass."""
+    outs = []
+    for start in range(0, len(image_inds), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        im_data = crop_and_resize(integral, image_inds[chunk], y[chunk], ey[chunk], x[chunk], ex[chunk], sz)
+        im_data = (im_data - 127.5) * 0.0078125
+        outs.append(net(im_data))
+    return [torch.cat(out).cpu() for out in zip(*outs)]
+
+
+def crop_and_resize(integral, image_inds, y, ey, x, ex, sz):
+    """Crops the pixel ranges [y - 1, ey) x [x - 1, ex) out of the images `image_inds` and
+    resamples every crop to `sz`, like calling imresample() on each crop, but for all crops at
+    once: each output pixel is the mean of the input pixels of its area-interpolation bin,
+    read with four lookups into the summed-area table `integral` of the images."""
+    device = integral.device
+    n, h1, w1, c = integral.shape
+    image_inds = torch.as_tensor(image_inds, dtype=torch.int64, device=device)
+    r0, r1 = _area_bins(torch.as_tensor(y - 1, device=device), torch.as_tensor(ey - y + 1, device=device), sz[0])
+    c0, c1 = _area_bins(torch.as_tensor(x - 1, device=device), torch.as_tensor(ex - x + 1, device=device), sz[1])
+
+    # row offsets into the flattened table, (k, sz[0], 1) + (k, 1, sz[1]) broadcasts to the grid
+    b = (image_inds * h1)[:, None]
+    r0, r1 = ((b + r0) * w1)[:, :, None], ((b + r1) * w1)[:, :, None]
+    c0, c1 = c0[:, None, :], c1[:, None, :]
+    flat = integral.view(-1, c)
+
+    def lookup(rows, cols):
+        return flat.index_select(0, (rows + cols).view(-1))
+
+    total = lookup(r1, c1) - lookup(r0, c1) - lookup(r1, c0) + lookup(r0, c0)
+    area = ((r1 - r0) // w1) * (c1 - c0)
+    total = total.view(len(image_inds), sz[0], sz[1], c)
+    return (total.float() / area.unsqueeze(3)).permute(0, 3, 1, 2).contiguous()
+
+
+def _area_bins(start, length, size):
+    # bin i of an area resize covers [floor(i * length / size), ceil((i + 1) * length / size))
+    i = torch.arange(size, device=start.device)[None, :]
+    start, length = start.long()[:, None], length.long()[:, None]
+    return start + (i * length) // size, start - ((-(i + 1) * length) // size)
+
+
 def extract_face(img, box, image_size=160, margin=0, save_path=None):
     """Extract face + margin from PIL Image given bounding box.
     
@@ -275,3 +441,40 @@ def extract_face(img, box, image_size=160, margin=0, save_path=None):
     face = F.to_tensor(np.float32(face))
 
     return face
+
+
+def extract_face_tensor(img, box, image_size=160, margin=0):
+    """Extract face + margin from an image tensor given bounding box.
+
+    Tensor counterpart of extract_face(): the crop stays on the device of `img` and is
+    resized with antialiased bilinear interpolation, which approximates PIL's resize.
+
+    Arguments:
+        img {torch.Tensor} -- A (3, H, W) image tensor with values in [0, 255].
+        box {numpy.ndarray} -- Four-element bounding box.
+        image_size {int} -- Output image size in pixels. The image will be square.
+        margin {int} -- Margin to add to bounding box, in terms of pixels in the final image.
+
+    Returns:
+        torch.tensor -- float tensor representing the extracted face.
+    """
+    margin = [
+        margin * (box[2] - box[0]) / (image_size - margin),
+        margin * (box[3] - box[1]) / (image_size - margin),
+    ]
+    box = [
+        int(max(box[0] - margin[0] / 2, 0)),
+        int(max(box[1] - margin[1] / 2, 0)),
+        int(min(box[2] + margin[0] / 2, img.shape[2])),
+        int(min(box[3] + margin[1] / 2, img.shape[1])),
+    ]
+
+    if box[2] <= box[0] or box[3] <= box[1]:
+        return torch.zeros(3, image_size, image_size, device=img.device)
+
+    face = img[:, box[1]:box[3], box[0]:box[2]].unsqueeze(0).float()
+    face = torch.nn.functional.interpolate(
+        face, size=(image_size, image_size), mode="bilinear", align_corners=False, antialias=True
+    )
+
+    return face.squeeze(0)
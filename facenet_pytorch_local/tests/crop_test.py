@@ -0,0 +1,37 @@
+"""
+Checks that the batched crop resampling of the R-Net and O-Net stages gives the same input
+as cropping each box and resizing it with imresample(), as the pipeline did before.
+
+Run from the repository root with:
+    python -m pytest facenet_pytorch_local/tests/crop_test.py
+"""
+
+import os
+import sys
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from facenet_pytorch_local.models.utils.detect_face import crop_and_resize, imresample, integral_image, pad
+
+
+def test_crop_and_resize_matches_imresample():
+    rng = np.random.RandomState(0)
+    imgs = torch.as_tensor(rng.randint(0, 256, size=(3, 3, 90, 160))).float()
+    x1 = rng.randint(-20, 150, size=200)
+    y1 = rng.randint(-20, 80, size=200)
+    size = rng.randint(1, 120, size=200)
+    boxes = np.stack([x1, y1, x1 + size, y1 + size], axis=1).astype(np.float64)
+    image_inds = rng.randint(0, 3, size=200)
+    y, ey, x, ex = pad(boxes, 160, 90)
+    valid = (ey > y - 1) & (ex > x - 1)
+    image_inds, y, ey, x, ex = image_inds[valid], y[valid], ey[valid], x[valid], ex[valid]
+
+    for sz in [(24, 24), (48, 48)]:
+        crops = crop_and_resize(integral_image(imgs), image_inds, y, ey, x, ex, sz)
+        for k in range(len(image_inds)):
+            img_k = imgs[image_inds[k], :, (y[k] - 1):ey[k], (x[k] - 1):ex[k]].unsqueeze(0)
+            expected = imresample(img_k, sz)[0]
+            assert torch.allclose(crops[k], expected, atol=1e-3), (sz, k)
@@ -0,0 +1,66 @@
+"""
+Checks that the batched tensor pipeline of MTCNN.detect_tensor() and forward_tensor() finds
+the same faces as the PIL pipeline of detect() and forward() on frames of examples/video.mp4.
+
+Run from the repository root with:
+    python -m pytest facenet_pytorch_local/tests/detect_tensor_test.py
+"""
+
+import os
+import sys
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from facenet_pytorch_local.models.mtcnn import MTCNN
+
+VIDEO = os.path.join(os.path.dirname(__file__), '..', 'examples', 'video.mp4')
+
+
+def read_frames(num_frames, scale=0.5):
+    """
+    Returns the first frames of the example video as an (N, H, W, 3) uint8 RGB array,
+    downscaled to keep the tests fast
+    """
+    cap = cv2.VideoCapture(VIDEO)
+    frames = []
+    while len(frames) < num_frames:
+        ok, frame = cap.read()
+        if not ok:
+            break
+        frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    cap.release()
+    return np.stack(frames)
+
+
+def test_detect_tensor_matches_detect():
+    frames = read_frames(6)
+    # the boxes of select_largest are reordered with the landmarks, which detect_face doesn't return
+    mtcnn = MTCNN(keep_all=True, select_largest=False)
+    boxes, probs = mtcnn.detect_tensor(torch.from_numpy(frames), batch_size=4)
+    assert sum(len(b) for b in boxes if b is not None) > 0
+    for frame, box, prob in zip(frames, boxes, probs):
+        expected_box, expected_prob = mtcnn.detect(Image.fromarray(frame))
+        if expected_box is None:
+            assert box is None
+            continue
+        assert box.shape == expected_box.shape
+        assert np.allclose(box, expected_box, atol=1e-2)
+        assert np.allclose(prob, expected_prob, atol=1e-4)
+
+
+def test_forward_tensor_matches_forward():
+    frames = read_frames(2)
+    mtcnn = MTCNN(keep_all=True, select_largest=False)
+    faces = mtcnn.forward_tensor(torch.from_numpy(frames))
+    for frame, face in zip(frames, faces):
+        expected = mtcnn(Image.fromarray(frame))
+        assert face.shape == expected.shape
+        # the tensor path resizes the crops on the tensor instead of through PIL
+        assert torch.allclose(face, expected, atol=0.1)
+        assert (face - expected).abs().mean() < 0.02
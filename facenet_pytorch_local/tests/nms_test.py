@@ -0,0 +1,125 @@
+"""
+Equivalence tests for the batched NMS of the MTCNN pipeline against the original per-image
+NumPy implementation, plus a microbenchmark over the number of candidate boxes.
+
+Run the tests from the repository root with:
+    python -m pytest facenet_pytorch_local/tests/nms_test.py
+and the benchmark with:
+    python facenet_pytorch_local/tests/nms_test.py
+"""
+
+import os
+import sys
+from time import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from facenet_pytorch_local.models.utils.detect_face import batched_nms, nms
+
+
+def reference_nms(boxes, threshold, method):
+    """The NumPy while-loop NMS the pipeline used before, with an int64 pick array."""
+    if boxes.size == 0:
+        return np.empty((0,), dtype=np.int64)
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = boxes[:, 2]
+    y2 = boxes[:, 3]
+    s = boxes[:, 4]
+    area = (x2 - x1 + 1) * (y2 - y1 + 1)
+    I = np.argsort(s)
+    pick = np.zeros_like(s, dtype=np.int64)
+    counter = 0
+    while I.size > 0:
+        i = I[-1]
+        pick[counter] = i
+        counter += 1
+        idx = I[0:-1]
+        xx1 = np.maximum(x1[i], x1[idx])
+        yy1 = np.maximum(y1[i], y1[idx])
+        xx2 = np.minimum(x2[i], x2[idx])
+        yy2 = np.minimum(y2[i], y2[idx])
+        w = np.maximum(0.0, xx2 - xx1 + 1)
+        h = np.maximum(0.0, yy2 - yy1 + 1)
+        inter = w * h
+        if method == "Min":
+            o = inter / np.minimum(area[i], area[idx])
+        else:
+            o = inter / (area[i] + area[idx] - inter)
+        I = I[np.where(o <= threshold)]
+    return pick[0:counter]
+
+
+def random_boxes(num_boxes, seed, image_size=720, max_box=200):
+    """Clustered candidate boxes with distinct scores, similar to P-Net output."""
+    if num_boxes == 0:
+        return np.empty((0, 5))
+    rng = np.random.RandomState(seed)
+    centres = rng.uniform(0, image_size, size=(max(1, num_boxes // 50), 2))
+    centre = centres[rng.randint(len(centres), size=num_boxes)] + rng.normal(0, 10, size=(num_boxes, 2))
+    size = rng.uniform(12, max_box, size=(num_boxes, 1))
+    x1y1 = np.floor(centre - size / 2)
+    x2y2 = np.floor(centre + size / 2)
+    scores = rng.permutation(num_boxes) / num_boxes + 0.5 / num_boxes
+    return np.hstack([x1y1, x2y2, scores[:, None]])
+
+
+def test_single_image_matches_reference():
+    for method in ["Union", "Min"]:
+        for threshold in [0.5, 0.7]:
+            for num_boxes in [0, 1, 10, 300, 2000]:
+                boxes = random_boxes(num_boxes, seed=num_boxes)
+                expected = reference_nms(boxes, threshold, method)
+                assert np.array_equal(nms(boxes, threshold, method), expected), (method, threshold, num_boxes)
+
+
+def test_batched_matches_per_image_reference():
+    for method in ["Union", "Min"]:
+        images = [random_boxes(n, seed=i) for i, n in enumerate([400, 0, 3500, 120])]
+        boxes = torch.as_tensor(np.concatenate(images))
+        idxs = torch.cat([torch.full((len(b),), i, dtype=torch.int64) for i, b in enumerate(images)])
+        pick = batched_nms(boxes[:, :4], boxes[:, 4], idxs, 0.5, method).numpy()
+        offset = 0
+        for i, image_boxes in enumerate(images):
+            expected = reference_nms(image_boxes, 0.5, method) + offset
+            assert np.array_equal(pick[idxs.numpy()[pick] == i], expected), (method, i)
+            offset += len(image_boxes)
+
+
+def test_more_boxes_than_int16():
+    # The old int16 pick array wrapped around above 32767 candidates. Disjoint boxes are all
+    # kept, in decreasing order of score.
+    num_boxes = 40000
+    corner = np.stack(np.meshgrid(np.arange(200), np.arange(200)), axis=2).reshape(-1, 2) * 20.0
+    scores = np.random.RandomState(0).permutation(num_boxes) / num_boxes
+    boxes = np.hstack([corner, corner + 10, scores[:, None]])
+    pick = nms(boxes, 0.5, "Union")
+    assert np.array_equal(pick, np.argsort(-scores))
+
+
+def benchmark(counts=(100, 500, 1000, 2000, 5000, 10000), num_images=8, repeats=3):
+    print('{:>10} {:>14} {:>14} {:>10}'.format('boxes/img', 'numpy loop (s)', 'batched (s)', 'speedup'))
+    for count in counts:
+        images = [random_boxes(count, seed=i) for i in range(num_images)]
+        boxes = torch.as_tensor(np.concatenate(images))
+        idxs = torch.cat([torch.full((count,), i, dtype=torch.int64) for i in range(num_images)])
+
+        start = time()
+        for _ in range(repeats):
+            for image_boxes in images:
+                reference_nms(image_boxes, 0.5, "Union")
+        numpy_time = (time() - start) / repeats
+
+        start = time()
+        for _ in range(repeats):
+            batched_nms(boxes[:, :4], boxes[:, 4], idxs, 0.5, "Union")
+        batched_time = (time() - start) / repeats
+
+        print('{:>10} {:>14.4f} {:>14.4f} {:>9.1f}x'.format(count, numpy_time, batched_time, numpy_time / batched_time))
+
+
+if __name__ == '__main__':
+    benchmark()
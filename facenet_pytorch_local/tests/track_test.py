@@ -0,0 +1,74 @@
+"""
+Checks the keyframe tracking of MTCNN.detect_tensor() against detection on every frame of
+examples/video.mp4. Tracking knowingly misses faces that only appear between keyframes, so
+the tracked boxes are compared within an IoU tolerance rather than exactly.
+
+Run from the repository root with:
+    python -m pytest facenet_pytorch_local/tests/track_test.py
+"""
+
+import os
+import sys
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import facenet_pytorch_local.models.mtcnn as mtcnn_module
+from facenet_pytorch_local.models.mtcnn import MTCNN
+from detect_tensor_test import read_frames
+
+
+def box_iou(a, b):
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / (area_a[:, None] + area_b[None, :] - inter)
+
+
+def test_tracking_matches_detection(monkeypatch):
+    frames = torch.from_numpy(read_frames(16))
+    mtcnn = MTCNN(keep_all=True, select_largest=False)
+    full, _ = mtcnn.detect_tensor(frames)
+
+    # count the frames that R-Net and O-Net tracked, rather than detected again
+    tracked_frames = []
+    track_face = mtcnn_module.track_face
+    def counting_track_face(frames, *args):
+        tracked_frames.append(len(frames))
+        return track_face(frames, *args)
+    monkeypatch.setattr(mtcnn_module, 'track_face', counting_track_face)
+    boxes, probs = mtcnn.detect_tensor(frames, keyframe_interval=4, clip_lengths=[8, 8])
+    assert sum(tracked_frames) > 0
+
+    num_full = sum(len(b) for b in full if b is not None)
+    found = 0
+    for box, prob, expected in zip(boxes, probs, full):
+        if box is None or expected is None:
+            assert box is None and expected is None
+            continue
+        assert len(prob) == len(box)
+        iou = box_iou(box, expected)
+        # every tracked face is one detection finds
+        assert iou.max(axis=1).min() > 0.7
+        found += (iou.max(axis=0) > 0.5).sum()
+    assert found >= 0.95 * num_full
+
+
+def test_every_frame_a_keyframe_is_detection():
+    frames = torch.from_numpy(read_frames(6))
+    mtcnn = MTCNN(keep_all=True, select_largest=False)
+    full, full_probs = mtcnn.detect_tensor(frames, batch_size=4)
+    boxes, probs = mtcnn.detect_tensor(frames, batch_size=4, keyframe_interval=1)
+    for box, prob, expected, expected_prob in zip(boxes, probs, full, full_probs):
+        if expected is None:
+            assert box is None
+            continue
+        assert np.array_equal(box, expected)
+        assert np.array_equal(prob, expected_prob)
@@ -0,0 +1,241 @@
+"""
+Packed, memory-mapped storage for per-utterance feature arrays.
+
+A store at `path` consists of two files:
+
+    path.bin          every array, flattened and written back to back
+    path.index.json   dtype plus the element offset and shape of each key
+
+Reading goes through np.memmap, so opening a store is cheap and each lookup
+returns a view into the page cache instead of unpickling a file.
+"""
+import json
+import os
+
+import numpy as np
+
+
+class FeatureStore(object):
+    """
+    Read-only access to a packed store. The memmap is opened copy-on-write so the
+    returned arrays can be wrapped with torch.from_numpy without copying; writes
+    to them never reach the file.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path + '.index.json') as f:
+            index = json.load(f)
+        self.dtype = np.dtype(index['dtype'])
+        self.index = {key: (offset, tuple(shape)) for key, offset, shape in zip(index['keys'], index['offsets'], index['shapes'])}
+        if os.path.getsize(path + '.bin') > 0:
+            self.data = np.memmap(path + '.bin', dtype=self.dtype, mode='c')
+        else:
+            self.data = np.empty(0, dtype=self.dtype)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(path + '.index.json') and os.path.exists(path + '.bin')
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def get(self, key):
+        """
+        Returns the array stored under `key` as a view into the memmap
+        """
+        offset, shape = self.index[key]
+        size = int(np.prod(shape))
+        return self.data[offset:offset + size].reshape(shape)
+
+
+class FeatureStoreWriter(object):
+    """
+    Appends arrays to a new store. Both files are written under temporary names
+    and only moved into place by close(), so an interrupted write never leaves a
+    partial store behind.
+
+    With append=True, the arrays are instead appended to the .bin of an
+    existing store and close() replaces its index, so adding to a large store
+    costs only the new arrays. Bytes past the last indexed array, left by an
+    interrupted append, are dropped before appending.
+    """
+    def __init__(self, path, dtype, append=False):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.tmp_suffix = '.{}.tmp'.format(os.getpid())
+        self.keys = []
+        self.offsets = []
+        self.shapes = []
+        self.offset = 0
+        self.appending = append and FeatureStore.exists(path)
+        if self.appending:
+            with open(path + '.index.json') as f:
+                index = json.load(f)
+            if np.dtype(index['dtype']) != self.dtype:
+                raise Exception("Can't append {} arrays to the {} store {}".format(self.dtype, index['dtype'], path))
+            self.keys, self.offsets, self.shapes = index['keys'], index['offsets'], index['shapes']
+            if len(self.keys) > 0:
+                self.offset = self.offsets[-1] + int(np.prod(self.shapes[-1]))
+            self.data_path = path + '.bin'
+            self.data_file = open(self.data_path, 'r+b')
+            self.data_file.truncate(self.offset * self.dtype.itemsize)
+            self.data_file.seek(0, os.SEEK_END)
+        else:
+            self.data_path = path + '.bin' + self.tmp_suffix
+            self.data_file = open(self.data_path, 'wb')
+
+    def add(self, key, array):
+        array = np.ascontiguousarray(array, dtype=self.dtype)
+        self.data_file.write(array.tobytes())
+        self.keys.append(key)
+        self.offsets.append(self.offset)
+        self.shapes.append(list(array.shape))
+        self.offset += array.size
+
+    def close(self):
+        self.data_file.close()
+        with open(self.path + '.index.json' + self.tmp_suffix, 'w') as f:
+            json.dump({'dtype': self.dtype.name, 'keys': self.keys, 'offsets': self.offsets, 'shapes': self.shapes}, f)
+        if not self.appending:
+            os.replace(self.data_path, self.path + '.bin')
+        os.replace(self.path + '.index.json' + self.tmp_suffix, self.path + '.index.json')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.data_file.close()
+            if not self.appending:
+                os.remove(self.data_path)
+
+
+class MatrixStore(object):
+    """
+    Read-only access to a packed (rows x features) matrix with one row per
+    utterance, indexed by (dialogue id, utterance id). Row 0 is all zeros and
+    stands in for every utterance that is not in the store.
+
+    A store at `path` consists of path.bin with the rows back to back and
+    path.index.json with the dtype, the number of features and the dialogue
+    and utterance id of rows 1 onwards.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path + '.index.json') as f:
+            index = json.load(f)
+        self.dtype = np.dtype(index['dtype'])
+        self.dialogue_ids = np.asarray(index['dialogue_ids'], dtype=np.int64)
+        self.utterance_ids = np.asarray(index['utterance_ids'], dtype=np.int64)
+        self.num_features = index['num_features']
+        if self.num_features > 0:
+            self.data = np.memmap(path + '.bin', dtype=self.dtype, mode='c', shape=(len(self.dialogue_ids) + 1, self.num_features))
+        else:
+            self.data = np.zeros((1, 0), dtype=self.dtype)
+        keys = self.get_keys(self.dialogue_ids, self.utterance_ids)
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(path + '.index.json') and os.path.exists(path + '.bin')
+
+    @staticmethod
+    def get_keys(dialogue_ids, utterance_ids):
+        return (np.asarray(dialogue_ids, dtype=np.int64) << 32) | np.asarray(utterance_ids, dtype=np.int64)
+
+    def __contains__(self, key):
+        return self.rows([key[0]], [key[1]])[0] != 0
+
+    def __len__(self):
+        return len(self.dialogue_ids)
+
+    def rows(self, dialogue_ids, utterance_ids):
+        """
+        Returns the row of each (dialogue id, utterance id) pair, 0 for the
+        pairs that are not in the store
+        """
+        keys = self.get_keys(dialogue_ids, utterance_ids)
+        if len(self.sorted_keys) == 0:
+            return np.zeros(len(keys), dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.sorted_keys, keys), len(self.sorted_keys) - 1)
+        found = self.sorted_keys[positions] == keys
+        return np.where(found, self.order[positions] + 1, 0)
+
+    def get(self, dialogue_id, utterance_id):
+        """
+        Returns the row of an utterance as a view into the memmap
+        """
+        return self.data[self.rows([dialogue_id], [utterance_id])[0]]
+
+
+class MatrixStoreWriter(object):
+    """
+    Appends rows to a new MatrixStore, moving it into place on close() like
+    FeatureStoreWriter, or with append=True to an existing one.
+    """
+    def __init__(self, path, dtype='float32', append=False):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.tmp_suffix = '.{}.tmp'.format(os.getpid())
+        self.dialogue_ids = []
+        self.utterance_ids = []
+        self.num_features = None
+        self.appending = append and MatrixStore.exists(path)
+        if self.appending:
+            with open(path + '.index.json') as f:
+                index = json.load(f)
+            if np.dtype(index['dtype']) != self.dtype:
+                raise Exception("Can't append {} rows to the {} store {}".format(self.dtype, index['dtype'], path))
+            self.dialogue_ids, self.utterance_ids = index['dialogue_ids'], index['utterance_ids']
+            self.num_features = index['num_features'] or None
+            num_rows = len(self.dialogue_ids) + 1 if self.num_features is not None else 0
+            self.data_path = path + '.bin'
+            self.data_file = open(self.data_path, 'r+b')
+            self.data_file.truncate(num_rows * (self.num_features or 0) * self.dtype.itemsize)
+            self.data_file.seek(0, os.SEEK_END)
+        else:
+            self.data_path = path + '.bin' + self.tmp_suffix
+            self.data_file = open(self.data_path, 'wb')
+
+    def add(self, dialogue_id, utterance_id, row):
+        row = np.ascontiguousarray(row, dtype=self.dtype).reshape(-1)
+        if self.num_features is None:
+            self.num_features = len(row)
+            self.data_file.write(np.zeros(self.num_features, dtype=self.dtype).tobytes())
+        elif len(row) != self.num_features:
+            raise Exception("Row of dialogue: {}, utterance: {} has {} features, expected {}".format(
+                dialogue_id, utterance_id, len(row), self.num_features))
+        self.data_file.write(row.tobytes())
+        self.dialogue_ids.append(int(dialogue_id))
+        self.utterance_ids.append(int(utterance_id))
+
+    def close(self):
+        self.data_file.close()
+        with open(self.path + '.index.json' + self.tmp_suffix, 'w') as f:
+            json.dump({'dtype': self.dtype.name, 'num_features': self.num_features or 0,
+                       'dialogue_ids': self.dialogue_ids, 'utterance_ids': self.utterance_ids}, f)
+        if not self.appending:
+            os.replace(self.data_path, self.path + '.bin')
+        os.replace(self.path + '.index.json' + self.tmp_suffix, self.path + '.index.json')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.data_file.close()
+            if not self.appending:
+                os.remove(self.data_path)
@@ -1,17 +1,19 @@
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from dataset import MELDDataset, Utterance
+from dataset import MELDDataset, Utterance, DevicePrefetcher, get_data_loader, get_audio_store_path, load_audio_embeddings, load_audio_store
 import pickle
 from dummy_model import DummyModel
+from feature_store import MatrixStore
 from torch.utils.data import DataLoader
 from models.config import Config
 from models.dialogue_gcn import DialogueGCN
+from models.visual_features import set_face_model_device
 
 from torch.utils.data import ConcatDataset
 from sklearn.metrics import f1_score, confusion_matrix
 from models.expression_detector import ExpressionDetector, AttentionConvWrapper
-from models.sentiment_model import BERTGRUSentiment
+from models.sentiment_model import build_sentiment_model
 from transformers import BertModel, BertTokenizer
 
 
@@ -25,8 +27,19 @@ num_epochs = int(sys.argv[5])
 model_name = sys.argv[6]
 run_id = sys.argv[7]
 config = Config(use_texts, use_our_audio, use_meld_audio, num_epochs, use_visual)
-
-if config.use_our_audio:
+config.setup_device()
+# the face models of the main process follow the training device, loader workers use config.loader_face_device
+set_face_model_device(config.device)
+
+if config.use_our_audio and config.audio_features_name is not None:
+    # only the stores of extract_audio_features.py exist for these, there is no pickle to fall back on
+    audio_store_paths = [get_audio_store_path(config.audio_features_name + ".pkl", split) for split in ["train", "val", "test"]]
+    for store_path in audio_store_paths:
+        if not MatrixStore.exists(store_path):
+            raise Exception("No audio features at {}, run extract_audio_features.py --name {}".format(
+                store_path, config.audio_features_name))
+    train_audio_emb, val_audio_emb, test_audio_emb = [load_audio_store(store_path, True) for store_path in audio_store_paths]
+elif config.use_our_audio:
     if config.use_clean_audio:
         audio_embed_path_train = "../MELD.Raw/train_audio_clean.pkl"
         audio_embed_path_val = "../MELD.Raw/val_audio_clean.pkl"
@@ -35,18 +48,23 @@ if config.use_our_audio:
         audio_embed_path_train = "../MELD.Raw/train_audio.pkl"
         audio_embed_path_val = "../MELD.Raw/dev_audio.pkl"
         audio_embed_path_test = "../MELD.Raw/test_audio.pkl"
-    train_audio_emb = pickle.load(open(audio_embed_path_train, 'rb'))
-    val_audio_emb = pickle.load(open(audio_embed_path_val, 'rb'))
-    test_audio_emb = pickle.load(open(audio_embed_path_test, 'rb'))
+    # memory-mapped when convert_audio_features.py has been run on the pickles
+    train_audio_emb = load_audio_embeddings(audio_embed_path_train, use_our_audio=True)
+    val_audio_emb = load_audio_embeddings(audio_embed_path_val, use_our_audio=True)
+    test_audio_emb = load_audio_embeddings(audio_embed_path_test, use_our_audio=True)
 else:    
     audio_embed_path = "../MELD.Raw/audio_embeddings_feature_selection_emotion.pkl"
     #audio_embed_path = "../MELD.Raw/audio_embeddings_feature_selection_sentiment.pkl"
-    train_audio_emb, val_audio_emb, test_audio_emb = pickle.load(open(audio_embed_path, 'rb'))
+    train_audio_emb, val_audio_emb, test_audio_emb = load_audio_embeddings(audio_embed_path, False, ["train", "val", "test"])
 
 train_dataset = MELDDataset("../MELD.Raw/train_sent_emo.csv", "../MELD.Raw/train_splits/", train_audio_emb, name="train", config=config, )
 val_dataset = MELDDataset("../MELD.Raw/dev_sent_emo.csv", "../MELD.Raw/dev_splits_complete/", val_audio_emb, name="val", config=config)
 if use_our_audio or use_meld_audio:
-    params = train_dataset.find_audio_stats(use_our_audio)
+    # fitted once per set of training features, then read from ./cache/audio_params
+    params = train_dataset.get_audio_stats(use_our_audio)
+    config.audio_in_dim = MELDDataset.get_audio_dim(params, use_our_audio)
+    # kept for scoring new dialogues with score_dialogues.py
+    pickle.dump(params, open("model_saves/audio_params_" + run_id + ".pkl", 'wb'))
     train_dataset.apply_audio_transform(params, use_our_audio)
     val_dataset.apply_audio_transform(params, use_our_audio)
 
@@ -85,11 +103,11 @@ def train_and_validate(model_name, model, optimiser, loss_emotion, loss_sentimen
             emotion_target_labels.append(torch.cat(val_batch_labels[0],0))
             sentiment_target_labels.append(torch.cat(val_batch_labels[1],0))
 
-        emotion_predicted_labels = torch.cat(emotion_predicted_labels, 0).cuda()
-        sentiment_predicted_labels = torch.cat(sentiment_predicted_labels, 0).cuda()
+        emotion_predicted_labels = torch.cat(emotion_predicted_labels, 0)
+        sentiment_predicted_labels = torch.cat(sentiment_predicted_labels, 0)
         emotion_target_labels = torch.cat(emotion_target_labels, 0)
         sentiment_target_labels = torch.cat(sentiment_target_labels, 0)
-        target_labels = torch.cat([emotion_target_labels.unsqueeze(1), sentiment_target_labels.unsqueeze(1)], 1).cuda()
+        target_labels = torch.cat([emotion_target_labels.unsqueeze(1), sentiment_target_labels.unsqueeze(1)], 1).to(config.device)
 
         emotion_f1_score = f1_score(emotion_target_labels.cpu().numpy(), emotion_predicted_labels.cpu().numpy(), average='weighted')        
 
@@ -106,6 +124,7 @@ def train_and_validate(model_name, model, optimiser, loss_emotion, loss_sentimen
         #    best_emotion_accuracy_so_far = (emotion_correct_count / val_count)
         torch.save({
             'epoch': epoch,
+            'config': vars(config),
             'model_state_dict': model.state_dict(),
             'optimizer_state_dict': optimiser.state_dict(),
             'loss': total_epoch_loss
@@ -199,11 +218,11 @@ def test_model(model_name, model, test_loader):
         emotion_target_labels.append(torch.cat(test_batch_labels[0],0))
         sentiment_target_labels.append(torch.cat(test_batch_labels[1],0))
 
-    emotion_predicted_labels = torch.cat(emotion_predicted_labels, 0).cuda()
-    sentiment_predicted_labels = torch.cat(sentiment_predicted_labels, 0).cuda()
+    emotion_predicted_labels = torch.cat(emotion_predicted_labels, 0)
+    sentiment_predicted_labels = torch.cat(sentiment_predicted_labels, 0)
     emotion_target_labels = torch.cat(emotion_target_labels, 0)
     sentiment_target_labels = torch.cat(sentiment_target_labels, 0)
-    target_labels = torch.cat([emotion_target_labels.unsqueeze(1), sentiment_target_labels.unsqueeze(1)], 1).cuda()
+    target_labels = torch.cat([emotion_target_labels.unsqueeze(1), sentiment_target_labels.unsqueeze(1)], 1).to(config.device)
 
     emotion_f1_score = f1_score(emotion_target_labels.cpu().numpy(), emotion_predicted_labels.cpu().numpy(), average='weighted')
     confusion = confusion_matrix(emotion_target_labels.cpu().numpy(), emotion_predicted_labels.cpu().numpy())
@@ -220,8 +239,9 @@ def test_model(model_name, model, test_loader):
 def train_step(model, input, target, loss_emotion, loss_sentiment, optimiser):
     """Trains model for one batch of data."""
     optimiser.zero_grad()
-    (batch_output_emotion, batch_output_sentiment) = model(input)
-    target = torch.LongTensor(target).to("cuda")
+    with config.autocast():
+        (batch_output_emotion, batch_output_sentiment) = model(input)
+    target = torch.LongTensor(target).to(config.device)
     batch_loss_emotion = loss_emotion(batch_output_emotion, target[0])
     #batch_loss_sentiment = loss_sentiment(batch_output_sentiment, target[1])
     total_loss = batch_loss_emotion# + batch_loss_sentiment
@@ -231,8 +251,9 @@ def train_step(model, input, target, loss_emotion, loss_sentiment, optimiser):
     return total_loss.item()
 
 def validate_step(model, input, target):
-    target = torch.LongTensor(target).to("cuda")
-    (output_logits_emotion, output_logits_sentiment) = model(input)
+    target = torch.LongTensor(target).to(config.device)
+    with config.autocast():
+        (output_logits_emotion, output_logits_sentiment) = model(input)
     output_labels_emotion = torch.argmax(output_logits_emotion, dim=1)
     output_labels_sentiment = torch.argmax(output_logits_sentiment, dim=1)
     #emotion_accuracy_acc = torch.eq(output_labels_emotion, target[0]).sum()
@@ -241,8 +262,9 @@ def validate_step(model, input, target):
     return output_labels_emotion, output_labels_sentiment, target[0].size()
 
 def test_step(model, input, target):
-    target = torch.LongTensor(target).to("cuda")
-    (output_logits_emotion, output_logits_sentiment) = model(input)
+    target = torch.LongTensor(target).to(config.device)
+    with config.autocast():
+        (output_logits_emotion, output_logits_sentiment) = model(input)
     output_labels_emotion = torch.argmax(output_logits_emotion, dim=1)
     output_labels_sentiment = torch.argmax(output_logits_sentiment, dim=1)
     #emotion_accuracy_acc = torch.eq(output_labels_emotion, target[0]).sum()
@@ -254,23 +276,15 @@ emotion_criterion = nn.CrossEntropyLoss()
 sentiment_criterion = nn.CrossEntropyLoss()
 model_name = "audio_text_ours"
 
-train_loader = DataLoader(train_dataset, batch_size=1, shuffle=True)
-val_loader = DataLoader(val_dataset, batch_size=1, shuffle=True)
-test_loader = DataLoader(test_dataset, batch_size=1, shuffle=True)
+train_loader = get_data_loader(train_dataset, config)
+val_loader = get_data_loader(val_dataset, config)
+test_loader = get_data_loader(test_dataset, config)
+if config.overlap_transfers:
+    train_loader, val_loader, test_loader = [DevicePrefetcher(loader, config.device) for loader in [train_loader, val_loader, test_loader]]
 bert = BertModel.from_pretrained('bert-base-uncased')
 
 if config.use_sentiment:
-    HIDDEN_DIM = 256
-    OUTPUT_DIM = 1
-    N_LAYERS = 2
-    BIDIRECTIONAL = True
-    DROPOUT = 0
-    sentiment_model = BERTGRUSentiment(bert,
-                         HIDDEN_DIM,
-                         OUTPUT_DIM,
-                         N_LAYERS,
-                         BIDIRECTIONAL,
-                         DROPOUT)    
+    sentiment_model = build_sentiment_model(bert)
     sentiment_model.load_state_dict(torch.load('models/sentiment_model.pt'))
     for param in sentiment_model.parameters():
         param.requires_grad = False
@@ -279,13 +293,13 @@ else:
 
 if config.model_type == 'dialoguegcn':
     model = DialogueGCN(config, bert, sentiment_model)
-    model = model.to("cuda")
+    model = model.to(config.device)
 elif config.model_type == 'fan':
-    model = ExpressionDetector(config.fan_weights_path, config.face_matching)
-    model = model.to("cuda")
+    model = ExpressionDetector(config.fan_weights_path, config.face_matching, device=config.device)
+    model = model.to(config.device)
 elif config.model_type == 'acn':
-    model = AttentionConvWrapper()
-    model = model.to("cuda")
+    model = AttentionConvWrapper(device=config.device)
+    model = model.to(config.device)
 if config.model_type == 'dummy':
     model = DummyModel()
 
@@ -312,4 +326,4 @@ for i in range(1):
     
     train_and_validate(model_name + str(i), model, optimisation_unit, emotion_criterion, sentiment_criterion, train_loader, val_loader)
     test_model(model_name + str(i), model, test_loader)
-torch.save({'model_state_dict': model.state_dict()}, 'model_saves/' + model_name + "_" + run_id)
\ No newline at end of file
+torch.save({'model_state_dict': model.state_dict(), 'config': vars(config)}, 'model_saves/' + model_name + "_" + run_id)
\ No newline at end of file
@@ -0,0 +1,91 @@
+"""
+Module for extracting acoustic features from the audio track of the clips.
+"""
+import subprocess
+
+import numpy as np
+
+
+def decode_audio(file_path, sample_rate=16000):
+    """
+    Decodes the audio track of a media file to mono float32 PCM in [-1, 1]
+    with ffmpeg, straight into memory without an intermediate .wav file.
+    Returns an empty array for clips without an audio track.
+    """
+    command = ['ffmpeg', '-nostdin', '-v', 'error', '-i', file_path, '-vn', '-f', 's16le', '-acodec', 'pcm_s16le',
+               '-ac', '1', '-ar', str(sample_rate), '-']
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise Exception("ffmpeg could not decode {}: {}".format(file_path, result.stderr.decode(errors='replace').strip()))
+    return np.frombuffer(result.stdout, dtype=np.int16).astype(np.float32) / 32768
+
+
+# mel filterbanks built so far, keyed by (sample rate, fft size, number of bands)
+mel_filterbanks = {}
+
+def get_mel_filterbank(sample_rate, n_fft, n_mels):
+    """
+    Returns the (n_fft // 2 + 1 x n_mels) matrix of triangular filters spaced
+    evenly on the mel scale between 0 Hz and the Nyquist frequency
+    """
+    key = (sample_rate, n_fft, n_mels)
+    if key not in mel_filterbanks:
+        mel_edges = np.linspace(0, 2595 * np.log10(1 + sample_rate / 2 / 700), n_mels + 2)
+        hz_edges = 700 * (10 ** (mel_edges / 2595) - 1)
+        bins = np.fft.rfftfreq(n_fft, 1 / sample_rate)
+        lower, center, upper = hz_edges[:-2, None], hz_edges[1:-1, None], hz_edges[2:, None]
+        rising = (bins - lower) / (center - lower)
+        falling = (upper - bins) / (upper - center)
+        mel_filterbanks[key] = np.maximum(0, np.minimum(rising, falling)).T.astype(np.float32)
+    return mel_filterbanks[key]
+
+
+def frame_features(pcm, sample_rate=16000, frame_length=0.025, hop_length=0.01, n_mels=40):
+    """
+    Computes frame-level features of a mono signal: the log mel energies, the
+    log energy, the zero-crossing rate and the spectral centroid of every
+    frame, in one vectorised pass over all frames.
+
+    Inputs:
+        pcm(np.array(float32)): the signal
+        sample_rate(int): samples per second of the signal
+        frame_length(float): seconds per frame
+        hop_length(float): seconds between the starts of two frames
+        n_mels(int): number of mel bands
+
+    Output:
+        np.array(frames, n_mels + 3) float32, at least one frame
+    """
+    frame_size = int(round(frame_length * sample_rate))
+    hop_size = int(round(hop_length * sample_rate))
+    if len(pcm) < frame_size:
+        pcm = np.pad(pcm, (0, frame_size - len(pcm)))
+    frames = np.lib.stride_tricks.sliding_window_view(pcm, frame_size)[::hop_size]
+
+    n_fft = 1 << (frame_size - 1).bit_length()
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(frame_size).astype(np.float32), n=n_fft)) ** 2
+    log_mel = np.log(spectrum @ get_mel_filterbank(sample_rate, n_fft, n_mels) + 1e-10)
+    log_energy = np.log(np.mean(frames ** 2, axis=1) + 1e-10)
+    zero_crossings = np.mean(np.abs(np.diff(np.signbit(frames), axis=1)), axis=1)
+    bins = np.fft.rfftfreq(n_fft, 1 / sample_rate)
+    centroid = (spectrum @ bins) / (np.sum(spectrum, axis=1) + 1e-10) / (sample_rate / 2)
+    return np.column_stack([log_mel, log_energy, zero_crossings, centroid]).astype(np.float32)
+
+
+def pool_features(frames):
+    """
+    Summarises (frames x features) frame-level features into one fixed-size
+    vector: the mean, standard deviation, minimum and maximum of every feature
+    and the mean absolute difference between consecutive frames.
+    """
+    deltas = np.abs(np.diff(frames, axis=0)).mean(axis=0) if len(frames) > 1 else np.zeros(frames.shape[1], dtype=frames.dtype)
+    return np.concatenate([frames.mean(axis=0), frames.std(axis=0), frames.min(axis=0), frames.max(axis=0), deltas]).astype(np.float32)
+
+
+def extract_audio_features(file_path, sample_rate=16000, n_mels=40):
+    """
+    Returns the (pooled features, frame-level features) of the audio track of
+    a clip
+    """
+    frames = frame_features(decode_audio(file_path, sample_rate), sample_rate, n_mels=n_mels)
+    return pool_features(frames), frames
@@ -1,3 +1,6 @@
+import torch
+
+
 class Config:
     def __init__(self, use_texts, use_our_audio, use_meld_audio, num_epochs, use_visual):
         self.text_in_dim = 768
@@ -15,6 +18,8 @@ class Config:
         self.face_matching = True
         self.utt_embed_size = 100
         self.att_window_size = 10
+        # dialogues per optimisation step
+        self.batch_size = 1
         self.lr=0.0005 
         self.l2=0.00001
         self.eval_on_test=True
@@ -24,9 +29,57 @@ class Config:
         if use_meld_audio == True and use_our_audio == True:
             raise Exception("Can't use both our and MELD audio")
         self.use_clean_audio=False
+        # name of the stores extract_audio_features.py wrote, used as our audio instead of the openSMILE pickles
+        self.audio_features_name = None
         self.use_sentiment=False
+        # read the BERT hidden states from the store built by build_text_cache.py
+        self.use_text_cache=False
+        # tokenize the transcripts once in the dataset and cache the token ids on disk
+        self.use_token_cache=True
+        if self.use_text_cache and self.use_sentiment:
+            raise Exception("The sentiment model needs token ids, it can't be used with the text cache")
         self.use_texts=use_texts
         self.use_visual=use_visual
         self.visual_features=use_visual
+        # device and precision every model runs in, the CPU unless a GPU is available
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        # float32, or bfloat16/float16 to run the models under autocast
+        self.precision = "float32"
+        # intra-op and inter-op CPU threads, None keeps the torch defaults
+        self.num_threads = None
+        self.num_interop_threads = None
+        # DataLoader worker processes, 0 loads the dialogues on the training thread
+        self.num_workers = 0
+        # batches each worker loads ahead
+        self.prefetch_factor = 2
+        # collate into page-locked memory, only used on cuda
+        self.pin_memory = True
+        # copy the next batch to the device on a side stream while the current one runs
+        self.overlap_transfers = False
+        # device of the face models of DataLoader workers, which can't use cuda in forked processes
+        self.loader_face_device = "cpu"
         #self.save_model=True
 
+    def setup_device(self):
+        """
+        Applies the CPU thread settings, to be called before the first model runs
+        """
+        if torch.device(self.device).type != "cpu":
+            return
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+        if self.num_interop_threads is not None:
+            try:
+                torch.set_num_interop_threads(self.num_interop_threads)
+            except RuntimeError:
+                # can only be set once, before any inter-op parallel work
+                print("Inter-op threads already in use, keeping", torch.get_num_interop_threads())
+        # denormal floats are very slow on x86 CPUs
+        torch.set_flush_denormal(True)
+
+    def autocast(self):
+        """
+        Returns the autocast context of the configured precision
+        """
+        return torch.autocast(torch.device(self.device).type, dtype=getattr(torch, self.precision),
+                              enabled=self.precision != "float32")
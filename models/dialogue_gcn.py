@@ -1,12 +1,103 @@
 import torch
 from torch import nn
 import numpy as np
-from models.dialogue_gcn_cell import GraphConvolution
+from models.dialogue_gcn_cell import GraphConvolution, relation_graph_convolution
 from torch.nn.parameter import Parameter
-from transformers import BertModel, BertTokenizer
-from torch.nn.utils.rnn import pad_sequence, pack_padded_sequence, pad_packed_sequence, PackedSequence
+from transformers import BertModel
+from torch.nn.utils.rnn import pad_sequence, pack_padded_sequence, pack_sequence, pad_packed_sequence, PackedSequence
 from models.visual_features import FaceModule
 from models.expression_detector import ExpressionDetector
+from models.text_features import encode_transcripts, get_tokenizer
+
+
+# band masks of the attention window and their (i, j) pairs, keyed by
+# (number of utterances, window size, device)
+window_masks = {}
+window_edges = {}
+
+def get_window_mask(num_utts, window_size, device):
+    """
+    Returns the N x N bool mask that is true where |i - j| <= window_size
+    """
+    key = (num_utts, window_size, str(device))
+    if key not in window_masks:
+        idx = torch.arange(num_utts, device=device)
+        window_masks[key] = (idx.unsqueeze(0) - idx.unsqueeze(1)).abs() <= window_size
+    return window_masks[key]
+
+def window_attention(ut_embs, window_size):
+    """
+    Edge attention of DialogueGCN: dot products between the utterances within
+    window_size of each other, softmaxed over each row.
+
+    Entries outside the window are 0 before the softmax, not -inf, so they keep
+    a small weight, as in the original per-entry loop.
+    """
+    mask = get_window_mask(len(ut_embs), window_size, ut_embs.device)
+    attn = torch.matmul(ut_embs, ut_embs.t()).masked_fill(~mask, 0)
+    return torch.softmax(attn, dim=1)
+
+def get_window_edges(num_utts, window_size, device):
+    """
+    Returns the (i, j) pairs with |i - j| <= window_size in row-major order
+    """
+    key = (num_utts, window_size, str(device))
+    if key not in window_edges:
+        dst, src = get_window_mask(num_utts, window_size, device).nonzero(as_tuple=True)
+        window_edges[key] = (dst, src)
+    return window_edges[key]
+
+def get_block_window_edges(dialogue_lengths, window_size, device):
+    """
+    Returns the window edges of several dialogues stored back to back, i.e. the
+    block-diagonal union of their get_window_edges, and the number of
+    utterances in the dialogue of each node
+    """
+    if len(dialogue_lengths) == 1:
+        dst, src = get_window_edges(dialogue_lengths[0], window_size, device)
+        return dst, src, dialogue_lengths[0]
+    dsts = []
+    srcs = []
+    offset = 0
+    for num_utts in dialogue_lengths:
+        dst, src = get_window_edges(num_utts, window_size, device)
+        dsts.append(dst + offset)
+        srcs.append(src + offset)
+        offset += num_utts
+    dialogue_lengths = torch.tensor(dialogue_lengths, device=device)
+    return torch.cat(dsts), torch.cat(srcs), torch.repeat_interleave(dialogue_lengths, dialogue_lengths)
+
+def window_edge_attention(ut_embs, dst, src, num_utts=None):
+    """
+    The entries of window_attention on the given window edges, computed from
+    the edges only. The entries outside the window, which are exp(0) before
+    normalisation, are accounted for in each row's normaliser by count.
+    num_utts is the length of the dialogue of each node when ut_embs holds
+    several dialogues, by default all nodes belong to one dialogue.
+    """
+    if num_utts is None:
+        num_utts = len(ut_embs)
+    scores = (ut_embs.index_select(0, dst) * ut_embs.index_select(0, src)).sum(dim=1)
+    outside = num_utts - torch.bincount(dst, minlength=len(ut_embs))
+    with torch.no_grad():
+        row_max = scores.new_full((len(ut_embs),), float('-inf')).scatter_reduce(0, dst, scores, 'amax')
+        row_max = torch.where(outside > 0, row_max.clamp_min(0), row_max)
+    exp_scores = torch.exp(scores - row_max.index_select(0, dst))
+    norm = scores.new_zeros(len(ut_embs)).index_add_(0, dst, exp_scores) + outside * torch.exp(-row_max)
+    return exp_scores / norm.index_select(0, dst)
+
+
+def encode_context(context_encoder, indept_embeds, dialogue_lengths):
+    """
+    Runs the context GRU over several dialogues stored back to back in the
+    (1 x N x D) indept_embeds, packed so that no dialogue sees another one or
+    any padding. Returns the N x D' outputs in the same order.
+    """
+    dialogues = torch.split(indept_embeds.squeeze(0), dialogue_lengths.tolist())
+    packed = pack_sequence(dialogues, enforce_sorted=False)
+    encoded, lengths = pad_packed_sequence(context_encoder(packed)[0], batch_first=True)
+    mask = torch.arange(encoded.size(1)).unsqueeze(0) < lengths.unsqueeze(1)
+    return encoded[mask.to(encoded.device)]
 
 
 class DialogueGCN(nn.Module):
@@ -14,6 +105,7 @@ class DialogueGCN(nn.Module):
     def __init__(self, config, bert, sentiment_model):
         super(DialogueGCN, self).__init__()
         self.config = config
+        self.device = config.device
         self.sentiment_model = sentiment_model
         self.utt_embed_size = config.utt_embed_size
         self.text_encoder = nn.GRU(config.text_in_dim, config.text_out_dim, bidirectional=True, batch_first=True)
@@ -52,21 +144,38 @@ class DialogueGCN(nn.Module):
         self.w_sentiment = nn.Linear(self.utt_embed_size*2, 7)
         self.w_visual = nn.Linear(512, 100)
         
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        if not config.use_token_cache:
+            self.tokenizer = get_tokenizer()
         self.bert = bert
         for param in self.bert.parameters():
             param.requires_grad = False
 
-        self.visual_model = ExpressionDetector(config.fan_weights_path, face_matching=True)
+        self.visual_model = ExpressionDetector(config.fan_weights_path, face_matching=True, device=config.device)
 
     def forward(self, x):
-        transcripts, video, audio, speakers = x
+        # batches of several dialogues (see dataset.collate_dialogues) hold the
+        # utterances of all of them back to back plus the length of each dialogue
+        transcripts, video, audio, speakers = x[:4]
+        dialogue_lengths = x[4] if len(x) > 4 else None
         speakers.squeeze_(0)
+        indept_embeds = self.embed_utterances(transcripts, video, audio)
+        if dialogue_lengths is None:
+            context_embeds = self.context_encoder(indept_embeds)[0].squeeze(0)
+        else:
+            context_embeds = encode_context(self.context_encoder, indept_embeds, dialogue_lengths)
+        edges, self_attn = self.construct_edges_relations(context_embeds, speakers, dialogue_lengths)
+        return self.classify(context_embeds, edges, self_attn)
+
+    def embed_utterances(self, transcripts, video, audio):
+        """
+        Returns the (1 x N x D) context-independent embeddings of the utterances
+        from each modality in use
+        """
         indept_embeds = None
         if self.config.use_texts:
             indept_embeds = self.embed_text(transcripts)
         if self.config.use_meld_audio:
-            audio = torch.cat(audio).unsqueeze(0).float().to('cuda')
+            audio = torch.cat(audio).unsqueeze(0).float().to(self.device)
             audio = torch.relu(self.audio_W(audio))
             if self.config.use_texts:
                 indept_embeds = torch.cat([indept_embeds, audio], dim=2)
@@ -74,7 +183,7 @@ class DialogueGCN(nn.Module):
                 indept_embeds = audio            
         elif self.config.use_our_audio:
             audio = [pair[0][0] for pair in audio]
-            audio = torch.stack(audio, dim=1).float().to('cuda').t()
+            audio = torch.stack(audio, dim=1).float().to(self.device).t()
             audio = torch.relu(self.audio_W(audio)).unsqueeze(0)     
             if self.config.use_texts:
                 indept_embeds = torch.cat([indept_embeds, audio], dim=2)
@@ -86,22 +195,20 @@ class DialogueGCN(nn.Module):
                 indept_embeds = torch.cat([indept_embeds, self.w_visual(visual_embeds.unsqueeze(0))], dim=2)
             else:
                 indept_embeds = self.w_visual(visual_embeds.unsqueeze(0))
-            
-        context_embeds = self.context_encoder(indept_embeds)[0].squeeze(0)
-        relation_matrices = self.construct_edges_relations(context_embeds, speakers)
-        
-        pred_adj, suc_adj, same_speak_adj, diff_adj_matrix, attn = relation_matrices
-        
-        h1 = self.pred_rel_l1(context_embeds, pred_adj)
-        h1 += self.suc_rel_l1(context_embeds, suc_adj)
-        h1 += self.same_speak_rel_l1(context_embeds, same_speak_adj)
-        h1 += self.diff_speak_rel_l1(context_embeds, diff_adj_matrix)
-        h1 = torch.relu(h1 + torch.matmul(context_embeds, self.w_aggr_1) * attn.diag().unsqueeze(1))
-        h2 = self.pred_rel_l2(h1, pred_adj)
-        h2 += self.suc_rel_l2(h1, suc_adj)
-        h2 += self.same_speak_rel_l2(h1, same_speak_adj)
-        h2 += self.diff_speak_rel_l2(h1, diff_adj_matrix)
-        h2 = torch.relu(h2 + torch.matmul(h1, self.w_aggr_2) * attn.diag().unsqueeze(1))
+        return indept_embeds
+
+    def classify(self, context_embeds, edges, self_attn):
+        """
+        Runs the two relational GCN layers over the utterance graph and returns
+        the emotion and sentiment logits of every node
+        """
+        # relation types 0-3 of construct_edges_relations, in order
+        layers_1 = [self.pred_rel_l1, self.suc_rel_l1, self.same_speak_rel_l1, self.diff_speak_rel_l1]
+        layers_2 = [self.pred_rel_l2, self.suc_rel_l2, self.same_speak_rel_l2, self.diff_speak_rel_l2]
+        h1 = relation_graph_convolution(context_embeds, layers_1, edges)
+        h1 = torch.relu(h1 + torch.matmul(context_embeds, self.w_aggr_1) * self_attn.unsqueeze(1))
+        h2 = relation_graph_convolution(h1, layers_2, edges)
+        h2 = torch.relu(h2 + torch.matmul(h1, self.w_aggr_2) * self_attn.unsqueeze(1))
         
         h = torch.cat([h2, context_embeds], dim=1)
         
@@ -112,22 +219,31 @@ class DialogueGCN(nn.Module):
         #   N - number of utterances
         #   L - length of longest (in # of words) utterance
         #   G - dimention of Glove embeddings
-        lengths = []
-        texts = []
         if self.config.use_sentiment:
             sentiment_scores = []
-        for i, utt in enumerate(utterances):
-            input_ids = torch.tensor([self.tokenizer.encode(utt[0])]).to("cuda")
-            if self.config.use_sentiment:
-                sentiment_scores.append(self.w_embed_sentiment(self.sentiment_model(input_ids)[1]))
-            hidden_states = self.bert(input_ids)[0]
-            texts.append(hidden_states.squeeze(0))
-            lengths.append(hidden_states.size(1))
-        texts = pad_sequence(texts, batch_first=True)
-        lengths = torch.LongTensor(lengths)
-        # Sort utterance transcripts in decreasing order by the number of words
-        sorted_lengths, sorted_idx = lengths.sort(descending=True)
-        texts = texts[sorted_idx]
+        if self.config.use_text_cache or self.config.use_sentiment:
+            lengths = []
+            texts = []
+            for i, utt in enumerate(utterances):
+                if self.config.use_text_cache:
+                    # (1 x L x 768) hidden states precomputed by build_text_cache.py
+                    hidden_states = utt.to(self.device).float()
+                else:
+                    input_ids = self.get_token_ids(utt).unsqueeze(0).to(self.device)
+                    sentiment_scores.append(self.w_embed_sentiment(self.sentiment_model(input_ids)[1]))
+                    hidden_states = self.bert(input_ids)[0]
+                texts.append(hidden_states.squeeze(0))
+                lengths.append(hidden_states.size(1))
+            texts = pad_sequence(texts, batch_first=True)
+            lengths = torch.LongTensor(lengths)
+            # Sort utterance transcripts in decreasing order by the number of words
+            sorted_lengths, sorted_idx = lengths.sort(descending=True)
+            texts = texts[sorted_idx]
+        else:
+            # All transcripts of the dialogue go through BERT in length-bucketed batches,
+            # already padded and sorted in decreasing order by the number of words
+            input_ids = [self.get_token_ids(utt) for utt in utterances]
+            texts, sorted_lengths, sorted_idx = encode_transcripts(self.bert, input_ids, self.device)
         # Pack -> rnn -> unpack (to handle variable-length sequences)
         texts = pack_padded_sequence(texts, lengths=sorted_lengths, batch_first=True)
         encoded_text = pad_packed_sequence(self.text_encoder(texts)[0], batch_first=True)[0]
@@ -144,16 +260,22 @@ class DialogueGCN(nn.Module):
         _, orig_idx = sorted_idx.sort(0)
         encoded_text = encoded_text[orig_idx].unsqueeze(0)
         if self.config.use_sentiment:
-            sentiment_scores = torch.stack(sentiment_scores).to("cuda")
+            sentiment_scores = torch.stack(sentiment_scores).to(self.device)
             encoded_text = torch.cat([encoded_text, sentiment_scores.view(1, -1, 100)], dim=2)
         return encoded_text    
 
+    def get_token_ids(self, utt):
+        if self.config.use_token_cache:
+            # (1 x L) int32 ids tokenized by the dataset
+            return utt.squeeze(0).long()
+        return torch.tensor(self.tokenizer.encode(utt[0]))
+
     def embed_audio(self, audio):
         lengths = []
         audios = []
         for i, utt in enumerate(audio):
             utt = utt[0].squeeze(0).float()
-            audio_feat = torch.relu(self.audio_W(utt.to("cuda")))
+            audio_feat = torch.relu(self.audio_W(utt.to(self.device)))
             audios.append(audio_feat)
             lengths.append(audio_feat.size(0))
         audios = pad_sequence(audios, batch_first=True)
@@ -178,40 +300,36 @@ class DialogueGCN(nn.Module):
         encoded_audio = encoded_audio[orig_idx].unsqueeze(0)
         return encoded_audio    
     
-    def construct_edges_relations(self, ut_embs, speaker_ids):
+    def construct_edges_relations(self, ut_embs, speaker_ids, dialogue_lengths=None, num_utts=None):
         # ut_embs is a tensor of size N x D
         #   N - number of utterances
         #   D - dimention of utterance embedding
         # speaker is a list of size N corresponding
         #   to speaker ids for each utterance
-        num_utts = len(ut_embs)
-        raw_attn = self.edge_att_weights(ut_embs)
-        attn = torch.zeros(num_utts, num_utts).to("cuda")
-        for i in range(num_utts):
-            curr_utt = ut_embs[i]
-            left_bdry = max(0, i - self.config.att_window_size)
-            right_bdry = min(num_utts, i + self.config.att_window_size + 1)
-            for j in range(left_bdry, right_bdry):
-                attn[i, j] = curr_utt.dot(ut_embs[j])
-        attn = torch.softmax(attn, dim=1)
-        relation_matrices = self.build_relation_matrices(ut_embs, speaker_ids, attn)
-        return relation_matrices
-    
-    def build_relation_matrices(self, ut_embs, speaker_ids, attn_mask):
-        num_utt = len(ut_embs)
-        num_speakers = len(np.unique(speaker_ids))
-        pred_adj = torch.ones(num_utt, num_utt, dtype=torch.float).triu(0).to("cuda")
-        suc_adj = 1 - pred_adj
-        same_adj_matrix = torch.zeros(num_utt, num_utt, dtype=torch.long).to("cuda")
-        for i in range(num_speakers):
-            same_speak_indices = speaker_ids == i
-            same_adj_matrix[same_speak_indices] = same_speak_indices.long().to("cuda")
-        diff_adj_matrix = 1 - same_adj_matrix.byte()
-        same_adj_pred = same_adj_matrix.float() * pred_adj.float() * attn_mask
-        same_adj_post = same_adj_matrix.float() * suc_adj.float() * attn_mask
-        diff_adj_pred = diff_adj_matrix.float() * pred_adj.float() * attn_mask
-        diff_adj_post = diff_adj_matrix.float() * suc_adj.float() * attn_mask
-        return same_adj_pred, same_adj_post, diff_adj_pred, diff_adj_post, attn_mask
+        # dialogue_lengths optionally splits the N utterances into several
+        #   dialogues, whose graphs are then disjoint blocks of one graph
+        # num_utts optionally gives the length of the whole dialogue when
+        #   ut_embs only holds its last utterances (see StreamingSession)
+        # Returns the typed edge list (dst, src, relation, weight) between
+        # utterances within the attention window, and the attention of each
+        # utterance to itself. Relation types are
+        #   0 - same speaker, src at or after dst
+        #   1 - same speaker, src before dst
+        #   2 - different speaker, src at or after dst
+        #   3 - different speaker, src before dst
+        if dialogue_lengths is None:
+            dialogue_lengths = [len(ut_embs)]
+        else:
+            dialogue_lengths = dialogue_lengths.tolist()
+        dst, src, dialogue_sizes = get_block_window_edges(dialogue_lengths, self.config.att_window_size, ut_embs.device)
+        if num_utts is None:
+            num_utts = dialogue_sizes
+        weight = window_edge_attention(ut_embs, dst, src, num_utts)
+        speaker_ids = speaker_ids.to(ut_embs.device)
+        relation = 2 * (speaker_ids[dst] != speaker_ids[src]).long() + (src < dst).long()
+        # every node has exactly one self edge and edges are in row-major order
+        self_attn = weight[dst == src]
+        return (dst, src, relation, weight), self_attn
     
     """
         def __init__(self, config):
@@ -258,7 +376,7 @@ class DialogueGCN(nn.Module):
         if self.config.use_texts:
             indept_embeds = self.embed_text(transcripts)
         if self.config.use_our_audio:
-            audio_fixed = torch.cat(audio[0], dim=0).float().to('cuda')
+            audio_fixed = torch.cat(audio[0], dim=0).float().to(self.device)
             audio_fixed = self.audio_W_fixed_1(audio_fixed)
             if self.config.use_texts:
                 indept_embeds = torch.cat([indept_embeds, audio_fixed], dim=2)
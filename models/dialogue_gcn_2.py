@@ -55,7 +55,7 @@ class DialogueGCN(nn.Module):
             indept_embeds = self.embed_text(transcripts)
         if self.config.use_our_audio:
             audio = [audio[i][0] for i in range(len(audio))]
-            audio_fixed = torch.cat(audio, dim=0).float().to('cuda')
+            audio_fixed = torch.cat(audio, dim=0).float().to(self.config.device)
             audio_fixed = self.audio_W_fixed_1(audio_fixed).unsqueeze(0)
             if self.config.use_texts:
                 indept_embeds = torch.cat([indept_embeds, audio_fixed], dim=2)
@@ -86,7 +86,7 @@ class DialogueGCN(nn.Module):
         lengths = []
         texts = []
         for i, utt in enumerate(utterances):
-            input_ids = torch.tensor([self.tokenizer.encode(utt[0])]).to("cuda")
+            input_ids = torch.tensor([self.tokenizer.encode(utt[0])]).to(self.config.device)
             hidden_states = self.bert(input_ids)[0]
             texts.append(hidden_states.squeeze(0))
             lengths.append(hidden_states.size(1))
@@ -117,7 +117,7 @@ class DialogueGCN(nn.Module):
         audios = []
         for i, utt in enumerate(audio):
             utt = utt.squeeze(0)
-            audio_feat = self.audio_W_temp_2(torch.relu(self.audio_W_temp_1(utt.to("cuda"))))
+            audio_feat = self.audio_W_temp_2(torch.relu(self.audio_W_temp_1(utt.to(self.config.device))))
             audios.append(audio_feat)
             lengths.append(audio_feat.size(0))
         audios = pad_sequence(audios, batch_first=True)
@@ -151,7 +151,7 @@ class DialogueGCN(nn.Module):
         #   to speaker ids for each utterance
         num_utts = len(ut_embs)
         raw_attn = self.edge_att_weights(ut_embs)
-        attn = torch.zeros(num_utts, num_utts).to("cuda")
+        attn = torch.zeros(num_utts, num_utts).to(self.config.device)
         for i in range(num_utts):
             curr_utt = ut_embs[i]
             left_bdry = max(0, i - self.att_window_size)
@@ -165,12 +165,12 @@ class DialogueGCN(nn.Module):
     def build_relation_matrices(self, ut_embs, speaker_ids, attn_mask):
         num_utt = len(ut_embs)
         num_speakers = len(np.unique(speaker_ids))
-        pred_adj = torch.ones(num_utt, num_utt, dtype=torch.float).triu(0).to("cuda")
+        pred_adj = torch.ones(num_utt, num_utt, dtype=torch.float).triu(0).to(self.config.device)
         suc_adj = 1 - pred_adj
-        same_adj_matrix = torch.zeros(num_utt, num_utt, dtype=torch.long).to("cuda")
+        same_adj_matrix = torch.zeros(num_utt, num_utt, dtype=torch.long).to(self.config.device)
         for i in range(num_speakers):
             same_speak_indices = speaker_ids == i
-            same_adj_matrix[same_speak_indices] = same_speak_indices.long().to("cuda")
+            same_adj_matrix[same_speak_indices] = same_speak_indices.long().to(self.config.device)
         diff_adj_matrix = 1 - same_adj_matrix.byte()
         same_adj_pred = same_adj_matrix.float() * pred_adj.float() * attn_mask
         same_adj_post = same_adj_matrix.float() * suc_adj.float() * attn_mask
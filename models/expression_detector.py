@@ -49,8 +49,9 @@ def load_parameter(_structure, _parameterDir):
 
 class ExpressionDetector(torch.nn.Module):
 
-    def __init__(self, parameter_path, face_matching=False):
+    def __init__(self, parameter_path, face_matching=False, device="cuda"):
         super(ExpressionDetector, self).__init__()
+        self.device = device
         structure = frame_attention_network.resnet18_AT(at_type='self-attention') #or relation-attention
         #print(structure)
         parameter_dir = parameter_path
@@ -58,7 +59,10 @@ class ExpressionDetector(torch.nn.Module):
 
         self.face_matching = face_matching
         if self.face_matching:
+            # kept as a submodule so that saved state dicts still load, the
+            # embedder runs it on whatever device the detector is moved to
             self.resnet = InceptionResnetV1(pretrained='vggface2').eval()
+            self.face_embedder = visual_features.FaceEmbedder(model=self.resnet)
 
         self.attention_network = FCProj(512, 512)
         self.classifier = torch.nn.Linear(7,7) #FCProj(512, 7)
@@ -67,11 +71,13 @@ class ExpressionDetector(torch.nn.Module):
         #print(self.frame_attention_network)
         #self.face_detecor = visual_features.FaceModule()
 
-    def get_face_matchings(self, face_tensor):
+    def get_face_matchings(self, face_tensor, cache_key=None):
         """
         Method for generating face embeddings based on the Facenet model.
         Input:
             face_tensor(torch.tensor(N, F, C, W, H)): dimensions returned by the MTCNN detctor
+            cache_key: optional key (eg. the visual cache key of the utterance)
+                under which the embeddings of these crops are memoized
 
         Ouput:
             torch.tensor(N,F): N - number of frames, F face per frame
@@ -82,23 +88,15 @@ class ExpressionDetector(torch.nn.Module):
         _, N, F, C, W, H, = face_tensor.shape
         face_tensor = face_tensor.view(-1, C, W, H)
 
-        # Instantiate facenet model
-        resnet = InceptionResnetV1(pretrained='vggface2').eval()
-        # Generate the embeddings for all faces
-        embeddings = resnet(face_tensor).view(N, F, -1)
+        # Generate the embeddings for all faces in one batched pass
+        embeddings = self.face_embedder.embed(face_tensor, cache_key).view(N, F, -1).to(face_tensor.device)
 
-        # Create a similarity matrix comparing each face with each other face in 
-        # all possible frames 
+        # Create a similarity matrix comparing each face with each other face in
+        # all possible frames, sim_matrix[i, j, a, b] is the distance between
+        # face a of frame i and face b of frame j
 
-        sim_matrix = []
-        for idx, embedding_faces in enumerate(embeddings):
-            distances = embedding_faces.view(F, 1, 1, 512) - embeddings #torch.cat((embeddings[:idx], embeddings[idx + 1:]))
-            #distances is now shape (N - 1, F, F, 512) 
-
-            norms = torch.norm(distances, p=2, dim=3).permute(1, 0, 2)
-            sim_matrix.append(norms)
-
-        sim_matrix = torch.stack(sim_matrix)
+        flat = embeddings.view(N * F, -1)
+        sim_matrix = torch.cdist(flat, flat).view(N, F, N, F).permute(0, 2, 1, 3)
 
         #print(sim_matrix)
 
@@ -173,7 +171,7 @@ class ExpressionDetector(torch.nn.Module):
                 #    faces = self.get_face_matchings(faces)
 
                 _, N, F, C, W, H = faces.shape
-                faces = faces.view(F, N, C, W, H).cuda()
+                faces = faces.view(F, N, C, W, H).to(self.device).float()
                 #print("faces size", faces.size())
                 #print(faces.is_cuda)
                 #emotions = self.frame_attention_network(faces.squeeze(0))
@@ -190,12 +188,12 @@ class ExpressionDetector(torch.nn.Module):
                 #predicted_emotions = self.classifier(summed_emotions)
                 emotion_output.append(predicted_emotions.view(1, 512)) #summed_emotions.unsqueeze(0))
             else:
-                emotion_output.append(torch.zeros(1, 512).cuda())
+                emotion_output.append(torch.zeros(1, 512, device=self.device))
 
         #print(len(emotion_output))
 
         # placeholder:
-        sentiment_output = torch.zeros(len(emotion_output), 3).cuda()
+        sentiment_output = torch.zeros(len(emotion_output), 3, device=self.device)
         emotion_output = torch.cat(emotion_output, dim=0)
         #print("EMOTION", emotion_output.size())
         #print("SENTIMENT", sentiment_output.size())
@@ -203,8 +201,9 @@ class ExpressionDetector(torch.nn.Module):
 
 class AttentionConvWrapper(torch.nn.Module):
 
-    def __init__(self):
+    def __init__(self, device="cuda"):
         super(AttentionConvWrapper, self).__init__()
+        self.device = device
         self.model = attention_convolution_network.AttentionConvolutionNetwork()
 
     def forward(self, x):
@@ -217,7 +216,7 @@ class AttentionConvWrapper(torch.nn.Module):
         for faces in face_vector:
             _, N, F, C, W, H = faces.shape
 
-            face_stack = faces.squeeze(0).view(N * F, C, W, H).to("cuda")
+            face_stack = faces.squeeze(0).view(N * F, C, W, H).to(self.device).float()
 
             if N * F == 0:
                 pass
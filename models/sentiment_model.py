@@ -36,3 +36,11 @@ class BERTGRUSentiment(nn.Module):
         output = self.out(hidden)
         #output = [batch size, out dim]
         return output, hidden
+
+
+def build_sentiment_model(bert):
+    """
+    Returns the BERTGRUSentiment DialogueGCN uses when config.use_sentiment is
+    set, with the architecture of models/sentiment_model.pt
+    """
+    return BERTGRUSentiment(bert, hidden_dim=256, output_dim=1, n_layers=2, bidirectional=True, dropout=0)
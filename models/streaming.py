@@ -0,0 +1,138 @@
+"""
+Module for scoring live conversations with a trained DialogueGCN, one
+utterance at a time.
+"""
+import time
+from collections import deque
+
+import torch
+from torch import nn
+
+from models.text_features import tokenize_transcripts
+
+
+def split_gru_directions(gru):
+    """
+    Returns the forward and backward directions of a single layer
+    bidirectional GRU as two unidirectional GRUs sharing its weights
+    """
+    directions = []
+    for suffix in ['', '_reverse']:
+        direction = nn.GRU(gru.input_size, gru.hidden_size, batch_first=True)
+        for name in ['weight_ih_l0', 'weight_hh_l0', 'bias_ih_l0', 'bias_hh_l0']:
+            setattr(direction, name, getattr(gru, name + suffix))
+        directions.append(direction)
+    return directions
+
+
+class StreamingSession(object):
+    """
+    Scores the utterances of a live conversation as they arrive.
+
+    For each new utterance, only work that the new utterance changes is redone:
+
+        - its context-independent embedding is computed once and cached
+        - the forward direction of the context GRU continues from the cached
+          hidden state of the previous utterance
+        - the backward direction and the two GCN layers are re-run over the
+          last 2 * att_window_size + 1 utterances, which is the receptive
+          field of the new node in the graph
+
+    The emotion and sentiment scores returned for the new utterance are the
+    ones DialogueGCN.forward gives the last utterance of the conversation so
+    far, at a cost that does not grow with the length of the conversation.
+
+    Attributes:
+
+    model: a trained DialogueGCN in eval mode
+    latency_budget: seconds per utterance, updates slower than that are
+        reported
+    last_latency: seconds taken by the last update
+    """
+    def __init__(self, model, latency_budget=None):
+        self.model = model
+        self.config = model.config
+        self.window_size = model.config.att_window_size
+        self.forward_gru, self.backward_gru = split_gru_directions(model.context_encoder)
+        context_size = 2 * self.window_size + 1
+        self.indept_embeds = deque(maxlen=context_size)
+        self.forward_states = deque(maxlen=context_size)
+        self.speakers = deque(maxlen=context_size)
+        self.hidden = None
+        self.num_utts = 0
+        self.latency_budget = latency_budget
+        self.last_latency = 0
+
+    def add_utterance(self, speaker, text=None, audio=None, faces=None):
+        """
+        Adds the next utterance of the conversation and returns its emotion and
+        sentiment probabilities.
+
+        Inputs:
+            speaker(int): id of the speaker within the conversation
+            text(str): the transcript, when the model uses texts
+            audio(torch.tensor(D)): the audio features of the utterance,
+                normalised like the training data, when the model uses audio
+            faces(torch.tensor(N, F, C, W, H)): the aligned faces of the
+                utterance, as cached by the dataset, when the model uses visual
+                features; None if no face was found
+
+        Output:
+            (torch.tensor(7), torch.tensor(7)) emotion and sentiment probabilities
+        """
+        start = time.time()
+        with torch.inference_mode():
+            indept_embed = self.model.embed_utterances(self.get_transcripts(text), self.get_video(faces),
+                                                       self.get_audio(audio))
+            emotion, sentiment = self.add_embedding(speaker, indept_embed)
+        self.last_latency = time.time() - start
+        if self.latency_budget is not None and self.last_latency > self.latency_budget:
+            print("Utterance {} took {:.3f}s, over the budget of {:.3f}s".format(
+                self.num_utts - 1, self.last_latency, self.latency_budget))
+        return emotion, sentiment
+
+    def add_embedding(self, speaker, indept_embed):
+        """
+        Adds the next utterance from its (1 x 1 x D) context-independent
+        embedding and returns its emotion and sentiment probabilities
+        """
+        with torch.inference_mode():
+            forward_state, self.hidden = self.forward_gru(indept_embed, self.hidden)
+            self.indept_embeds.append(indept_embed[0, 0])
+            self.forward_states.append(forward_state[0, 0])
+            self.speakers.append(speaker)
+            self.num_utts += 1
+
+            # the backward direction starts over from the new last utterance
+            indept_embeds = torch.stack(list(self.indept_embeds)).unsqueeze(0)
+            backward_states = self.backward_gru(indept_embeds.flip(1))[0].flip(1)[0]
+            context_embeds = torch.cat([torch.stack(list(self.forward_states)), backward_states], dim=1)
+            speakers = torch.tensor(list(self.speakers), device=context_embeds.device)
+            edges, self_attn = self.model.construct_edges_relations(context_embeds, speakers, num_utts=self.num_utts)
+            with self.config.autocast():
+                emotion, sentiment = self.model.classify(context_embeds, edges, self_attn)
+        return torch.softmax(emotion[-1].float(), dim=0), torch.softmax(sentiment[-1].float(), dim=0)
+
+    def get_transcripts(self, text):
+        if not self.config.use_texts:
+            return None
+        if self.config.use_text_cache:
+            raise Exception("Live transcripts can't be read from the text cache, turn off config.use_text_cache")
+        if self.config.use_token_cache:
+            return [torch.from_numpy(tokenize_transcripts([text])[0]).unsqueeze(0)]
+        return [(text,)]
+
+    def get_audio(self, audio):
+        # the layout the DataLoader gives a dialogue of one utterance
+        if self.config.use_meld_audio:
+            return [audio.view(1, -1)]
+        if self.config.use_our_audio:
+            return [(audio.view(1, -1), None)]
+        return None
+
+    def get_video(self, faces):
+        if not self.config.use_visual:
+            return None
+        if faces is None:
+            return [torch.zeros(1, 0)]
+        return [faces.unsqueeze(0)]
@@ -0,0 +1,101 @@
+"""
+Module for tokenizing and encoding transcripts with the frozen BERT model.
+"""
+import numpy as np
+import torch
+from transformers import BertTokenizerFast
+
+
+# the fast tokenizer, loaded on first use in each process
+tokenizer = None
+
+def get_tokenizer():
+    """
+    Returns the shared Rust-backed bert-base-uncased tokenizer
+    """
+    global tokenizer
+    if tokenizer is None:
+        tokenizer = BertTokenizerFast.from_pretrained('bert-base-uncased')
+    return tokenizer
+
+
+def tokenize_transcripts(transcripts, batch_size=1024):
+    """
+    Tokenizes transcripts in batches with the fast tokenizer, adding [CLS] and
+    [SEP] like tokenizer.encode does.
+
+    Inputs:
+        transcripts(list(str)): the transcripts
+        batch_size(int): transcripts per call into the tokenizer
+
+    Output:
+        list(np.array(int32)) token ids of each transcript
+    """
+    token_ids = []
+    for start in range(0, len(transcripts), batch_size):
+        encoded = get_tokenizer()(transcripts[start:start + batch_size], add_special_tokens=True)['input_ids']
+        token_ids.extend(np.asarray(ids, dtype=np.int32) for ids in encoded)
+    return token_ids
+
+
+def length_buckets(sorted_lengths, max_batch_tokens=4096):
+    """
+    Splits sequences sorted by decreasing length into consecutive buckets whose
+    padded size (number of sequences x longest sequence) stays within
+    max_batch_tokens, so short transcripts are never padded to the longest one.
+
+    Inputs:
+        sorted_lengths(list(int)): sequence lengths in decreasing order
+        max_batch_tokens(int): budget of padded tokens per BERT batch
+
+    Output:
+        list((start, end)) slices into sorted_lengths
+    """
+    buckets = []
+    start = 0
+    while start < len(sorted_lengths):
+        # the first sequence of a bucket is its longest one
+        size = max(1, max_batch_tokens // max(1, sorted_lengths[start]))
+        end = min(len(sorted_lengths), start + size)
+        buckets.append((start, end))
+        start = end
+    return buckets
+
+
+def encode_transcripts(bert, input_ids, device, max_batch_tokens=4096):
+    """
+    Runs BERT over tokenized transcripts in padded, length-bucketed batches with
+    attention masks. The transcripts may come from one or several dialogues.
+
+    The hidden states are written in decreasing order of length into a single
+    zero padded tensor, ready for pack_padded_sequence without sorting or
+    padding them again.
+
+    Inputs:
+        bert(BertModel): the encoder
+        input_ids(list(list(int) or torch.tensor)): token ids of each transcript
+        device(str): device BERT lives on
+        max_batch_tokens(int): budget of padded tokens per BERT batch
+
+    Output:
+        hidden_states(torch.tensor(N, L, H)): in decreasing order of length
+        sorted_lengths(torch.tensor(N)): the number of tokens of each row
+        sorted_idx(torch.tensor(N)): index into input_ids of each row
+    """
+    lengths = torch.tensor([len(ids) for ids in input_ids], dtype=torch.long)
+    sorted_lengths, sorted_idx = lengths.sort(descending=True, stable=True)
+    hidden_size = bert.config.hidden_size
+    hidden_states = None
+    for start, end in length_buckets(sorted_lengths.tolist(), max_batch_tokens):
+        bucket_len = int(sorted_lengths[start])
+        batch_ids = torch.zeros(end - start, bucket_len, dtype=torch.long)
+        attention_mask = torch.zeros(end - start, bucket_len, dtype=torch.long)
+        for row, i in enumerate(sorted_idx[start:end].tolist()):
+            batch_ids[row, :lengths[i]] = torch.as_tensor(input_ids[i], dtype=torch.long)
+            attention_mask[row, :lengths[i]] = 1
+        batch_states = bert(batch_ids.to(device), attention_mask=attention_mask.to(device))[0]
+        if hidden_states is None:
+            hidden_states = batch_states.new_zeros(len(input_ids), int(sorted_lengths[0]), hidden_size)
+        # padded positions hold garbage states, the GRU never sees them once packed
+        hidden_states[start:end, :bucket_len] = batch_states
+    return hidden_states, sorted_lengths, sorted_idx
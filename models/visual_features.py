@@ -7,6 +7,7 @@ from torch_mtcnn import detect_faces
 import torch
 from torchvision.transforms import ToPILImage
 import os
+from collections import OrderedDict
 from facenet_pytorch_local.models.mtcnn import MTCNN
 from facenet_pytorch_local.models.inception_resnet_v1 import InceptionResnetV1
 
@@ -117,11 +118,206 @@ def get_face_embeddings(face_tensor):
     N, F, C, W, H, = face_tensor.shape
     face_tensor = face_tensor.view(-1, C, W, H)
 
-    # Instantiate facenet model
-    resnet = InceptionResnetV1(pretrained='vggface2').eval()
-    embeddings = resnet(face_tensor)
+    embeddings = get_face_embedder("cpu").embed(face_tensor)
 
     return embeddings.view(N, F, -1)
+
+class FaceEmbedder(object):
+    """
+    Shared FaceNet (InceptionResnetV1, vggface2) embedding service.
+
+    The model is loaded once and every call embeds all the faces it is given
+    in as few forward passes as possible, at most `max_batch_size` faces at a
+    time. Embeddings of a set of face crops can be memoized under a key (eg.
+    the visual cache key of an utterance), the last `cache_size` keys are kept
+    on the cpu. An already built `model` can be passed in, embeddings are then
+    computed on whatever device it has been moved to.
+    """
+    def __init__(self, device="cuda", max_batch_size=64, cache_size=1024, model=None):
+        if model is None:
+            model = InceptionResnetV1(pretrained='vggface2').eval().to(device)
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    @property
+    def device(self):
+        return next(self.model.parameters()).device
+
+    def embed(self, faces, key=None):
+        """
+        Input:
+            faces(torch.tensor(N, C, W, H)): face crops on any device
+            key: optional memoization key of the crops
+        Output:
+            torch.tensor(N, 512): embeddings on self.device
+        """
+        if key is not None and key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key].to(self.device)
+        embeddings = [torch.zeros(0, 512, device=self.device)]
+        with torch.no_grad():
+            for start in range(0, len(faces), self.max_batch_size):
+                batch = faces[start:start + self.max_batch_size].to(self.device).float()
+                embeddings.append(self.model(batch))
+        embeddings = torch.cat(embeddings)
+        if key is not None:
+            self.remember(key, embeddings)
+        return embeddings
+
+    def embed_videos(self, videos, keys=None):
+        """
+        Embeds the faces of every frame of several videos (eg. all utterances
+        of a dialogue) in one batched pass.
+
+        Input:
+            videos(list): per video, a list with one entry per frame that is
+                either None or a (faces, C, W, H) tensor
+            keys(list): optional memoization key of each video
+        Output:
+            list of (torch.tensor(frames, max faces, 512), list) per video: the
+            embeddings padded with zeros on self.device and the number of faces
+            in each frame
+        """
+        if keys is None:
+            keys = [None] * len(videos)
+        faces = [[faces for faces in frames if type(faces) == torch.Tensor] for frames in videos]
+        flat = [None] * len(videos)
+        for i, key in enumerate(keys):
+            if key is not None and key in self.cache:
+                self.cache.move_to_end(key)
+                flat[i] = self.cache[key]
+        pending = [i for i in range(len(videos)) if flat[i] is None]
+        pending_faces = [f for i in pending for f in faces[i]]
+        if len(pending_faces) > 0:
+            embeddings = self.embed(torch.cat(pending_faces)).split(
+                [sum(len(f) for f in faces[i]) for i in pending])
+            for i, embedding in zip(pending, embeddings):
+                flat[i] = embedding
+                if keys[i] is not None:
+                    self.remember(keys[i], embedding)
+
+        outputs = []
+        for frames, embedding in zip(videos, flat):
+            num_faces = [len(faces) if type(faces) == torch.Tensor else 0 for faces in frames]
+            padded = torch.zeros(len(num_faces), max(num_faces + [1]), 512, device=self.device)
+            if embedding is not None:
+                mask = torch.arange(padded.shape[1]).unsqueeze(0) < torch.tensor(num_faces).unsqueeze(1)
+                padded[mask.to(self.device)] = embedding.to(self.device)
+            outputs.append((padded, num_faces))
+        return outputs
+
+    def embed_frames(self, frames, key=None):
+        """
+        embed_videos for a single video
+        """
+        return self.embed_videos([frames], [key])[0]
+
+    def remember(self, key, embeddings):
+        self.cache[key] = embeddings.cpu()
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+"""
+Face models shared by everything in a process. They are only built on first
+use, so importing a module that may need them (eg. dataset.py) stays cheap
+and works without CUDA. The device defaults to cuda when it is available and
+can be changed with set_face_model_device before the models are first used.
+"""
+face_model_device = None
+face_detectors = {}
+face_embedders = {}
+
+def set_face_model_device(device):
+    global face_model_device
+    face_model_device = str(device)
+
+def get_face_model_device():
+    if face_model_device is not None:
+        return face_model_device
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+def get_face_detector(device=None):
+    """
+    Returns the shared MTCNN face detector of a device, loading it on first use
+    """
+    device = str(device) if device is not None else get_face_model_device()
+    if device not in face_detectors:
+        face_detectors[device] = MTCNN(image_size=224, margin=0, keep_all=True, device=torch.device(device))
+    return face_detectors[device]
+
+def get_face_embedder(device=None):
+    """
+    Returns the shared FaceEmbedder of a device, loading it on first use
+    """
+    device = str(device) if device is not None else get_face_model_device()
+    if device not in face_embedders:
+        face_embedders[device] = FaceEmbedder(device)
+    return face_embedders[device]
+
+def align_face_identities(embeddings, num_faces, max_persons=7, threshold=1.25):
+    """
+    Method for assigning the faces of every frame to identity slots, so that
+    the same person keeps the same slot across the frames of a video.
+
+    Frames are visited in order. A face joins the slot whose embeddings,
+    averaged over all frames (frames without that slot count as zeros), are
+    closest to it, if that mean squared distance is below `threshold` and
+    smaller than the distance to an empty slot. Each slot takes at most one
+    face per frame, the first one that matches it. Every other face opens the
+    next empty slot; once all `max_persons` slots are in use, further new
+    faces are dropped.
+
+    Inputs:
+        embeddings(torch.tensor(N, F, 512)): N frames, padded to F faces each
+        num_faces(torch.tensor(N)): number of faces in each frame
+        max_persons(int): the number of identity slots
+        threshold(float): largest mean squared distance for joining a slot
+
+    Output:
+        torch.tensor(N, max_persons): index + 1 of the face in each slot, 0
+        when the slot is empty, on the device of `embeddings`
+    """
+    N, F, D = embeddings.shape
+    device = embeddings.device
+    num_faces = torch.as_tensor(num_faces, device=device)
+    face_ids = torch.arange(F, device=device)
+    # running sums over frames of the slot embeddings and of their squared norms
+    slot_sum = torch.zeros(max_persons, D, device=device)
+    slot_sq = torch.zeros(max_persons, device=device)
+    used = torch.zeros(max_persons, dtype=torch.bool, device=device)
+    alignment = torch.zeros(N, max_persons + 1, dtype=torch.long, device=device)
+
+    # the extra slot max_persons collects the faces that are not assigned
+    for i in range(N):
+        emb = embeddings[i]
+        valid = face_ids < num_faces[i]
+        sq = torch.sum(emb ** 2, dim=1)
+        distances = sq.unsqueeze(1) - 2 * emb @ slot_sum.t() / N + slot_sq.unsqueeze(0) / N
+        min_dist, slot = torch.min(distances, dim=1)
+
+        matched = valid & (min_dist < threshold) & used[slot]
+        first = torch.full((max_persons + 1,), F, dtype=torch.long, device=device)
+        first = first.scatter_reduce(0, torch.where(matched, slot, max_persons), face_ids, reduce='amin')
+        matched = matched & (first[slot] == face_ids)
+
+        new = valid & ~matched
+        rank = torch.cumsum(new.long(), dim=0) - 1
+        free_slots = torch.argsort(used.to(torch.uint8), stable=True)
+        opened = new & (rank < torch.sum(~used))
+        target = torch.where(matched, slot, free_slots[rank.clamp(0, max_persons - 1)])
+        target = torch.where(matched | opened, target, max_persons)
+        alignment[i].scatter_(0, target, face_ids + 1)
+        alignment[i, max_persons] = 0
+
+        aligned = torch.cat([torch.zeros(1, D, device=device), emb], dim=0)[alignment[i, :max_persons]]
+        slot_sum += aligned
+        slot_sq += torch.sum(aligned ** 2, dim=1)
+        used |= alignment[i, :max_persons] > 0
+
+    return alignment[:, :max_persons]
 # Alternate implementation of mtcnn:
 
 # def detect_faces_mtcnn(video_tensor, display_images=False):
@@ -1,36 +1,122 @@
+"""
+Extracts the frames of every mp4 clip in one or more folders into one packed
+array file per clip.
+
+Every --sampling-rate-th frame of a clip is decoded (the frames in between are
+only grabbed, see dataset.sample_video_frames), optionally downscaled so that
+its longer side is at most --max-size pixels, and all sampled frames of the
+clip are written as a single (frames x H x W x 3) uint8 BGR array to
+<output>/<folder>/rate_<r>_size_<s>/<clip>.npy, the layout video_to_tensor
+returns. np.load(path, mmap_mode='r') reads it back without decoding.
+
+Clips are spread over a pool of worker processes. Every array is written
+under a temporary name and moved into place, so an interrupted run can be
+re-run and skips the clips whose array already exists. Clips of which no
+frame can be decoded are reported as failed and not written, so a re-run tries
+them again.
+
+Example:
+    python -u preprocess_videos.py ../MELD.Raw/train_splits ../MELD.Raw/dev_splits_complete --output ../MELD.Raw/frames --workers 8
+"""
+import argparse
+import multiprocessing
 import os
+import time
+
 import cv2
+import numpy as np
+
+
+def get_frames_path(output, folder, file_name, sampling_rate, max_size):
+    setting = 'rate_{}_size_{}'.format(sampling_rate, max_size if max_size is not None else 'full')
+    return os.path.join(output, os.path.basename(os.path.normpath(folder)), setting,
+                        os.path.splitext(file_name)[0] + '.npy')
+
+
+def resize_frame(frame, max_size):
+    """
+    Downscales a frame so that its longer side is at most max_size pixels
+    """
+    height, width = frame.shape[:2]
+    scale = max_size / max(height, width)
+    if scale >= 1:
+        return frame
+    return cv2.resize(frame, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+
+
+def process_videos_into_frames(task):
+    """
+    Writes the sampled frames of one clip to its array file and returns the
+    number of frames and bytes written, or None when no frame could be decoded
+    """
+    from dataset import sample_video_frames
+
+    video_file, frames_path, sampling_rate, max_size, seek = task
+    frames = [frame.copy() if max_size is None else resize_frame(frame, max_size)
+              for frame in sample_video_frames(video_file, sampling_rate, seek=seek)]
+    if len(frames) == 0:
+        print("Could not decode", video_file)
+        return None
+    frames = np.stack(frames)
+    os.makedirs(os.path.dirname(frames_path), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(frames_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, frames)
+    os.replace(tmp_path, frames_path)
+    return len(frames), frames.nbytes
+
+
+def collect_tasks(folders, output, sampling_rate, max_size, seek):
+    """
+    Returns one task per clip of the folders whose array does not exist yet,
+    and the total number of clips
+    """
+    tasks = []
+    total = 0
+    for folder in folders:
+        for file_name in sorted(os.listdir(folder)):
+            if not file_name.endswith(".mp4"):
+                continue
+            total += 1
+            frames_path = get_frames_path(output, folder, file_name, sampling_rate, max_size)
+            if not os.path.exists(frames_path):
+                tasks.append((os.path.join(folder, file_name), frames_path, sampling_rate, max_size, seek))
+    return tasks, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract the sampled frames of mp4 clips into packed arrays")
+    parser.add_argument("folders", nargs="+", help="folders of mp4 clips")
+    parser.add_argument("--output", required=True, help="root directory of the frame arrays")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--sampling-rate", type=int, default=30, help="keep every n-th frame")
+    parser.add_argument("--max-size", type=int, default=None, help="downscale frames to at most this many pixels per side")
+    parser.add_argument("--seek", action="store_true", help="seek to the sampled frames instead of grabbing every frame")
+    parser.add_argument("--log-every", type=int, default=100, help="log progress every n clips")
+    args = parser.parse_args()
+
+    tasks, total = collect_tasks(args.folders, args.output, args.sampling_rate, args.max_size, args.seek)
+    print("{} clips, {} already extracted, {} to extract with {} workers".format(total, total - len(tasks), len(tasks), args.workers))
+    if len(tasks) == 0:
+        return
+
+    start = time.time()
+    num_frames = 0
+    num_bytes = 0
+    failed = 0
+    with multiprocessing.Pool(args.workers) as pool:
+        for i, result in enumerate(pool.imap_unordered(process_videos_into_frames, tasks), 1):
+            if result is None:
+                failed += 1
+            else:
+                num_frames += result[0]
+                num_bytes += result[1]
+            if i % args.log_every == 0 or i == len(tasks):
+                elapsed = time.time() - start
+                print("[{}/{}] {:.1f} clips/s, {:.1f} frames/s, {:.1f} MB/s, {:.0f}s elapsed, {:.0f}s remaining, {} failed".format(
+                    i, len(tasks), i / elapsed, num_frames / elapsed, num_bytes / elapsed / 1e6, elapsed,
+                    (len(tasks) - i) * elapsed / i, failed))
+
 
-def process_videos_into_frames(file_name, dir_name):
- 
-    print(dir_name, file_name)
-    dir_to_save_name = dir_name + file_name.split(".")[0] + "/"
-    print("Creating directory " + dir_to_save_name)
-    os.makedirs(dir_to_save_name)
-
-    video_file_name = dir_name + file_name
-    vidcap = cv2.VideoCapture(video_file_name)
-    success, image = vidcap.read()
-    count = 0
- 
-    while success:
-        file_name = "frame%d.jpg" % count
-        full_file_name = dir_to_save_name + file_name
-        cv2.imwrite(full_file_name, image)     # save frame as JPEG file      
-        success,image = vidcap.read()
-        count += 1
-
-def process_folder_of_videos_into_frames(dir_name):
-
-    if not dir_name.endswith("/"):
-        dir_name += "/"
-    
-    number_of_files = len(os.listdir(dir_name))
-    for i, file_name in enumerate(os.listdir(dir_name)):
-        if file_name.endswith(".mp4"):
-            print("[" + str(i) + "/" + str(number_of_files) + "], currently processing file: " + file_name)
-            process_videos_into_frames(file_name, dir_name)
-
-#process_folder_of_videos_into_frames("../MELD.Raw/dev_splits_complete")
-#process_folder_of_videos_into_frames("../MELD.Raw/output_repeated_splits_test")
-#process_folder_of_videos_into_frames("../MELD.Raw/train_splits")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
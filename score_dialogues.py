@@ -0,0 +1,245 @@
+"""
+Scores the dialogues of a MELD-format CSV with a trained DialogueGCN and writes
+per-utterance emotion and sentiment probabilities.
+
+The dialogues are cut, in CSV order, into shards of --shard-size dialogues.
+Shards are scored by a pool of CPU worker processes. Each worker loads the
+checkpoint and opens the dataset once, gets only the range of dialogues of a
+shard and runs batches of --batch-size dialogues under
+torch.inference_mode(). Convert pickled audio features with
+convert_audio_features.py so the workers memory-map them. Every shard is written atomically to its own
+part-NNNNN.jsonl (or .parquet) file in --output, so an interrupted run picks up
+where it stopped when re-run with the same arguments: shards whose file exists
+are skipped.
+
+The model configuration is read from the checkpoint when main.py saved it
+there, otherwise from the --texts/--our-audio/--meld-audio/--visual flags.
+Audio features are looked up in --audio-embs and normalised with the
+--audio-params main.py fitted on the training set.
+
+Example:
+    python -u score_dialogues.py --checkpoint model_saves/texts_0 --csv archive.csv --output scores --workers 16
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import time
+
+import torch
+
+
+def load_config(checkpoint, args):
+    """
+    Returns the Config the checkpoint was trained with
+    """
+    from models.config import Config
+
+    if 'config' in checkpoint:
+        saved = checkpoint['config']
+        config = Config(saved['use_texts'], saved['use_our_audio'], saved['use_meld_audio'], saved['num_epochs'], saved['use_visual'])
+        config.__dict__.update(saved)
+    else:
+        config = Config(args.texts, args.our_audio, args.meld_audio, 0, args.visual)
+    # the device and precision of this run, not of the training run
+    config.device = args.device
+    config.precision = args.precision
+    return config
+
+
+def load_dataset(args, config):
+    """
+    Returns the MELDDataset of the csv with the audio features normalised
+    like in training
+    """
+    from dataset import MELDDataset, load_audio_embeddings
+
+    audio_embs = None
+    if config.use_our_audio or config.use_meld_audio:
+        if args.audio_embs is None or args.audio_params is None:
+            raise Exception("The model uses audio, pass --audio-embs and --audio-params")
+        audio_embs = load_audio_embeddings(args.audio_embs, config.use_our_audio)
+    dataset = MELDDataset(args.csv, args.video_dir, audio_embs, name=args.name, config=config)
+    if audio_embs is not None:
+        with open(args.audio_params, 'rb') as f:
+            dataset.apply_audio_transform(pickle.load(f), config.use_our_audio)
+    return dataset
+
+
+def init_worker(args):
+    """
+    Loads the model and the dataset once per worker process
+    """
+    global model, dataset, worker_args
+    from transformers import BertModel
+    from models.dialogue_gcn import DialogueGCN
+    from models.sentiment_model import build_sentiment_model
+
+    worker_args = args
+    checkpoint = torch.load(args.checkpoint, map_location=args.device)
+    config = load_config(checkpoint, args)
+    config.num_threads = args.threads_per_worker
+    config.num_interop_threads = 1
+    config.setup_device()
+    bert = BertModel.from_pretrained('bert-base-uncased')
+    # the weights of the sentiment model are part of the checkpoint
+    sentiment_model = build_sentiment_model(bert) if config.use_sentiment else None
+    model = DialogueGCN(config, bert, sentiment_model)
+    model.load_state_dict(checkpoint['model_state_dict'])
+    model = model.to(args.device).eval()
+    # the index is read from the cache the main process built, the audio stores are memory-mapped
+    dataset = load_dataset(args, config)
+
+
+def score_shard(task):
+    """
+    Scores dialogues first:last and writes the rows of their utterances to
+    the shard file
+    """
+    from dataset import collate_dialogues
+
+    shard, first, last = task
+    emotion_names = sorted(dataset.emotion_mapping, key=dataset.emotion_mapping.get)
+    rows = []
+    with torch.inference_mode():
+        for batch_first in range(first, last, worker_args.batch_size):
+            batch_last = min(batch_first + worker_args.batch_size, last)
+            inputs, _ = collate_dialogues([dataset[idx] for idx in range(batch_first, batch_last)])
+            with model.config.autocast():
+                emotion, sentiment = model(inputs)
+            emotion = torch.softmax(emotion.float(), dim=1).cpu().tolist()
+            sentiment = torch.softmax(sentiment.float(), dim=1).cpu().tolist()
+            start, end = dataset.dialogue_offsets[batch_first], dataset.dialogue_offsets[batch_last]
+            for dialogue_id, utterance_id, speaker, emotion_probs, sentiment_probs in zip(
+                    dataset.dialogue_ids[start:end], dataset.utterance_ids[start:end], dataset.speakers[start:end],
+                    emotion, sentiment):
+                row = {'dialogue_id': int(dialogue_id), 'utterance_id': int(utterance_id), 'speaker': int(speaker),
+                       'emotion': emotion_names[emotion_probs.index(max(emotion_probs))]}
+                for name, p in zip(emotion_names, emotion_probs):
+                    row['emotion_' + name] = p
+                for i, p in enumerate(sentiment_probs):
+                    row['sentiment_{}'.format(i)] = p
+                rows.append(row)
+    write_shard(get_shard_path(worker_args.output, shard, worker_args.format), rows, worker_args.format)
+    return shard, len(rows)
+
+
+def get_split_name(csv_file):
+    """
+    Returns the name the dialogues of a csv file get in the feature caches,
+    unique to the file so they never collide with the cached MELD splits
+    """
+    csv_file = os.path.abspath(csv_file)
+    name = os.path.splitext(os.path.basename(csv_file))[0]
+    return 'score_{}_{}'.format(name, hashlib.sha1(csv_file.encode()).hexdigest()[:8])
+
+
+def get_shard_path(output, shard, output_format):
+    return os.path.join(output, 'part-{:05d}.{}'.format(shard, output_format))
+
+
+def write_shard(path, rows, output_format):
+    """
+    Writes the rows under a temporary name and moves the file into place, so a
+    shard file is either complete or absent
+    """
+    tmp_path = path + '.{}.tmp'.format(os.getpid())
+    if output_format == 'parquet':
+        import pandas as pd
+        pd.DataFrame(rows).to_parquet(tmp_path, index=False)
+    else:
+        with open(tmp_path, 'w') as f:
+            for row in rows:
+                f.write(json.dumps(row) + '\n')
+    os.replace(tmp_path, path)
+
+
+def check_manifest(args, num_dialogues):
+    """
+    Records the sharding of the output directory, and refuses to resume into a
+    directory sharded differently
+    """
+    manifest = {'csv': os.path.abspath(args.csv), 'shard_size': args.shard_size, 'format': args.format,
+                'dialogues': num_dialogues}
+    manifest_path = os.path.join(args.output, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+        if previous != manifest:
+            raise Exception("{} holds the output of another run: {}".format(args.output, previous))
+    else:
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+
+
+def report_progress(results, num_tasks):
+    start = time.time()
+    scored = 0
+    for i, (shard, num_rows) in enumerate(results, 1):
+        scored += num_rows
+        elapsed = time.time() - start
+        print("[{}/{}] shard {} done, {:.1f} utt/s, {:.0f}s elapsed".format(i, num_tasks, shard, scored / elapsed, elapsed))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score MELD-format dialogues with a trained DialogueGCN")
+    parser.add_argument("--checkpoint", required=True, help="model_saves/*.pt file with a model_state_dict")
+    parser.add_argument("--csv", required=True, help="dialogues in the MELD csv format")
+    parser.add_argument("--video-dir", default=".", help="directory of the dia*_utt*.mp4 clips, for visual models")
+    parser.add_argument("--audio-embs", default=None, help="pickle of audio features keyed by <dialogue>_<utterance>, read from its converted store when there is one")
+    parser.add_argument("--audio-params", default=None, help="pickle of the audio normalisation main.py fitted")
+    parser.add_argument("--output", required=True, help="directory of the shard files")
+    parser.add_argument("--format", default="jsonl", choices=["jsonl", "parquet"])
+    parser.add_argument("--name", default=None,
+                        help="split name of the dialogues in the feature caches, derived from the csv path by default")
+    parser.add_argument("--workers", type=int, default=max(1, multiprocessing.cpu_count() // 2),
+                        help="scoring processes, 0 scores in this process")
+    parser.add_argument("--threads-per-worker", type=int, default=2)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--precision", default="float32", choices=["float32", "bfloat16", "float16"])
+    parser.add_argument("--shard-size", type=int, default=500, help="dialogues per output file")
+    parser.add_argument("--batch-size", type=int, default=32, help="dialogues per forward pass")
+    parser.add_argument("--texts", action="store_true")
+    parser.add_argument("--our-audio", action="store_true")
+    parser.add_argument("--meld-audio", action="store_true")
+    parser.add_argument("--visual", action="store_true")
+    args = parser.parse_args(argv)
+    if args.name is None:
+        args.name = get_split_name(args.csv)
+
+    if args.format == 'parquet':
+        try:
+            import pyarrow
+        except ImportError:
+            raise Exception("--format parquet needs pyarrow, use --format jsonl or install it")
+    config = load_config(torch.load(args.checkpoint, map_location='cpu'), args)
+    # builds the cached index the workers read, they only get the dialogue range of their shard
+    dataset = load_dataset(args, config)
+
+    os.makedirs(args.output, exist_ok=True)
+    check_manifest(args, len(dataset))
+    tasks = []
+    pending = 0
+    for shard, first in enumerate(range(0, len(dataset), args.shard_size)):
+        if os.path.exists(get_shard_path(args.output, shard, args.format)):
+            continue
+        last = min(first + args.shard_size, len(dataset))
+        pending += last - first
+        tasks.append((shard, first, last))
+    print("{} dialogues, {} to score in {} shards with {} workers".format(len(dataset), pending, len(tasks), args.workers))
+    if len(tasks) == 0:
+        return
+
+    if args.workers == 0:
+        init_worker(args)
+        report_progress(map(score_shard, tasks), len(tasks))
+    else:
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(args.workers, initializer=init_worker, initargs=(args,)) as pool:
+            report_progress(pool.imap_unordered(score_shard, tasks), len(tasks))
+
+
+if __name__ == "__main__":
+    main()
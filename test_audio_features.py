@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+
+from extract_audio_features import write_stores
+from feature_store import FeatureStore, MatrixStore
+from models.audio_features import frame_features, pool_features
+
+"""
+Tests for the acoustic feature extraction, run with
+    python -m pytest test_audio_features.py
+"""
+
+
+def test_frame_features_of_a_tone():
+    sample_rate = 16000
+    t = np.arange(sample_rate) / sample_rate
+    pcm = (0.5 * np.sin(2 * np.pi * 1000 * t)).astype(np.float32)
+    frames = frame_features(pcm, sample_rate, n_mels=40)
+    # 25ms frames every 10ms over one second
+    assert frames.shape == (98, 43)
+    assert frames.dtype == np.float32
+    # two zero crossings per period, a centroid at the tone
+    assert np.allclose(frames[:, 41], 2 * 1000 / sample_rate, atol=5e-3)
+    assert np.allclose(frames[:, 42] * sample_rate / 2, 1000, rtol=0.02)
+    assert np.allclose(frames[:, 40], np.log(0.125), atol=0.05)
+
+
+def test_short_and_silent_clips():
+    frames = frame_features(np.zeros(10, dtype=np.float32))
+    assert frames.shape == (1, 43)
+    assert np.isfinite(frames).all()
+    pooled = pool_features(frames)
+    assert pooled.shape == (5 * 43,)
+    assert np.isfinite(pooled).all()
+
+
+def test_stores_are_extended(tmp_path):
+    store_path = str(tmp_path / "acoustic_train")
+    first = [(0, 0, np.full(3, 1.0), np.ones((2, 3))), (0, 1, np.full(3, 2.0), np.ones((4, 3)))]
+    second = [(5, 0, np.full(3, 3.0), np.ones((1, 3)))]
+    write_stores(store_path, first)
+    inode = os.stat(store_path + ".bin").st_ino
+    # an interrupted append leaves bytes no index refers to
+    for path in [store_path + ".bin", store_path + "_temporal.bin"]:
+        with open(path, "ab") as f:
+            f.write(b"\xff" * 20)
+    write_stores(store_path, second)
+    # appended in place, not rewritten
+    assert os.stat(store_path + ".bin").st_ino == inode
+    assert os.path.getsize(store_path + ".bin") == 4 * 3 * 4
+
+    store = MatrixStore(store_path)
+    frames = FeatureStore(store_path + "_temporal")
+    assert len(store) == 3
+    for dialogue_id, utterance_id, pooled, frame_level in first + second:
+        assert np.array_equal(store.get(dialogue_id, utterance_id), pooled)
+        assert np.array_equal(frames.get("{}_{}".format(dialogue_id, utterance_id)), frame_level)
+    assert np.array_equal(store.rows([5, 1], [0, 0]), [3, 0])
+    assert not store.data[0].any()
@@ -0,0 +1,242 @@
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+import dataset
+from dataset import MELDDataset, build_meld_index
+from models.config import Config
+
+"""
+Tests for the columnar MELD index, run with
+    python -m pytest test_dataset_index.py
+"""
+
+EMOTIONS = ["joy", "anger", "disgust", "fear", "sadness", "neutral", "surprise"]
+
+
+def write_csv(path, seed=0):
+    """
+    Writes a MELD-format csv with shuffled rows and returns the (dialogue id,
+    utterance id) -> row mapping of its records
+    """
+    rng = np.random.RandomState(seed)
+    records = []
+    for d_id in rng.permutation(12) + 3:
+        # utterances of a dialogue out of order, dialogues in the generated order
+        for u_id in rng.permutation(rng.randint(1, 9)):
+            records.append({"Sr No.": 0, "Utterance": "dia {} utt {}".format(d_id, u_id),
+                            "Speaker": ["Monica", "Ross", "Joey", "Monica and Rachel"][rng.randint(4)],
+                            "Emotion": EMOTIONS[rng.randint(7)], "Sentiment": ["negative", "neutral", "positive"][rng.randint(3)],
+                            "Dialogue_ID": d_id, "Utterance_ID": u_id, "Season": 1, "Episode": 1,
+                            "StartTime": "00:00:00,000", "EndTime": "00:00:01,000"})
+    pd.DataFrame(records).to_csv(path, index=False)
+    return {(r["Dialogue_ID"], r["Utterance_ID"]): r for r in records}
+
+
+def test_index_matches_records(tmp_path, monkeypatch):
+    monkeypatch.setattr(dataset, "INDEX_CACHE_PATH", str(tmp_path / "index"))
+    # no clips on disk, the raw videos are not under test
+    monkeypatch.setattr(dataset, "video_to_tensor", lambda *args: torch.zeros(0, 1, 1, 3, dtype=torch.uint8))
+    records = write_csv(tmp_path / "split.csv")
+    audio_embs = {"{}_{}".format(d_id, u_id): np.random.randn(1, 5) for d_id, u_id in records}
+    config = Config(False, False, True, 0, False)
+    meld = MELDDataset(str(tmp_path / "split.csv"), str(tmp_path), audio_embs, name="train", config=config)
+
+    csv_order = list(dict.fromkeys(pd.read_csv(tmp_path / "split.csv")["Dialogue_ID"]))
+    assert len(meld) == len(csv_order)
+    for idx, d_id in enumerate(csv_order):
+        start, end = meld.dialogue_offsets[idx], meld.dialogue_offsets[idx + 1]
+        rows = [records[(d_id, u_id)] for u_id in range(end - start)]
+        assert meld.dialogue_ids[start:end].tolist() == [d_id] * len(rows)
+        assert meld.utterance_ids[start:end].tolist() == list(range(len(rows)))
+
+        (transcripts, _, audio, speakers), (emotions, sentiments) = meld[idx]
+        assert transcripts == [r["Utterance"] for r in rows]
+        assert emotions == [meld.emotion_mapping[r["Emotion"]] for r in rows]
+        assert sentiments == [meld.sentiment_mapping[r["Sentiment"]] for r in rows]
+        for row, features in zip(rows, audio):
+            assert np.allclose(features.numpy(), audio_embs["{}_{}".format(d_id, row["Utterance_ID"])].reshape(-1))
+        # relative speaker ids in order of first appearance, like Dialogue.reparameterize_speakers
+        relative = {}
+        for r in rows:
+            relative.setdefault(r["Speaker"], len(relative))
+        assert speakers.tolist() == [relative[r["Speaker"]] for r in rows]
+        assert torch.equal(speakers, meld.data[idx].get_speakers())
+
+
+def test_items_are_column_slices(tmp_path, monkeypatch):
+    monkeypatch.setattr(dataset, "INDEX_CACHE_PATH", str(tmp_path / "index"))
+    records = write_csv(tmp_path / "split.csv", seed=7)
+
+    def fail(*args):
+        raise AssertionError("built per utterance")
+    monkeypatch.setattr(dataset, "Utterance", fail)
+    monkeypatch.setattr(dataset, "video_to_tensor", fail)
+    config = Config(False, False, False, 0, False)
+    meld = MELDDataset(str(tmp_path / "split.csv"), str(tmp_path), None, name="train", config=config)
+    for idx in range(len(meld)):
+        (transcripts, video, _, _), _ = meld[idx]
+        assert len(video) == len(transcripts) and all(v.numel() == 0 for v in video)
+
+    # models reading the raw clips get them decoded from the path column
+    paths = []
+    monkeypatch.setattr(dataset, "video_to_tensor", lambda path: paths.append(path) or torch.zeros(0, 1, 1, 3, dtype=torch.uint8))
+    config.use_visual = True
+    meld[0]
+    start, end = meld.dialogue_offsets[0], meld.dialogue_offsets[1]
+    assert paths == [str(tmp_path / "dia{}_utt{}.mp4".format(meld.dialogue_ids[start], u_id)) for u_id in meld.utterance_ids[start:end]]
+
+
+def test_saved_index_is_reused(tmp_path, monkeypatch):
+    monkeypatch.setattr(dataset, "INDEX_CACHE_PATH", str(tmp_path / "index"))
+    write_csv(tmp_path / "split.csv", seed=1)
+    config = Config(False, False, False, 0, False)
+    first = MELDDataset(str(tmp_path / "split.csv"), str(tmp_path), None, name="val", config=config)
+    assert len(list((tmp_path / "index").iterdir())) == 1
+
+    def fail(*args):
+        raise AssertionError("the csv was parsed again")
+    monkeypatch.setattr(dataset, "build_meld_index", fail)
+    second = MELDDataset(str(tmp_path / "split.csv"), str(tmp_path), None, name="val", config=config)
+    for key in ["dialogue_offsets", "dialogue_ids", "utterance_ids", "transcripts", "speakers",
+                "dialogue_speakers", "emotions", "sentiments"]:
+        assert np.array_equal(getattr(second, key), getattr(first, key))
+    assert second.speaker_mapping == first.speaker_mapping
+    assert second.sentiment_mapping == first.sentiment_mapping
+
+
+def test_audio_stats_are_fitted_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(dataset, "INDEX_CACHE_PATH", str(tmp_path / "index"))
+    monkeypatch.setattr(dataset, "AUDIO_PARAMS_CACHE_PATH", str(tmp_path / "audio_params"))
+    records = write_csv(tmp_path / "split.csv", seed=2)
+    audio_embs = {"{}_{}".format(d_id, u_id): np.random.randn(1, 5) * 3 + 1 for d_id, u_id in records}
+    config = Config(False, False, True, 0, False)
+    meld = MELDDataset(str(tmp_path / "split.csv"), str(tmp_path), audio_embs, name="train", config=config)
+    scaler = meld.get_audio_stats(False)
+
+    monkeypatch.setattr(MELDDataset, "find_audio_stats", lambda *args: None)
+    assert np.allclose(meld.get_audio_stats(False).mean_, scaler.mean_)
+    meld.apply_audio_transform(scaler, False)
+    assert meld.audio.dtype == np.float32
+    assert np.allclose(meld.audio.mean(axis=0), 0, atol=1e-5)
+    # different features are fitted again
+    assert meld.get_audio_stats(False) is None
+
+
+def test_audio_store_matches_pickled_features(tmp_path, monkeypatch):
+    from convert_audio_features import write_fixed_features, write_temporal_features
+    from feature_store import FeatureStore, MatrixStore
+
+    monkeypatch.setattr(dataset, "INDEX_CACHE_PATH", str(tmp_path / "index"))
+    monkeypatch.setattr(dataset, "video_to_tensor", lambda *args: torch.zeros(0, 1, 1, 3, dtype=torch.uint8))
+    records = write_csv(tmp_path / "split.csv", seed=3)
+    # the last utterances have no audio features
+    keys = ["{}_{}".format(d_id, u_id) for d_id, u_id in records][:-5]
+    # and a few only one of the two halves, which counts as no features either
+    fixed = {key: np.random.randn(1, 6373) for key in keys[3:]}
+    temporal = {key: np.random.randn(np.random.randint(1, 6), 142) for key in keys[:-3]}
+    write_fixed_features(str(tmp_path / "fixed"), fixed, "float32")
+    write_temporal_features(str(tmp_path / "fixed_temporal"), temporal, "float32")
+    store = MatrixStore(str(tmp_path / "fixed"))
+    assert len(store) == len(keys) - 3
+    assert (3, 99) not in store
+
+    config = Config(False, True, False, 0, False)
+    pickled = MELDDataset(str(tmp_path / "split.csv"), str(tmp_path), (fixed, temporal), name="train", config=config)
+    stored = MELDDataset(str(tmp_path / "split.csv"), str(tmp_path),
+                         (store, FeatureStore(str(tmp_path / "fixed_temporal"))), name="train", config=config)
+    assert np.array_equal(stored.get_audio_matrix(), pickled.audio)
+    assert np.sum(~pickled.audio.any(axis=1)) == len(records) - len(keys) + 6
+    for idx in range(len(pickled)):
+        for (fixed_a, temporal_a), (fixed_b, temporal_b) in zip(pickled[idx][0][2], stored[idx][0][2]):
+            assert torch.equal(fixed_a, fixed_b)
+            assert torch.equal(temporal_a, temporal_b)
+
+    params = pickled.find_audio_stats(False)
+    pickled.apply_audio_transform(params, False)
+    stored.apply_audio_transform(params, False)
+    assert np.allclose(stored.audio, pickled.audio)
+
+
+def test_fixed_only_audio_store(tmp_path, monkeypatch):
+    from convert_audio_features import write_fixed_features
+    from feature_store import MatrixStore
+
+    monkeypatch.setattr(dataset, "INDEX_CACHE_PATH", str(tmp_path / "index"))
+    monkeypatch.setattr(dataset, "AUDIO_STORE_PATH", str(tmp_path / "audio"))
+    records = write_csv(tmp_path / "split.csv", seed=5)
+    store_path = dataset.get_audio_store_path("fixed_only.pkl")
+    write_fixed_features(store_path, {"{}_{}".format(d_id, u_id): np.random.randn(1, 6373) for d_id, u_id in records}, "float32")
+
+    with pytest.raises(Exception, match="no temporal features"):
+        dataset.load_audio_embeddings("fixed_only.pkl", True)
+    # without the temporal half, no utterance has both halves of our audio
+    config = Config(False, True, False, 0, False)
+    meld = MELDDataset(str(tmp_path / "split.csv"), str(tmp_path), (MatrixStore(store_path), None), name="train", config=config)
+    assert not meld.get_audio_matrix().any()
+    assert all(np.array_equal(temporal, dataset.MISSING_AUDIO_TEMPORAL) for temporal in meld.audio_temporal)
+
+
+def test_worker_loader_matches_main_thread(tmp_path, monkeypatch):
+    from dataset import DevicePrefetcher, get_data_loader
+
+    monkeypatch.setattr(dataset, "INDEX_CACHE_PATH", str(tmp_path / "index"))
+    monkeypatch.setattr(dataset, "video_to_tensor", lambda *args: torch.zeros(0, 1, 1, 3, dtype=torch.uint8))
+    records = write_csv(tmp_path / "split.csv", seed=4)
+    audio_embs = {"{}_{}".format(d_id, u_id): np.random.randn(1, 5) for d_id, u_id in records}
+    config = Config(False, False, True, 0, False)
+    config.batch_size = 3
+    meld = MELDDataset(str(tmp_path / "split.csv"), str(tmp_path), audio_embs, name="train", config=config)
+
+    batches = list(get_data_loader(meld, config, shuffle=False))
+    config.num_workers = 2
+    worker_batches = list(DevicePrefetcher(get_data_loader(meld, config, shuffle=False), "cpu"))
+    assert len(worker_batches) == len(batches) == (len(meld) + 2) // 3
+    for ((transcripts, _, audio, speakers, lengths), labels), ((w_transcripts, _, w_audio, w_speakers, w_lengths), w_labels) in zip(batches, worker_batches):
+        assert transcripts == w_transcripts
+        assert all(torch.equal(a, b) for a, b in zip(audio, w_audio))
+        assert torch.equal(speakers, w_speakers)
+        assert torch.equal(lengths, w_lengths)
+        assert labels == w_labels
+
+
+def test_token_cache_follows_transcript_edits(tmp_path, monkeypatch):
+    monkeypatch.setattr(dataset, "TOKEN_CACHE_PATH", str(tmp_path / "tokens"))
+    monkeypatch.setattr(dataset, "feature_stores", {})
+    # one "token" per character, enough to tell transcripts apart
+    monkeypatch.setattr(dataset, "tokenize_transcripts", lambda transcripts: [np.frombuffer(t.encode(), dtype=np.uint8).astype(np.int32) for t in transcripts])
+
+    keys = dataset.build_token_cache(["test_dia_0_utt_0", "test_dia_0_utt_1"], ["hello", "there"])
+    assert bytes(dataset.get_token_store().get(keys[0]).astype(np.uint8)) == b"hello"
+    keys = dataset.build_token_cache(["test_dia_0_utt_0"], ["goodbye"])
+    store = dataset.get_token_store()
+    assert bytes(store.get(keys[0]).astype(np.uint8)) == b"goodbye"
+    # the old version is dropped, the untouched utterance kept
+    assert len(store) == 2
+
+
+def test_extracted_audio_features_are_normalised(tmp_path, monkeypatch):
+    from extract_audio_features import write_stores
+    from models.audio_features import frame_features, pool_features
+
+    monkeypatch.setattr(dataset, "INDEX_CACHE_PATH", str(tmp_path / "index"))
+    monkeypatch.setattr(dataset, "AUDIO_STORE_PATH", str(tmp_path / "audio"))
+    monkeypatch.setattr(dataset, "AUDIO_PARAMS_CACHE_PATH", str(tmp_path / "audio_params"))
+    records = write_csv(tmp_path / "split.csv", seed=6)
+    rng = np.random.RandomState(0)
+    results = []
+    for d_id, u_id in records:
+        frames = frame_features(rng.randn(rng.randint(400, 8000)).astype(np.float32) * rng.rand())
+        results.append((d_id, u_id, pool_features(frames), frames))
+    write_stores(dataset.get_audio_store_path("acoustic.pkl", "train"), results)
+
+    config = Config(False, True, False, 0, False)
+    audio_embs, = dataset.load_audio_embeddings("acoustic.pkl", True, ["train"])
+    meld = MELDDataset(str(tmp_path / "split.csv"), str(tmp_path), audio_embs, name="train", config=config)
+    params = meld.get_audio_stats(True)
+    meld.apply_audio_transform(params, True)
+    # fewer utterances than pooled features here, so the PCA keeps one component per utterance
+    assert MELDDataset.get_audio_dim(params, True) == min(400, len(records), results[0][2].size)
+    assert meld.audio.shape == (len(records), MELDDataset.get_audio_dim(params, True))
+    assert np.isfinite(meld.audio).all()
@@ -0,0 +1,136 @@
+import torch
+
+from dataset import collate_dialogues
+from models.dialogue_gcn import (encode_context, get_block_window_edges, get_window_edges, get_window_mask,
+                                 window_attention, window_edge_attention)
+from models.dialogue_gcn_cell import GraphConvolution, relation_graph_convolution
+
+"""
+Tests for the graph construction of DialogueGCN, run with
+    python -m pytest test_dialogue_gcn.py
+"""
+
+
+def reference_attention(ut_embs, window_size):
+    """
+    The per-entry loop construct_edges_relations used before, for comparison.
+    """
+    num_utts = len(ut_embs)
+    attn = torch.zeros(num_utts, num_utts)
+    for i in range(num_utts):
+        curr_utt = ut_embs[i]
+        left_bdry = max(0, i - window_size)
+        right_bdry = min(num_utts, i + window_size + 1)
+        for j in range(left_bdry, right_bdry):
+            attn[i, j] = curr_utt.dot(ut_embs[j])
+    return torch.softmax(attn, dim=1)
+
+
+def test_window_attention_matches_loop():
+    torch.manual_seed(0)
+    for num_utts in [1, 2, 5, 11, 24]:
+        for window_size in [0, 1, 3, 10]:
+            ut_embs = torch.randn(num_utts, 100) * 0.3
+            assert torch.allclose(window_attention(ut_embs, window_size), reference_attention(ut_embs, window_size), atol=1e-6)
+
+
+def test_window_attention_gradients_match_loop():
+    torch.manual_seed(1)
+    ut_embs = (torch.randn(15, 100) * 0.3).requires_grad_()
+    weights = torch.randn(15, 15)
+    grad, = torch.autograd.grad((window_attention(ut_embs, 4) * weights).sum(), ut_embs)
+    expected, = torch.autograd.grad((reference_attention(ut_embs, 4) * weights).sum(), ut_embs)
+    assert torch.allclose(grad, expected, atol=1e-5)
+
+
+def test_window_mask_is_cached_band():
+    mask = get_window_mask(6, 2, torch.device("cpu"))
+    assert get_window_mask(6, 2, torch.device("cpu")) is mask
+    for i in range(6):
+        for j in range(6):
+            assert mask[i, j].item() == (abs(i - j) <= 2)
+
+
+def reference_relation_matrices(speaker_ids, attn_mask):
+    """
+    The dense adjacency matrices build_relation_matrices used to return, in the
+    order of the relation types.
+    """
+    num_utt = len(speaker_ids)
+    pred_adj = torch.ones(num_utt, num_utt).triu(0)
+    suc_adj = 1 - pred_adj
+    same_adj = (speaker_ids.unsqueeze(1) == speaker_ids.unsqueeze(0)).float()
+    diff_adj = 1 - same_adj
+    return [same_adj * pred_adj * attn_mask, same_adj * suc_adj * attn_mask,
+            diff_adj * pred_adj * attn_mask, diff_adj * suc_adj * attn_mask]
+
+
+def sparse_graph(ut_embs, speaker_ids, window_size):
+    dst, src = get_window_edges(len(ut_embs), window_size, ut_embs.device)
+    weight = window_edge_attention(ut_embs, dst, src)
+    relation = 2 * (speaker_ids[dst] != speaker_ids[src]).long() + (src < dst).long()
+    return (dst, src, relation, weight), weight[dst == src]
+
+
+def test_edge_attention_matches_dense_window():
+    torch.manual_seed(2)
+    for num_utts in [1, 4, 13, 30]:
+        ut_embs = torch.randn(num_utts, 100) * 0.5
+        dst, src = get_window_edges(num_utts, 3, ut_embs.device)
+        expected = window_attention(ut_embs, 3)[dst, src]
+        assert torch.allclose(window_edge_attention(ut_embs, dst, src), expected, atol=1e-6)
+
+
+def test_relation_convolution_matches_dense_layers():
+    torch.manual_seed(3)
+    layers = [GraphConvolution(100, 100, bias=False) for _ in range(4)]
+    for num_utts, window_size in [(6, 10), (11, 10), (25, 4)]:
+        ut_embs = torch.randn(num_utts, 100) * 0.3
+        speaker_ids = torch.randint(0, 3, (num_utts,))
+        edges, self_attn = sparse_graph(ut_embs, speaker_ids, window_size)
+        # dense attention restricted to the window, the messages the edge list carries
+        attn = window_attention(ut_embs, window_size) * get_window_mask(num_utts, window_size, ut_embs.device)
+        expected = sum(layer(ut_embs, adj) for layer, adj in zip(layers, reference_relation_matrices(speaker_ids, attn)))
+        assert torch.allclose(relation_graph_convolution(ut_embs, layers, edges), expected, atol=1e-5)
+        assert torch.allclose(self_attn, attn.diag(), atol=1e-6)
+
+
+def test_block_graph_matches_separate_dialogues():
+    torch.manual_seed(4)
+    layers = [GraphConvolution(100, 100, bias=False) for _ in range(4)]
+    lengths = [5, 14, 1, 9]
+    ut_embs = torch.randn(sum(lengths), 100) * 0.3
+    speaker_ids = torch.cat([torch.randint(0, 3, (n,)) for n in lengths])
+    dst, src, num_utts = get_block_window_edges(lengths, 4, ut_embs.device)
+    weight = window_edge_attention(ut_embs, dst, src, num_utts)
+    relation = 2 * (speaker_ids[dst] != speaker_ids[src]).long() + (src < dst).long()
+    batched = relation_graph_convolution(ut_embs, layers, (dst, src, relation, weight))
+    separate = []
+    for embs, speakers in zip(torch.split(ut_embs, lengths), torch.split(speaker_ids, lengths)):
+        edges, _ = sparse_graph(embs, speakers, 4)
+        separate.append(relation_graph_convolution(embs, layers, edges))
+    assert torch.allclose(batched, torch.cat(separate), atol=1e-5)
+
+
+def test_packed_context_matches_separate_dialogues():
+    torch.manual_seed(5)
+    context_encoder = torch.nn.GRU(30, 20, bidirectional=True, batch_first=True)
+    lengths = torch.LongTensor([3, 8, 1, 6])
+    indept_embeds = torch.randn(1, int(lengths.sum()), 30)
+    batched = encode_context(context_encoder, indept_embeds, lengths)
+    separate = [context_encoder(embeds.unsqueeze(0))[0].squeeze(0) for embeds in torch.split(indept_embeds[0], lengths.tolist())]
+    assert torch.allclose(batched, torch.cat(separate), atol=1e-6)
+
+
+def test_collate_dialogues_concatenates_utterances():
+    def dialogue(num_utts, speaker):
+        inputs = ([torch.full((4,), i, dtype=torch.int32) for i in range(num_utts)],
+                  [torch.zeros(2, 3) for _ in range(num_utts)],
+                  [torch.zeros(8) for _ in range(num_utts)], torch.LongTensor([speaker] * num_utts))
+        return inputs, ([1] * num_utts, [2] * num_utts)
+    (transcripts, video, audio, speakers, lengths), (emotions, sentiments) = collate_dialogues([dialogue(2, 0), dialogue(3, 1)])
+    assert lengths.tolist() == [2, 3]
+    assert len(transcripts) == len(audio) == len(emotions) == 5
+    assert transcripts[0].shape == (1, 4) and video[0].shape == (1, 2, 3) and audio[0].shape == (1, 8)
+    assert speakers.tolist() == [[0, 0, 1, 1, 1]]
+    assert torch.LongTensor((emotions, sentiments)).shape == (2, 5)
@@ -0,0 +1,133 @@
+import torch
+
+from models.visual_features import FaceEmbedder, align_face_identities
+
+"""
+Tests for the face identity alignment of Utterance.get_face_frames, run with
+    python -m pytest test_face_alignment.py
+"""
+
+
+def reference_alignment(embedding_vector, max_persons=7, threshold=1.25):
+    """
+    The per-frame, per-face loop get_face_frames used before, for comparison.
+    """
+    aligned_embeddings = torch.zeros(len(embedding_vector), max_persons, 512)
+    alignment_indices = torch.zeros(len(embedding_vector), max_persons)
+    new_face_index = 0
+    for i, embedding in enumerate(embedding_vector):
+        distances = torch.sum(((embedding.unsqueeze(1).unsqueeze(1) - aligned_embeddings.unsqueeze(0)) ** 2), dim=3)
+        distances = torch.mean(distances, dim=1)
+        indices = torch.zeros(max_persons)
+        for j, distance in enumerate(distances):
+            min_dist, arg_min = torch.min(distance, dim=0)
+            if min_dist < threshold and indices[arg_min] < 1:
+                indices[arg_min] = j + 1
+                alignment_indices[i, arg_min] = j + 1
+            else:
+                new_face_index += 1
+                if new_face_index < max_persons:
+                    indices[new_face_index] = j + 1
+                    alignment_indices[i, new_face_index] = j + 1
+        padded_embedding = torch.cat([torch.zeros(1, 512), embedding], dim=0)
+        aligned_embeddings[i] = torch.index_select(padded_embedding, 0, indices.long())
+    return alignment_indices.long()
+
+
+def make_video(identities, frames, noise=0.05, seed=0):
+    """
+    Unit norm embeddings for the given identities in each frame, in that order
+    """
+    generator = torch.Generator().manual_seed(seed)
+    people = torch.nn.functional.normalize(torch.randn(identities, 512, generator=generator), dim=1)
+    video = []
+    for frame in frames:
+        embedding = people[frame] + noise * torch.randn(len(frame), 512, generator=generator) / 512 ** 0.5
+        video.append(torch.nn.functional.normalize(embedding, dim=1))
+    return video
+
+
+def pad(video):
+    num_faces = [len(frame) for frame in video]
+    embeddings = torch.zeros(len(video), max(num_faces), 512)
+    for i, frame in enumerate(video):
+        embeddings[i, :len(frame)] = frame
+    return embeddings, num_faces
+
+
+def test_matches_reference():
+    # every identity is seen on the first frame, as long as no new face
+    # shows up later the old loop has no slot collisions
+    frames = [[0, 1, 2, 3], [2, 0, 1], [3, 1], [1, 0, 2, 3], [0], [3, 2, 1, 0]]
+    for seed in range(5):
+        video = make_video(4, frames, seed=seed)
+        embeddings, num_faces = pad(video)
+        assert torch.equal(align_face_identities(embeddings, num_faces), reference_alignment(video))
+
+
+def test_same_person_keeps_slot():
+    frames = [[0, 1], [1, 0, 2], [2, 3, 1], [3, 0]]
+    embeddings, num_faces = pad(make_video(4, frames))
+    alignment = align_face_identities(embeddings, num_faces)
+    slots = {}
+    for frame, row in zip(frames, alignment):
+        assert sorted(row[row > 0].tolist()) == list(range(1, len(frame) + 1))
+        for slot, index in enumerate(row.tolist()):
+            if index > 0:
+                assert slots.setdefault(frame[index - 1], slot) == slot
+
+
+def test_more_people_than_slots():
+    # people 4, 5 and 6 show up once all 4 slots are taken, they may only
+    # end up in a slot by joining it and never move the people already there
+    frames = [[0, 1], [2, 0], [3, 4, 1], [5, 0, 6], [1, 3, 2, 0]]
+    embeddings, num_faces = pad(make_video(7, frames))
+    alignment = align_face_identities(embeddings, num_faces, max_persons=4)
+    assert alignment.shape == (5, 4)
+    for frame, row in zip(frames, alignment):
+        indices = row[row > 0].tolist()
+        assert len(set(indices)) == len(indices)
+        for slot, index in enumerate(row.tolist()):
+            if index > 0 and frame[index - 1] < 4:
+                assert frame[index - 1] == slot
+    assert alignment[4].tolist() == [4, 1, 3, 2]
+
+
+def test_frames_without_faces():
+    frames = [[], [0, 1], [], [1]]
+    video = make_video(2, frames)
+    embeddings, num_faces = pad(video)
+    alignment = align_face_identities(embeddings, num_faces, max_persons=3)
+    assert alignment[0].tolist() == [0, 0, 0] and alignment[2].tolist() == [0, 0, 0]
+    assert alignment[1].tolist() == [1, 2, 0] and alignment[3].tolist() == [0, 1, 0]
+
+
+class CountingModel(torch.nn.Module):
+    """
+    Stands in for FaceNet, one 512-d embedding per crop, counts the crops seen
+    """
+    def __init__(self):
+        super().__init__()
+        self.linear = torch.nn.Linear(3, 512)
+        self.num_faces = 0
+
+    def forward(self, faces):
+        self.num_faces += len(faces)
+        return self.linear(faces.mean(dim=(2, 3)))
+
+
+def test_embeddings_are_memoized_by_key():
+    model = CountingModel()
+    embedder = FaceEmbedder(model=model)
+    videos = [[torch.rand(2, 3, 8, 8), None, torch.rand(1, 3, 8, 8)], [torch.rand(3, 3, 8, 8)]]
+    keys = [("dia0_utt0", 224, 30, None), ("dia0_utt1", 224, 30, None)]
+    first = embedder.embed_videos(videos, keys)
+    assert model.num_faces == 6
+    second = embedder.embed_videos(videos, keys)
+    assert model.num_faces == 6
+    for (embeddings, num_faces), (memo_embeddings, memo_num_faces) in zip(first, second):
+        assert torch.equal(embeddings, memo_embeddings)
+        assert num_faces == memo_num_faces
+    # other sampling settings detect other crops
+    embedder.embed_frames(videos[0], ("dia0_utt0", 224, 15, None))
+    assert model.num_faces == 9
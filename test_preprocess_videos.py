@@ -0,0 +1,48 @@
+import cv2
+import numpy as np
+
+from dataset import video_to_tensor
+from preprocess_videos import collect_tasks, process_videos_into_frames
+
+"""
+Tests for the frame extraction tool, run with
+    python -m pytest test_preprocess_videos.py
+"""
+
+
+def write_clip(path, num_frames=65, size=(64, 48)):
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'mp4v'), 30, size)
+    for i in range(num_frames):
+        writer.write(np.full((size[1], size[0], 3), i * 3, np.uint8))
+    writer.release()
+
+
+def test_frames_match_video_tensor_and_resume(tmp_path):
+    (tmp_path / "clips").mkdir()
+    write_clip(tmp_path / "clips" / "dia0_utt0.mp4")
+    write_clip(tmp_path / "clips" / "dia0_utt1.mp4", num_frames=10)
+    folder = str(tmp_path / "clips")
+
+    tasks, total = collect_tasks([folder], str(tmp_path / "frames"), 30, None, False)
+    assert total == 2 and len(tasks) == 2
+    for task in tasks:
+        process_videos_into_frames(task)
+        assert np.array_equal(np.load(task[1]), video_to_tensor(task[0], 30).numpy())
+
+    # finished clips are skipped, other settings are extracted separately
+    assert collect_tasks([folder], str(tmp_path / "frames"), 30, None, False)[0] == []
+    tasks, _ = collect_tasks([folder], str(tmp_path / "frames"), 30, 32, False)
+    num_frames, _ = process_videos_into_frames(tasks[0])
+    assert np.load(tasks[0][1]).shape == (num_frames, 24, 32, 3)
+
+
+def test_unreadable_clip_is_not_marked_done(tmp_path):
+    (tmp_path / "clips").mkdir()
+    (tmp_path / "clips" / "dia0_utt0.mp4").write_bytes(b"not a video")
+    folder = str(tmp_path / "clips")
+
+    tasks, total = collect_tasks([folder], str(tmp_path / "frames"), 30, None, False)
+    assert total == 1 and len(tasks) == 1
+    assert process_videos_into_frames(tasks[0]) is None
+    # retried on the next run
+    assert collect_tasks([folder], str(tmp_path / "frames"), 30, None, False)[0] == tasks
@@ -0,0 +1,102 @@
+import argparse
+import json
+import os
+import pickle
+
+import numpy as np
+import torch
+import transformers
+from sklearn.preprocessing import StandardScaler
+from transformers import BertConfig, BertModel
+
+import dataset
+import score_dialogues
+from test_dataset_index import write_csv
+from test_streaming import small_model
+
+"""
+End-to-end test of the batch scoring CLI, run with
+    python -m pytest test_score_dialogues.py
+"""
+
+
+def test_scores_csv_and_resumes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(dataset, "INDEX_CACHE_PATH", str(tmp_path / "index"))
+    # the pretrained BERT can't be downloaded here, the audio-only model doesn't use it
+    monkeypatch.setattr(transformers.BertModel, "from_pretrained", lambda *args, **kwargs: BertModel(
+        BertConfig(vocab_size=10, hidden_size=8, num_hidden_layers=1, num_attention_heads=1, intermediate_size=8)))
+    model = small_model(monkeypatch, window_size=2)
+    torch.save({'model_state_dict': model.state_dict(), 'config': vars(model.config)}, str(tmp_path / "model.pt"))
+
+    records = write_csv(tmp_path / "archive.csv", seed=5)
+    audio_embs = {"{}_{}".format(d_id, u_id): np.random.randn(1, model.config.audio_in_dim) for d_id, u_id in records}
+    with open(tmp_path / "audio.pkl", 'wb') as f:
+        pickle.dump(audio_embs, f)
+    with open(tmp_path / "params.pkl", 'wb') as f:
+        pickle.dump(StandardScaler().fit(np.concatenate(list(audio_embs.values()))), f)
+
+    argv = ["--checkpoint", "model.pt", "--csv", "archive.csv", "--output", "scores", "--workers", "0",
+            "--shard-size", "5", "--batch-size", "2", "--audio-embs", "audio.pkl", "--audio-params", "params.pkl"]
+    score_dialogues.main(argv)
+    rows = [json.loads(line) for name in sorted(os.listdir("scores")) if name.endswith(".jsonl")
+            for line in open(os.path.join("scores", name))]
+    assert sorted((row['dialogue_id'], row['utterance_id']) for row in rows) == sorted(records)
+    for row in rows:
+        assert abs(sum(row['emotion_' + name] for name in dataset.EMOTION_MAPPING) - 1) < 1e-5
+        assert abs(sum(row['sentiment_{}'.format(i)] for i in range(7)) - 1) < 1e-5
+
+    # the scores of a dialogue are those of a forward pass over it alone
+    meld = dataset.MELDDataset("archive.csv", ".", audio_embs, name="check", config=model.config)
+    meld.apply_audio_transform(pickle.load(open("params.pkl", 'rb')), False)
+    inputs, _ = dataset.collate_dialogues([meld[0]])
+    with torch.no_grad():
+        emotion = torch.softmax(model(inputs)[0], dim=1)
+    first = {row['utterance_id']: row for row in rows if row['dialogue_id'] == meld.data[0].dialogue_id}
+    for u_id, probs in enumerate(emotion.tolist()):
+        assert np.allclose([first[u_id]['emotion_' + name] for name in sorted(dataset.EMOTION_MAPPING, key=dataset.EMOTION_MAPPING.get)], probs, atol=1e-5)
+
+    # finished shards are skipped on a re-run
+    os.remove(os.path.join("scores", "part-00001.jsonl"))
+    monkeypatch.setattr(score_dialogues, "report_progress", lambda results, num_tasks: [list(results), num_tasks])
+    calls = []
+    monkeypatch.setattr(score_dialogues, "score_shard", lambda task: calls.append(task) or (task[0], 0))
+    score_dialogues.main(argv)
+    # workers only get the range of dialogues of a shard
+    assert calls == [(1, 5, 10)]
+
+
+def test_loads_checkpoints_with_a_sentiment_model(tmp_path, monkeypatch):
+    from models.dialogue_gcn import DialogueGCN
+    from models.sentiment_model import build_sentiment_model
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(dataset, "INDEX_CACHE_PATH", str(tmp_path / "index"))
+    tiny_bert = lambda *args, **kwargs: BertModel(
+        BertConfig(vocab_size=10, hidden_size=8, num_hidden_layers=1, num_attention_heads=1, intermediate_size=8))
+    monkeypatch.setattr(transformers.BertModel, "from_pretrained", tiny_bert)
+    config = small_model(monkeypatch, window_size=2).config
+    config.use_sentiment = True
+    # one BERT shared by the model and its sentiment model, like in main.py
+    bert = tiny_bert()
+    model = DialogueGCN(config, bert, build_sentiment_model(bert))
+    torch.save({'model_state_dict': model.state_dict(), 'config': vars(config)}, str(tmp_path / "model.pt"))
+    records = write_csv(tmp_path / "archive.csv", seed=6)
+    audio_embs = {"{}_{}".format(d_id, u_id): np.random.randn(1, config.audio_in_dim) for d_id, u_id in records}
+    with open(tmp_path / "audio.pkl", 'wb') as f:
+        pickle.dump(audio_embs, f)
+    with open(tmp_path / "params.pkl", 'wb') as f:
+        pickle.dump(StandardScaler().fit(np.concatenate(list(audio_embs.values()))), f)
+
+    args = argparse.Namespace(checkpoint="model.pt", csv="archive.csv", video_dir=".", audio_embs="audio.pkl",
+                              audio_params="params.pkl", name="score_archive", device="cpu", precision="float32",
+                              threads_per_worker=1)
+    score_dialogues.init_worker(args)
+    for name, weights in model.state_dict().items():
+        assert torch.equal(score_dialogues.model.state_dict()[name], weights)
+
+
+def test_split_name_is_unique_to_the_csv(tmp_path):
+    name = score_dialogues.get_split_name(str(tmp_path / "test_sent_emo.csv"))
+    assert name != "test" and name.startswith("score_test_sent_emo_")
+    assert name != score_dialogues.get_split_name(str(tmp_path / "other" / "test_sent_emo.csv"))
@@ -0,0 +1,56 @@
+import torch
+from transformers import BertConfig, BertModel
+
+import models.dialogue_gcn
+from models.config import Config
+from models.dialogue_gcn import DialogueGCN
+from models.streaming import StreamingSession
+
+"""
+Tests for the incremental scoring of live conversations, run with
+    python -m pytest test_streaming.py
+"""
+
+
+class NoVisualModel(torch.nn.Module):
+    """
+    Stands in for the ExpressionDetector, whose FaceNet weights are downloaded
+    on construction; these tests don't use faces.
+    """
+    def __init__(self, *args, **kwargs):
+        super(NoVisualModel, self).__init__()
+
+
+def small_model(monkeypatch, window_size):
+    monkeypatch.setattr(models.dialogue_gcn, "ExpressionDetector", NoVisualModel)
+    config = Config(False, False, True, 1, False)
+    config.att_window_size = window_size
+    bert = BertModel(BertConfig(vocab_size=10, hidden_size=8, num_hidden_layers=1, num_attention_heads=1, intermediate_size=8))
+    torch.manual_seed(0)
+    return DialogueGCN(config, bert, None).eval()
+
+
+def test_session_matches_full_forward_on_every_prefix(monkeypatch):
+    model = small_model(monkeypatch, window_size=3)
+    session = StreamingSession(model)
+    torch.manual_seed(1)
+    num_utts = 15
+    indept_embeds = torch.randn(1, num_utts, model.config.audio_out_dim)
+    speakers = torch.randint(0, 3, (num_utts,))
+    with torch.no_grad():
+        for n in range(1, num_utts + 1):
+            emotion, sentiment = session.add_embedding(int(speakers[n - 1]), indept_embeds[:, n - 1:n])
+            context_embeds = model.context_encoder(indept_embeds[:, :n])[0].squeeze(0)
+            edges, self_attn = model.construct_edges_relations(context_embeds, speakers[:n])
+            expected_emotion, expected_sentiment = model.classify(context_embeds, edges, self_attn)
+            assert torch.allclose(emotion, torch.softmax(expected_emotion[-1], dim=0), atol=1e-5), n
+            assert torch.allclose(sentiment, torch.softmax(expected_sentiment[-1], dim=0), atol=1e-5), n
+
+
+def test_session_history_is_bounded(monkeypatch):
+    model = small_model(monkeypatch, window_size=2)
+    session = StreamingSession(model)
+    for i in range(30):
+        session.add_embedding(i % 2, torch.randn(1, 1, model.config.audio_out_dim))
+    assert session.num_utts == 30
+    assert len(session.indept_embeds) == len(session.forward_states) == 5
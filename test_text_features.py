@@ -0,0 +1,105 @@
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pack_padded_sequence
+from transformers import BertConfig, BertModel, BertTokenizer, BertTokenizerFast
+
+from models import text_features
+from models.text_features import encode_transcripts, length_buckets, tokenize_transcripts
+
+"""
+Tests for the dataset-side tokenization and the batched BERT encoding of DialogueGCN.embed_text, run with
+    python -m pytest test_text_features.py
+"""
+
+
+def small_bert():
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=100, hidden_size=32, num_hidden_layers=2, num_attention_heads=4, intermediate_size=64)
+    return BertModel(config).eval()
+
+
+def test_buckets_cover_in_order_within_budget():
+    lengths = [50, 40, 40, 12, 9, 9, 9, 3, 1]
+    buckets = length_buckets(lengths, max_batch_tokens=100)
+    assert buckets[0][0] == 0 and buckets[-1][1] == len(lengths)
+    for (start, end), (next_start, _) in zip(buckets, buckets[1:]):
+        assert end == next_start
+    for start, end in buckets:
+        assert end > start
+        assert (end - start) * lengths[start] <= 100 or end - start == 1
+
+
+def test_batched_matches_per_utterance():
+    bert = small_bert()
+    torch.manual_seed(1)
+    input_ids = [torch.randint(1, 100, (length,)).tolist() for length in [7, 3, 12, 7, 1, 25, 4]]
+    with torch.no_grad():
+        hidden_states, sorted_lengths, sorted_idx = encode_transcripts(bert, input_ids, "cpu", max_batch_tokens=40)
+        assert sorted_lengths.tolist() == sorted([len(ids) for ids in input_ids], reverse=True)
+        for row, i in enumerate(sorted_idx.tolist()):
+            expected = bert(torch.tensor([input_ids[i]]))[0][0]
+            assert torch.allclose(hidden_states[row, :sorted_lengths[row]], expected, atol=1e-5)
+    # rows are ready to be packed as they are
+    pack_padded_sequence(hidden_states, sorted_lengths, batch_first=True)
+
+
+def test_fast_tokenizer_matches_slow(tmp_path, monkeypatch):
+    words = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "oh", "my", "god", "you", "'", "re", "here", "!", "?",
+             ",", ".", "what", "are", "doing", "##ing", "do", "no", "way"]
+    vocab_file = tmp_path / "vocab.txt"
+    vocab_file.write_text("\n".join(words) + "\n")
+    slow = BertTokenizer(str(vocab_file))
+    monkeypatch.setattr(text_features, "tokenizer", BertTokenizerFast(str(vocab_file)))
+    transcripts = ["Oh my God, you're here!", "What are you doing?", "No way.", "", "Doing what?!"]
+    token_ids = tokenize_transcripts(transcripts, batch_size=2)
+    assert len(token_ids) == len(transcripts)
+    for transcript, ids in zip(transcripts, token_ids):
+        assert ids.dtype == np.int32
+        assert ids.tolist() == slow.encode(transcript)
+
+
+def test_text_cache_follows_transcript_edits(tmp_path, monkeypatch):
+    import pandas as pd
+    import pytest
+    import build_text_cache
+    import dataset
+    import transformers
+    from models.config import Config
+    from test_dataset_index import write_csv
+
+    monkeypatch.setattr(dataset, "INDEX_CACHE_PATH", str(tmp_path / "index"))
+    monkeypatch.setattr(dataset, "TEXT_CACHE_PATH", str(tmp_path / "text"))
+    monkeypatch.setattr(dataset, "feature_stores", {})
+    monkeypatch.setattr(transformers.BertModel, "from_pretrained", lambda *args, **kwargs: small_bert())
+    # one "token" per character, enough to tell transcripts apart
+    monkeypatch.setattr(build_text_cache, "tokenize_transcripts",
+                        lambda transcripts: [np.frombuffer(t.encode(), dtype=np.uint8) % 100 for t in transcripts])
+    csv_file = tmp_path / "train_sent_emo.csv"
+    write_csv(csv_file, seed=8)
+    argv = ["--data-root", str(tmp_path), "--splits", "train", "--device", "cpu", "--dtype", "float32"]
+    build_text_cache.main(argv)
+
+    config = Config(True, False, False, 0, False)
+    config.use_text_cache = True
+    meld = dataset.MELDDataset(str(csv_file), str(tmp_path), None, name="train", config=config)
+    (transcripts, _, _, _), _ = meld[0]
+    assert [len(features) for features in transcripts] == [len(t) for t in meld.transcripts[:len(transcripts)]]
+    utterance = meld.data[0].utterances[0]
+    assert torch.equal(utterance.get_text_features(), transcripts[0])
+
+    # an edited transcript misses until the cache is built again
+    records = pd.read_csv(csv_file)
+    first = (records["Dialogue_ID"] == records["Dialogue_ID"][0]) & (records["Utterance_ID"] == 0)
+    records.loc[first, "Utterance"] = "an edited transcript"
+    records.to_csv(csv_file, index=False)
+    edited = dataset.MELDDataset(str(csv_file), str(tmp_path), None, name="train", config=config)
+    with pytest.raises(Exception, match="run build_text_cache.py"):
+        edited[0]
+    with pytest.raises(Exception, match="run build_text_cache.py"):
+        edited.data[0].utterances[0].get_text_features()
+    build_text_cache.main(argv)
+    (transcripts, _, _, _), _ = edited[0]
+    assert len(transcripts[0]) == len("an edited transcript")
+    assert torch.equal(edited.data[0].utterances[0].get_text_features(), transcripts[0])
+    # the hidden states of the old version are dropped
+    assert len(dataset.get_text_store()) == len(edited.dialogue_ids)